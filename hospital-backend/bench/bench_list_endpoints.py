@@ -0,0 +1,97 @@
+# bench_list_endpoints.py
+# Thời gian / số query / kích thước response của các API danh sách lớn (serialize 1 lượt bằng pydantic-core).
+# python bench/bench_list_endpoints.py [file.json]
+# Có file.json: ghi body các response ra file -> chạy ở 2 commit rồi so 2 file để chắc output không đổi.
+import json
+import sys
+import time
+from datetime import datetime, time as clock, timedelta
+from decimal import Decimal
+
+from common import ADMIN, DOC, QUERIES, client, database, models
+
+ROUNDS = 20
+
+
+def seed_lists():
+    db = database.SessionLocal()
+    try:
+        now = datetime.now()
+        doctor = db.query(models.User).filter_by(username="doc").one()
+        technician = db.query(models.User).filter_by(username="tech").one()
+        patients = [models.Patient(full_name=f"BN {i}", dob=datetime(1990, 1, 1), gender="Nam", phone=f"09{i:08d}")
+                    for i in range(200)]
+        db.add_all(patients)
+        db.flush()
+
+        # 1000 lịch hẹn, 1000 hồ sơ nội trú, 1000 chỉ định có kết quả, 200 y lệnh hằng ngày
+        db.add_all([
+            models.Appointment(patient_id=patients[i % 200].patient_id, doctor_id=doctor.user_id,
+                               appointment_date=(now - timedelta(days=i % 30)).date(),
+                               start_time=clock(9, 0), end_time=clock(9, 30), reason="Khám", status="PENDING")
+            for i in range(1000)
+        ])
+        bed = db.query(models.Bed).first()
+        records = [models.InpatientRecord(patient_id=patients[i % 200].patient_id, treating_doctor_id=doctor.user_id,
+                                          admission_date=now - timedelta(minutes=i), status="ACTIVE", initial_diagnosis="x")
+                   for i in range(1000)]
+        db.add_all(records)
+        db.flush()
+        db.add_all([models.BedAllocation(inpatient_id=record.inpatient_id, bed_id=bed.bed_id, check_in_time=now,
+                                         price_per_day=Decimal(300000)) for record in records[:2]])
+
+        visit = models.Visit(patient_id=patients[0].patient_id, doctor_id=doctor.user_id, status="COMPLETED", visit_date=now)
+        db.add(visit)
+        db.flush()
+        service = db.query(models.Service).first()
+        for i in range(1000):
+            request = models.ServiceRequest(visit_id=visit.visit_id, service_id=service.service_id, doctor_id=doctor.user_id,
+                                            quantity=1, unit_price=service.price, status="COMPLETED",
+                                            created_at=now - timedelta(minutes=i))
+            db.add(request)
+            db.flush()
+            db.add(models.ServiceResult(request_id=request.request_id, conclusion="ok" * 20, performed_at=now,
+                                        technician_id=technician.user_id if i % 2 else None))
+        db.add_all([
+            models.DailyOrder(inpatient_id=records[0].inpatient_id, doctor_id=doctor.user_id, date=(now - timedelta(days=i)).date(),
+                              progress_note="x" * 100, doctor_instruction="y", vitals={"pulse": 80})
+            for i in range(200)
+        ])
+        db.commit()
+        return patients[0].patient_id, records[0].inpatient_id
+    finally:
+        db.close()
+
+
+def main():
+    patient_id, inpatient_id = seed_lists()
+    urls = [
+        ("/appointments?limit=1000", ADMIN),
+        ("/inpatients?limit=1000", ADMIN),
+        (f"/patients/{patient_id}/service-results", DOC),
+        (f"/inpatients/{inpatient_id}", ADMIN),
+    ]
+    bodies = {}
+    for url, headers in urls:
+        client.get(url, headers=headers) # Chạy nóng
+        QUERIES.clear()
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            response = client.get(url, headers=headers)
+        elapsed = (time.perf_counter() - started) / ROUNDS * 1000
+        print(f"{url:45s} {response.status_code} {elapsed:7.1f} ms  {len(QUERIES) // ROUNDS} queries  {len(response.content)} bytes")
+
+        body = response.json()
+        if isinstance(body, dict): # Tiền giường tính theo thời điểm gọi -> bỏ khi so sánh
+            body.pop("current_bed_fee", None)
+            for bed in body.get("bed_history", []):
+                bed.pop("total_price", None)
+        bodies[url] = body
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "w", encoding="utf-8") as f:
+            json.dump(bodies, f, ensure_ascii=False, sort_keys=True, default=str)
+
+
+if __name__ == "__main__":
+    main()
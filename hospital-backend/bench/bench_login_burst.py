@@ -0,0 +1,81 @@
+# bench_login_burst.py
+# Đợt đăng nhập dồn dập (đầu ca) có làm chậm các API khác không: đo GET /medicines khi chạy 1 mình và khi
+# chạy song song với N lần POST /login (bcrypt thật), đếm câu SQL chạy trên thread của event loop (phải = 0).
+# N=60 python bench/bench_login_burst.py
+import asyncio
+import os
+import statistics
+import threading
+import time
+
+import httpx
+from passlib.context import CryptContext
+from sqlalchemy import event
+
+from common import ADMIN, database, main, models, security
+
+LOGINS = int(os.environ.get("N", 60))
+OTHER_REQUESTS = 40
+
+_loop_thread = None
+_loop_queries = []
+
+@event.listens_for(database.engine, "before_cursor_execute")
+def _on_loop(conn, cursor, statement, *args):
+    if threading.get_ident() == _loop_thread:
+        _loop_queries.append(statement)
+
+
+def seed_users():
+    hashed = CryptContext(schemes=["bcrypt"]).hash("secret")
+    db = database.SessionLocal()
+    try:
+        db.add_all([models.User(username=f"user{i}", password=hashed, full_name=f"User {i}", role="NURSE")
+                    for i in range(LOGINS)])
+        db.commit()
+    finally:
+        db.close()
+
+
+async def timed(client, method, url, **kwargs):
+    started = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    return time.perf_counter() - started, response.status_code
+
+
+def summary(latencies) -> str:
+    return f"p50 {statistics.median(latencies) * 1000:6.0f} ms, max {max(latencies) * 1000:6.0f} ms"
+
+
+async def run():
+    global _loop_thread
+    _loop_thread = threading.get_ident()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.get("/medicines", headers=ADMIN) # Chạy nóng
+
+        alone = await asyncio.gather(*[timed(client, "GET", "/medicines", headers=ADMIN) for _ in range(OTHER_REQUESTS)])
+
+        async def others():
+            await asyncio.sleep(0.05) # Để đợt đăng nhập vào hàng trước
+            return await asyncio.gather(*[timed(client, "GET", "/medicines", headers=ADMIN) for _ in range(OTHER_REQUESTS)])
+
+        started = time.perf_counter()
+        logins, during = await asyncio.gather(
+            asyncio.gather(*[timed(client, "POST", "/login", data={"username": f"user{i}", "password": "secret"})
+                             for i in range(LOGINS)]),
+            others()
+        )
+        wall = time.perf_counter() - started
+
+    print(f"{'GET /medicines, chạy 1 mình:':34s}{summary([t for t, _ in alone])}")
+    print(f"{'GET /medicines, trong đợt login:':34s}{summary([t for t, _ in during])}")
+    print(f"{f'{LOGINS} x POST /login:':34s}{summary([t for t, _ in logins])}, "
+          f"status {sorted({code for _, code in logins})}, tổng {wall:.2f}s")
+    print(f"Câu SQL chạy trên event loop: {len(_loop_queries)}")
+    print(f"bcrypt executor: {security.hash_stats()}")
+
+
+if __name__ == "__main__":
+    seed_users()
+    asyncio.run(run())
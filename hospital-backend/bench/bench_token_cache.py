@@ -0,0 +1,51 @@
+# bench_token_cache.py
+# Chi phí xác thực token: giải mã + kiểm chữ ký JWT mỗi lần so với đọc claims đã xác thực trong token_cache,
+# và thời gian 1 request GET /medicines khi cache token còn / bị xóa trước mỗi request.
+# python bench/bench_token_cache.py
+import time
+import timeit
+
+from fastapi import HTTPException
+from jose import jwt
+
+from common import client, security
+
+CALLS = 20000
+REQUESTS = 500
+
+
+def per_call_us(func, number: int) -> float:
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def main():
+    token = security.create_access_token({"sub": "nurse", "role": "NURSE", "uid": 3})
+
+    decode = per_call_us(lambda: jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM]), CALLS)
+    security.get_current_user(token)
+    cached = per_call_us(lambda: security.get_current_user(token), CALLS)
+    print(f"jwt.decode:                  {decode:7.1f} us/call")
+    print(f"get_current_user (cache):    {cached:7.1f} us/call")
+
+    # Cả request: cache trống trước mỗi lần gọi (như trước khi có token_cache) / cache còn
+    headers = {"Authorization": f"Bearer {token}"}
+    client.get("/medicines", headers=headers)
+    for label, clear in (("không cache", True), ("có cache", False)):
+        started = time.perf_counter()
+        for _ in range(REQUESTS):
+            if clear:
+                security.token_cache.clear()
+            client.get("/medicines", headers=headers)
+        print(f"GET /medicines, {label + ':':13s}{(time.perf_counter() - started) / REQUESTS * 1000:7.2f} ms/request")
+
+    # Token hết hạn không được lấy từ cache: vẫn 401
+    expired = jwt.encode({"sub": "nurse", "role": "NURSE", "exp": 1}, security.SECRET_KEY, algorithm=security.ALGORITHM)
+    try:
+        security.get_current_user(expired)
+    except HTTPException as e:
+        print(f"token hết hạn -> {e.status_code}")
+    print(security.token_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
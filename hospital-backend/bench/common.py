@@ -0,0 +1,75 @@
+# common.py
+# Môi trường chung cho các script benchmark trong bench/: SQLite file tạm thay cho MySQL
+# (thay engine / SessionLocal TRƯỚC khi import main), dữ liệu nền tối thiểu, TestClient và token.
+# Chạy từ thư mục hospital-backend: python bench/<script>.py
+# Số đo trên SQLite chỉ dùng để so trước / sau 1 thay đổi trên cùng máy, không phải số của MySQL thật.
+import os
+import sys
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="hospital-bench-"), "bench.db")
+database.engine = create_engine(f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False})
+database.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=database.engine)
+
+# Các câu SQL đã chạy (đếm số query / request)
+QUERIES = []
+
+@event.listens_for(database.engine, "before_cursor_execute")
+def _count(conn, cursor, statement, *args):
+    QUERIES.append(statement)
+
+import models  # noqa: E402
+import main  # noqa: E402
+import security  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+database.Base.metadata.create_all(bind=database.engine)
+
+
+# --- Dữ liệu nền: tài khoản mỗi vai trò, 2 bệnh nhân, danh mục thuốc / dịch vụ, 1 khoa - 1 phòng - 3 giường ---
+def seed():
+    db = database.SessionLocal()
+    try:
+        db.add_all([
+            models.User(username=username, password="123456", full_name=name, role=role)
+            for username, name, role in (("admin", "Admin", "ADMIN"), ("doc", "BS A", "DOCTOR"),
+                                         ("nurse", "Y tá", "NURSE"), ("tech", "KTV", "TECHNICIAN"))
+        ])
+        db.add_all([
+            models.Patient(full_name="Nguyễn Văn An", dob=datetime(1990, 1, 1), gender="Nam", phone="0901234567"),
+            models.Patient(full_name="Trần Thị Bình", dob=datetime(1985, 5, 5), gender="Nu", phone="0912345678"),
+        ])
+        db.add_all([models.Medicine(name=f"Thuốc {i}", unit="viên", price=Decimal(1000 * (i + 1)), stock_quantity=1000)
+                    for i in range(5)])
+        db.add_all([models.Service(name=f"Dịch vụ {i}", type="LAB", price=Decimal(20000 * (i + 1))) for i in range(3)])
+        department = models.Department(name="Nội", location="A")
+        db.add(department)
+        db.flush()
+        room = models.Room(department_id=department.department_id, room_number="101", type="STANDARD",
+                           base_price=Decimal(300000))
+        db.add(room)
+        db.flush()
+        db.add_all([models.Bed(room_id=room.room_id, bed_number=f"B{i}", status="AVAILABLE") for i in range(3)])
+        db.commit()
+    finally:
+        db.close()
+
+seed()
+client = TestClient(main.app)
+
+
+def auth(username: str, role: str) -> dict:
+    return {"Authorization": "Bearer " + security.create_access_token({"sub": username, "role": role})}
+
+ADMIN = auth("admin", "ADMIN")
+DOC = auth("doc", "DOCTOR")
+NURSE = auth("nurse", "NURSE")
@@ -0,0 +1,602 @@
+# billing.py
+# Tính tiền tập trung cho lượt khám (Visit) và hồ sơ nội trú (InpatientRecord).
+# Mọi hàm ở đây chạy một số lượng query CỐ ĐỊNH (JOIN + GROUP BY),
+# không phụ thuộc số dòng thuốc / dịch vụ (tránh N+1 query).
+# Tiền luôn tính theo giá đã chốt trên dòng (unit_price), đổi giá danh mục
+# không làm thay đổi các hóa đơn cũ. Dòng cũ chưa chốt giá (unit_price NULL, chưa chạy
+# backfill-prices) tính theo giá danh mục hiện tại - ở MỌI chỗ (xem trước, hóa đơn, tổng, rollup)
+# để các con số luôn khớp nhau.
+from datetime import datetime, date, time, timedelta
+from sqlalchemy import Date, func, insert, select, update
+from sqlalchemy.orm import Session
+import models, catalog, database
+
+FIXED_EXAM_FEE = 50000.0 # Phí khám cố định (VNĐ)
+
+
+# --- HELPER: Số ngày nằm giường (làm tròn lên, tối thiểu 1 ngày) ---
+def bed_days(check_in: datetime, check_out: datetime) -> int:
+    duration = check_out - check_in
+    return max(1, duration.days + (1 if duration.seconds > 0 else 0))
+
+
+# --- HELPER: Giá tính tiền của 1 dòng (giá đã chốt, chưa chốt thì giá danh mục - cần JOIN danh mục) ---
+def medicine_line_price():
+    return func.coalesce(models.Prescription.unit_price, models.Medicine.price)
+
+def service_line_price():
+    return func.coalesce(models.ServiceRequest.unit_price, models.Service.price)
+
+# --- HELPER: Giá hiện hành đọc thẳng từ DB lúc chốt giá (kê đơn, chỉ định, nhập viện / chuyển giường) ---
+# Không lấy từ cache danh mục: cache của process có thể chưa thấy lần đổi giá vừa xong. None nếu không tồn tại.
+def medicine_price(db: Session, medicine_id: int):
+    return db.query(models.Medicine.price).filter(models.Medicine.medicine_id == medicine_id).scalar()
+
+def service_price(db: Session, service_id: int):
+    return db.query(models.Service.price).filter(models.Service.service_id == service_id).scalar()
+
+def room_price(db: Session, room_id: int):
+    return db.query(models.Room.base_price).filter(models.Room.room_id == room_id).scalar()
+
+
+# --- A. LƯỢT KHÁM (VISIT) ---
+
+# 1. Chi tiết tiền thuốc của các lượt khám (1 query, tên thuốc lấy từ cache danh mục)
+# Dòng cũ chưa chốt giá (unit_price NULL) thì tính theo giá danh mục hiện tại
+def visit_medicine_lines(db: Session, visit_ids: list[int]) -> dict[int, list[dict]]:
+    lines = {vid: [] for vid in visit_ids}
+    if not visit_ids:
+        return lines
+
+    rows = db.query(
+        models.Prescription.visit_id,
+        models.Prescription.medicine_id,
+        models.Prescription.quantity,
+        models.Prescription.unit_price
+    ).filter(models.Prescription.visit_id.in_(visit_ids))\
+     .order_by(models.Prescription.prescription_id).all()
+    medicines = catalog.medicines(db, [r.medicine_id for r in rows])
+
+    for r in rows:
+        medicine = medicines[r.medicine_id]
+        price = r.unit_price if r.unit_price is not None else medicine["price"]
+        lines[r.visit_id].append({"name": medicine["name"], "qty": r.quantity, "price": price, "total": r.quantity * float(price)})
+    return lines
+
+# 2. Chi tiết tiền dịch vụ CLS của các lượt khám (1 query, bỏ CANCELLED, tên dịch vụ lấy từ cache danh mục)
+def visit_service_lines(db: Session, visit_ids: list[int]) -> dict[int, list[dict]]:
+    lines = {vid: [] for vid in visit_ids}
+    if not visit_ids:
+        return lines
+
+    rows = db.query(
+        models.ServiceRequest.visit_id,
+        models.ServiceRequest.service_id,
+        models.ServiceRequest.quantity,
+        models.ServiceRequest.unit_price
+    ).filter(
+        models.ServiceRequest.visit_id.in_(visit_ids),
+        models.ServiceRequest.status != 'CANCELLED'
+    ).order_by(models.ServiceRequest.request_id).all()
+    services = catalog.services(db, [r.service_id for r in rows])
+
+    for r in rows:
+        service = services[r.service_id]
+        price = r.unit_price if r.unit_price is not None else service["price"]
+        lines[r.visit_id].append({"name": service["name"], "qty": r.quantity, "price": price, "total": r.quantity * float(price)})
+    return lines
+
+# 3. Tổng tiền thuốc / dịch vụ theo từng lượt khám (2 query GROUP BY visit_id)
+# Giá đã chốt trên từng dòng, dòng cũ chưa chốt thì lấy giá danh mục (OUTER JOIN danh mục)
+def visit_totals(db: Session, visit_ids: list[int]) -> dict[int, dict]:
+    totals = {vid: {"medicine_total": 0.0, "service_total": 0.0} for vid in visit_ids}
+    if not visit_ids:
+        return totals
+
+    med_rows = db.query(
+        models.Prescription.visit_id,
+        func.sum(models.Prescription.quantity * medicine_line_price())
+    ).outerjoin(models.Medicine, models.Medicine.medicine_id == models.Prescription.medicine_id)\
+     .filter(models.Prescription.visit_id.in_(visit_ids))\
+     .group_by(models.Prescription.visit_id).all()
+
+    srv_rows = db.query(
+        models.ServiceRequest.visit_id,
+        func.sum(models.ServiceRequest.quantity * service_line_price())
+    ).outerjoin(models.Service, models.Service.service_id == models.ServiceRequest.service_id)\
+     .filter(
+        models.ServiceRequest.visit_id.in_(visit_ids),
+        models.ServiceRequest.status != 'CANCELLED'
+    ).group_by(models.ServiceRequest.visit_id).all()
+
+    for vid, amount in med_rows:
+        totals[vid]["medicine_total"] = float(amount or 0)
+    for vid, amount in srv_rows:
+        totals[vid]["service_total"] = float(amount or 0)
+    return totals
+
+# 4. Tính hóa đơn 1 lượt khám (BHYT giảm trừ trên tổng)
+def summarize_bill(medicine_total: float, service_total: float,
+                   insurance_percent: int = 0, procedure_fee: float = 0) -> dict:
+    sub_total = medicine_total + service_total + FIXED_EXAM_FEE + procedure_fee
+    discount = sub_total * (insurance_percent / 100)
+    return {
+        "medicine_total": medicine_total,
+        "service_total": service_total,
+        "exam_fee": FIXED_EXAM_FEE,
+        "procedure_fee": procedure_fee,
+        "sub_total": sub_total,
+        "insurance_percent": insurance_percent,
+        "discount": discount,
+        "final_amount": sub_total - discount
+    }
+
+# 5. Hóa đơn cho nhiều lượt khám cùng lúc (chốt ca): đọc VisitCharges cho cả lô
+def visit_bills(db: Session, visit_ids: list[int],
+                insurance_percent: int = 0, procedure_fee: float = 0) -> dict[int, dict]:
+    totals = charge_totals(db, visit_ids)
+    return {
+        vid: summarize_bill(totals[vid]["medicine_total"], totals[vid]["service_total"],
+                            insurance_percent, procedure_fee)
+        for vid in visit_ids
+    }
+
+# 6. Dòng chi tiết hóa đơn (thuốc, dịch vụ, phí khám, thủ thuật) cho các lượt khám (3 query)
+# insurance_amount = phần BHYT chi trả của từng dòng
+def visit_invoice_items(db: Session, visit_ids: list[int],
+                        insurance_percent: int = 0, procedure_fee: float = 0) -> dict[int, list[dict]]:
+    items = {vid: [] for vid in visit_ids}
+    if not visit_ids:
+        return items
+    share = insurance_percent / 100
+
+    def add_item(vid, doctor_id, item_type, item_id, name, category, qty, price):
+        amount = qty * float(price)
+        items[vid].append({
+            "visit_id": vid, "doctor_id": doctor_id, "item_type": item_type,
+            "item_id": item_id, "item_name": name, "category": category,
+            "quantity": qty, "unit_price": float(price),
+            "amount": amount, "insurance_amount": amount * share
+        })
+
+    doctors = dict(db.query(models.Visit.visit_id, models.Visit.doctor_id).filter(
+        models.Visit.visit_id.in_(visit_ids)
+    ).all())
+
+    med_rows = db.query(
+        models.Prescription.visit_id,
+        models.Prescription.medicine_id,
+        models.Medicine.name,
+        models.Medicine.category,
+        models.Prescription.quantity,
+        medicine_line_price().label("price")
+    ).join(models.Medicine, models.Medicine.medicine_id == models.Prescription.medicine_id)\
+     .filter(models.Prescription.visit_id.in_(visit_ids))\
+     .order_by(models.Prescription.prescription_id).all()
+
+    srv_rows = db.query(
+        models.ServiceRequest.visit_id,
+        models.ServiceRequest.doctor_id,
+        models.ServiceRequest.service_id,
+        models.Service.name,
+        models.Service.type,
+        models.ServiceRequest.quantity,
+        service_line_price().label("price")
+    ).join(models.Service, models.Service.service_id == models.ServiceRequest.service_id)\
+     .filter(
+        models.ServiceRequest.visit_id.in_(visit_ids),
+        models.ServiceRequest.status != 'CANCELLED'
+    ).order_by(models.ServiceRequest.request_id).all()
+
+    for r in med_rows:
+        add_item(r.visit_id, doctors.get(r.visit_id), 'MEDICINE', r.medicine_id, r.name, r.category, r.quantity, r.price)
+    for r in srv_rows:
+        add_item(r.visit_id, r.doctor_id, 'SERVICE', r.service_id, r.name, r.type, r.quantity, r.price)
+    for vid in visit_ids:
+        add_item(vid, doctors.get(vid), 'EXAM', None, "Phí khám", None, 1, FIXED_EXAM_FEE)
+        if procedure_fee:
+            add_item(vid, doctors.get(vid), 'PROCEDURE', None, "Phí thủ thuật", None, 1, procedure_fee)
+    return items
+
+# 7. Tạo hóa đơn + dòng chi tiết (chưa commit, để gọi được trong transaction lớn hơn)
+# Tổng tiền lấy từ chính các dòng -> tổng hóa đơn luôn khớp tổng chi tiết
+def build_invoice(db: Session, visit_id: int, items: list[dict], insurance_percent: int,
+                  procedure_fee: float, payment_method: str, now: datetime = None):
+    now = now or datetime.now()
+    bill = summarize_bill(
+        sum(i["amount"] for i in items if i["item_type"] == 'MEDICINE'),
+        sum(i["amount"] for i in items if i["item_type"] == 'SERVICE'),
+        insurance_percent, procedure_fee
+    )
+    invoice = models.Invoice(
+        visit_id=visit_id,
+        payment_time=now,
+        medicine_total=bill["medicine_total"],
+        service_total=bill["service_total"],
+        exam_fee=bill["exam_fee"],
+        procedure_fee=bill["procedure_fee"],
+        insurance_percent=insurance_percent,
+        final_amount=bill["final_amount"],
+        payment_method=payment_method
+    )
+    db.add(invoice)
+    db.flush() # Lấy invoice_id
+
+    db.add_all([models.InvoiceItem(invoice_id=invoice.invoice_id, payment_time=now, **item) for item in items])
+    record_invoice(db, invoice)
+    return invoice, bill
+
+
+# --- B. TỔNG TIỀN LƯU SẴN (VisitCharges) ---
+
+# 1. Mở dòng tổng (0, 0) cho lượt khám mới - gọi cùng transaction tạo Visit (tạo lượt khám / check-in)
+def open_visit_charge(db: Session, visit_id: int):
+    db.add(models.VisitCharge(visit_id=visit_id, medicine_total=0, service_total=0))
+
+# 2. Cộng dồn tiền vào VisitCharges (gọi trong cùng transaction với thao tác ghi)
+# Chỉ UPDATE ... SET x = x + delta (dòng đã có từ lúc tạo lượt khám) -> 2 request song song không ghi đè,
+# không INSERT trùng khóa. Lượt khám cũ chưa có dòng tổng: bỏ qua, charge_totals tính trực tiếp
+# cho tới khi chạy rebuild-visit-charges.
+def apply_visit_charge(db: Session, visit_id: int, medicine_delta=0, service_delta=0):
+    db.query(models.VisitCharge).filter(
+        models.VisitCharge.visit_id == visit_id
+    ).update({
+        models.VisitCharge.medicine_total: models.VisitCharge.medicine_total + medicine_delta,
+        models.VisitCharge.service_total: models.VisitCharge.service_total + service_delta
+    }, synchronize_session=False)
+
+# 3. Đọc tổng tiền của nhiều lượt khám (1 query, 1 dòng / lượt khám)
+# Lượt khám chưa có dòng tổng (dữ liệu cũ chưa rebuild) thì tính trực tiếp
+def charge_totals(db: Session, visit_ids: list[int]) -> dict[int, dict]:
+    totals = {}
+    if visit_ids:
+        rows = db.query(models.VisitCharge).filter(models.VisitCharge.visit_id.in_(visit_ids)).all()
+        for c in rows:
+            totals[c.visit_id] = {"medicine_total": float(c.medicine_total), "service_total": float(c.service_total)}
+
+    missing = [vid for vid in visit_ids if vid not in totals]
+    if missing:
+        totals.update(visit_totals(db, missing))
+    return totals
+
+# 4. Tính lại toàn bộ VisitCharges từ dữ liệu gốc (chạy theo từng lô visit_id)
+# check_only=True: chỉ trả về danh sách lượt khám bị lệch, không ghi DB
+def rebuild_visit_charges(db: Session, check_only: bool = False, chunk_size: int = 1000) -> list[dict]:
+    drift = []
+    last_id = 0
+    while True:
+        visit_ids = [r.visit_id for r in db.query(models.Visit.visit_id).filter(
+            models.Visit.visit_id > last_id
+        ).order_by(models.Visit.visit_id).limit(chunk_size).all()]
+        if not visit_ids:
+            break
+        last_id = visit_ids[-1]
+
+        live = visit_totals(db, visit_ids)
+        stored = {c.visit_id: c for c in db.query(models.VisitCharge).filter(
+            models.VisitCharge.visit_id.in_(visit_ids)
+        ).all()}
+
+        for vid in visit_ids:
+            expected = live[vid]
+            row = stored.get(vid)
+            current = (round(float(row.medicine_total), 2), round(float(row.service_total), 2)) if row else None
+            if current == (round(expected["medicine_total"], 2), round(expected["service_total"], 2)):
+                continue
+
+            drift.append({
+                "visit_id": vid,
+                "stored": current,
+                "expected": (expected["medicine_total"], expected["service_total"])
+            })
+            if check_only:
+                continue
+            if row:
+                row.medicine_total = expected["medicine_total"]
+                row.service_total = expected["service_total"]
+            else:
+                db.add(models.VisitCharge(visit_id=vid, **expected))
+
+        if not check_only:
+            db.commit()
+    return drift
+
+# 5. Backfill giá chốt cho các dòng cũ (unit_price còn NULL) theo giá danh mục hiện tại
+# Chạy theo từng lô khóa chính để không khóa bảng lớn quá lâu
+def backfill_line_prices(db: Session, chunk_size: int = 10000) -> dict[str, int]:
+    targets = [
+        (models.Prescription, models.Prescription.prescription_id, models.Prescription.medicine_id,
+         models.Medicine.price, models.Medicine.medicine_id),
+        (models.ServiceRequest, models.ServiceRequest.request_id, models.ServiceRequest.service_id,
+         models.Service.price, models.Service.service_id),
+    ]
+    counts = {}
+    for model, pk, fk, catalog_price, catalog_pk in targets:
+        counts[model.__tablename__] = 0
+        max_id = db.query(func.max(pk)).scalar() or 0
+        for start in range(0, max_id, chunk_size):
+            price = select(catalog_price).where(catalog_pk == fk).scalar_subquery()
+            result = db.execute(
+                update(model)
+                .where(pk > start, pk <= start + chunk_size, model.unit_price.is_(None))
+                .values(unit_price=price)
+                .execution_options(synchronize_session=False)
+            )
+            counts[model.__tablename__] += result.rowcount
+            db.commit()
+    return counts
+
+
+# --- C. NỘI TRÚ (INPATIENT) ---
+
+# Điều kiện ghép Visit vào đợt nằm viện: cùng bệnh nhân, visit_date nằm trong
+# [admission_date, discharge_date] (chưa xuất viện thì tính đến thời điểm `now`)
+def _stay_visit_join(now: datetime):
+    return (models.Visit.patient_id == models.InpatientRecord.patient_id) & \
+           (models.Visit.visit_date >= models.InpatientRecord.admission_date) & \
+           (models.Visit.visit_date <= func.coalesce(models.InpatientRecord.discharge_date, now))
+
+# 1. Chi tiết tiền giường theo từng hồ sơ (1 query JOIN Beds)
+def stay_bed_lines(db: Session, inpatient_ids: list[int], now: datetime = None) -> dict[int, list[dict]]:
+    now = now or datetime.now()
+    lines = {iid: [] for iid in inpatient_ids}
+    if not inpatient_ids:
+        return lines
+
+    rows = db.query(
+        models.BedAllocation.inpatient_id,
+        models.BedAllocation.check_in_time,
+        models.BedAllocation.check_out_time,
+        models.BedAllocation.price_per_day,
+        models.Bed.bed_number
+    ).join(models.Bed, models.Bed.bed_id == models.BedAllocation.bed_id)\
+     .filter(models.BedAllocation.inpatient_id.in_(inpatient_ids))\
+     .order_by(models.BedAllocation.check_in_time).all()
+
+    for r in rows:
+        days = bed_days(r.check_in_time, r.check_out_time or now)
+        lines[r.inpatient_id].append({
+            "bed": r.bed_number,
+            "days": days,
+            "price": float(r.price_per_day),
+            "total": days * float(r.price_per_day)
+        })
+    return lines
+
+# 2. Chi tiết tiền thuốc trong đợt nằm viện (1 query)
+def stay_medicine_lines(db: Session, inpatient_ids: list[int], now: datetime = None) -> dict[int, list[dict]]:
+    now = now or datetime.now()
+    lines = {iid: [] for iid in inpatient_ids}
+    if not inpatient_ids:
+        return lines
+
+    rows = db.query(
+        models.InpatientRecord.inpatient_id,
+        models.Medicine.name,
+        models.Prescription.quantity,
+        medicine_line_price().label("price")
+    ).join(models.Visit, _stay_visit_join(now))\
+     .join(models.Prescription, models.Prescription.visit_id == models.Visit.visit_id)\
+     .join(models.Medicine, models.Medicine.medicine_id == models.Prescription.medicine_id)\
+     .filter(models.InpatientRecord.inpatient_id.in_(inpatient_ids))\
+     .order_by(models.Prescription.prescription_id).all()
+
+    for r in rows:
+        lines[r.inpatient_id].append({"name": r.name, "qty": r.quantity, "total": r.quantity * float(r.price)})
+    return lines
+
+# 3. Chi tiết tiền dịch vụ trong đợt nằm viện (1 query, bỏ CANCELLED)
+def stay_service_lines(db: Session, inpatient_ids: list[int], now: datetime = None) -> dict[int, list[dict]]:
+    now = now or datetime.now()
+    lines = {iid: [] for iid in inpatient_ids}
+    if not inpatient_ids:
+        return lines
+
+    rows = db.query(
+        models.InpatientRecord.inpatient_id,
+        models.Service.name,
+        models.ServiceRequest.quantity,
+        service_line_price().label("price")
+    ).join(models.Visit, _stay_visit_join(now))\
+     .join(models.ServiceRequest, models.ServiceRequest.visit_id == models.Visit.visit_id)\
+     .join(models.Service, models.Service.service_id == models.ServiceRequest.service_id)\
+     .filter(
+        models.InpatientRecord.inpatient_id.in_(inpatient_ids),
+        models.ServiceRequest.status != 'CANCELLED'
+    ).order_by(models.ServiceRequest.request_id).all()
+
+    for r in rows:
+        lines[r.inpatient_id].append({"name": r.name, "qty": r.quantity, "total": r.quantity * float(r.price)})
+    return lines
+
+# 4. Tổng tiền giường / thuốc / dịch vụ theo từng hồ sơ (dùng cho báo cáo, đọc VisitCharges)
+def stay_totals(db: Session, inpatient_ids: list[int], now: datetime = None) -> dict[int, dict]:
+    now = now or datetime.now()
+    totals = {iid: {"bed_fee": 0.0, "medicine_fee": 0.0, "service_fee": 0.0} for iid in inpatient_ids}
+    if not inpatient_ids:
+        return totals
+
+    # Tiền giường: chỉ lấy 3 cột của BedAllocations (không JOIN Beds), cộng dồn theo hồ sơ
+    beds = db.query(
+        models.BedAllocation.inpatient_id,
+        models.BedAllocation.check_in_time,
+        models.BedAllocation.check_out_time,
+        models.BedAllocation.price_per_day
+    ).filter(models.BedAllocation.inpatient_id.in_(inpatient_ids)).all()
+    for r in beds:
+        totals[r.inpatient_id]["bed_fee"] += bed_days(r.check_in_time, r.check_out_time or now) * float(r.price_per_day)
+
+    # Các lượt khám thuộc từng đợt nằm viện -> cộng tổng tiền đã lưu sẵn
+    stay_visits = db.query(
+        models.InpatientRecord.inpatient_id,
+        models.Visit.visit_id
+    ).join(models.Visit, _stay_visit_join(now))\
+     .filter(models.InpatientRecord.inpatient_id.in_(inpatient_ids)).all()
+
+    charges = charge_totals(db, list({r.visit_id for r in stay_visits}))
+    for r in stay_visits:
+        totals[r.inpatient_id]["medicine_fee"] += charges[r.visit_id]["medicine_total"]
+        totals[r.inpatient_id]["service_fee"] += charges[r.visit_id]["service_total"]
+    return totals
+
+# 5. Báo cáo chi phí nội trú: duyệt hồ sơ đã xuất viện theo từng khối (keyset theo inpatient_id),
+# mỗi khối chỉ tốn vài query cố định -> dùng được cho khoảng thời gian dài (cả năm)
+def inpatient_cost_rows(db: Session, from_date: date, to_date: date, chunk_size: int = 500):
+    now = datetime.now()
+    start = datetime.combine(from_date, time.min)
+    end = datetime.combine(to_date + timedelta(days=1), time.min)
+    last_id = 0
+    while True:
+        chunk = db.query(
+            models.InpatientRecord.inpatient_id,
+            models.InpatientRecord.admission_date,
+            models.InpatientRecord.discharge_date,
+            models.Patient.full_name
+        ).join(models.Patient, models.Patient.patient_id == models.InpatientRecord.patient_id)\
+         .filter(
+            models.InpatientRecord.status == 'DISCHARGED',
+            models.InpatientRecord.discharge_date >= start,
+            models.InpatientRecord.discharge_date < end,
+            models.InpatientRecord.inpatient_id > last_id
+        ).order_by(models.InpatientRecord.inpatient_id).limit(chunk_size).all()
+        if not chunk:
+            return
+
+        totals = stay_totals(db, [r.inpatient_id for r in chunk], now)
+        for r in chunk:
+            t = totals[r.inpatient_id]
+            yield {
+                "inpatient_id": r.inpatient_id,
+                "patient_name": r.full_name,
+                "admission_date": r.admission_date.date(),
+                "discharge_date": r.discharge_date.date(),
+                "bed_fee": t["bed_fee"],
+                "service_fee": t["service_fee"],
+                "medicine_fee": t["medicine_fee"],
+                "total_cost": t["bed_fee"] + t["service_fee"] + t["medicine_fee"]
+            }
+        last_id = chunk[-1].inpatient_id
+
+
+# --- D. BẢNG TỔNG HỢP THEO NGÀY (DailyRevenue / DailyMedicineUsage / DailyServiceUsage) ---
+
+def _day_bounds(start_day: date, end_day: date) -> tuple[datetime, datetime]:
+    return datetime.combine(start_day, time.min), datetime.combine(end_day + timedelta(days=1), time.min)
+
+# Query gốc cho từng bảng rollup: các cột trả về theo đúng thứ tự (day, khóa, giá trị...)
+def _revenue_facts(db: Session, start: datetime, end: datetime):
+    day = func.date(models.Invoice.payment_time, type_=Date)
+    return db.query(
+        day.label("day"),
+        models.Invoice.payment_method.label("payment_method"),
+        func.count(models.Invoice.invoice_id).label("invoice_count"),
+        func.coalesce(func.sum(models.Invoice.final_amount), 0).label("revenue")
+    ).filter(
+        models.Invoice.payment_time >= start,
+        models.Invoice.payment_time < end
+    ).group_by(day, models.Invoice.payment_method)
+
+def _medicine_usage_facts(db: Session, start: datetime, end: datetime):
+    day = func.date(models.Visit.visit_date, type_=Date)
+    return db.query(
+        day.label("day"),
+        models.Prescription.medicine_id.label("medicine_id"),
+        func.sum(models.Prescription.quantity).label("quantity"),
+        func.coalesce(func.sum(models.Prescription.quantity * medicine_line_price()), 0).label("amount")
+    ).join(models.Visit, models.Visit.visit_id == models.Prescription.visit_id
+    ).outerjoin(models.Medicine, models.Medicine.medicine_id == models.Prescription.medicine_id).filter(
+        models.Visit.visit_date >= start,
+        models.Visit.visit_date < end
+    ).group_by(day, models.Prescription.medicine_id)
+
+def _service_usage_facts(db: Session, start: datetime, end: datetime):
+    day = func.date(models.ServiceRequest.created_at, type_=Date)
+    return db.query(
+        day.label("day"),
+        models.ServiceRequest.service_id.label("service_id"),
+        func.sum(models.ServiceRequest.quantity).label("usage_count"),
+        func.coalesce(func.sum(models.ServiceRequest.quantity * service_line_price()), 0).label("revenue")
+    ).outerjoin(models.Service, models.Service.service_id == models.ServiceRequest.service_id).filter(
+        models.ServiceRequest.created_at >= start,
+        models.ServiceRequest.created_at < end,
+        models.ServiceRequest.status != 'CANCELLED'
+    ).group_by(day, models.ServiceRequest.service_id)
+
+# Bảng rollup -> (query gốc, tên cột khóa, các cột giá trị)
+_ROLLUPS = {
+    models.DailyRevenue: (_revenue_facts, "payment_method", ("invoice_count", "revenue")),
+    models.DailyMedicineUsage: (_medicine_usage_facts, "medicine_id", ("quantity", "amount")),
+    models.DailyServiceUsage: (_service_usage_facts, "service_id", ("usage_count", "revenue")),
+}
+
+# 1. Cộng dồn vào 1 dòng rollup (cùng transaction với thao tác ghi, 1 câu INSERT ... cộng dồn nếu trùng khóa)
+# Chưa có dòng của ngày đó thì tạo mới với đúng giá trị delta: dữ liệu các ngày cũ (trước khi có rollup)
+# do lệnh rebuild-daily-rollups nạp, không tính lại từ bảng gốc trong lúc ghi.
+def apply_daily_rollup(db: Session, model, day: date, key, **deltas):
+    _, key_name, _ = _ROLLUPS[model]
+    db.execute(database.increment_statement(db.get_bind().dialect.name, model.__table__,
+                                            {"day": day, key_name: key}, deltas))
+
+# 2. Các hàm ghi nhận dùng ở main.py
+def record_invoice(db: Session, invoice: models.Invoice):
+    apply_daily_rollup(db, models.DailyRevenue, invoice.payment_time.date(), invoice.payment_method,
+                       invoice_count=1, revenue=invoice.final_amount)
+
+def record_medicine_usage(db: Session, visit_id: int, medicine_id: int, quantity: int, amount):
+    visit_date = db.query(models.Visit.visit_date).filter(models.Visit.visit_id == visit_id).scalar()
+    if visit_date is None:
+        return
+    apply_daily_rollup(db, models.DailyMedicineUsage, visit_date.date(), medicine_id,
+                       quantity=quantity, amount=amount)
+
+# Mỗi dòng thay đổi: (service_id, số lượng, thành tiền) - âm khi hủy / sửa bớt.
+# Gộp theo service_id trước khi ghi để đổi số lượng cùng dịch vụ chỉ là 1 lần cộng dồn.
+def record_service_usage(db: Session, day: date, *changes: tuple):
+    merged = {}
+    for service_id, quantity, amount in changes:
+        usage, revenue = merged.get(service_id, (0, 0))
+        merged[service_id] = (usage + quantity, revenue + amount)
+    for service_id, (usage, revenue) in merged.items():
+        apply_daily_rollup(db, models.DailyServiceUsage, day, service_id, usage_count=usage, revenue=revenue)
+
+# 3. Tính lại bảng rollup từ dữ liệu gốc theo từng khoảng `chunk_days` ngày
+# (DELETE khoảng ngày + INSERT ... SELECT GROUP BY, commit từng khoảng)
+def rebuild_daily_rollups(db: Session, from_date: date = None, to_date: date = None,
+                          chunk_days: int = 31) -> dict[str, int]:
+    if from_date is None:
+        firsts = [
+            db.query(func.min(models.Invoice.payment_time)).scalar(),
+            db.query(func.min(models.Visit.visit_date)).scalar(),
+            db.query(func.min(models.ServiceRequest.created_at)).scalar(),
+        ]
+        firsts = [d.date() for d in firsts if d is not None]
+        if not firsts:
+            return {}
+        from_date = min(firsts)
+    to_date = to_date or date.today()
+
+    counts = {model.__tablename__: 0 for model in _ROLLUPS}
+    chunk_start = from_date
+    while chunk_start <= to_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), to_date)
+        start, end = _day_bounds(chunk_start, chunk_end)
+        for model, (facts, key_name, values) in _ROLLUPS.items():
+            db.query(model).filter(
+                model.day >= chunk_start,
+                model.day <= chunk_end
+            ).delete(synchronize_session=False)
+            result = db.execute(
+                insert(model).from_select(["day", key_name, *values], facts(db, start, end).statement)
+            )
+            counts[model.__tablename__] += result.rowcount
+        db.commit()
+        chunk_start = chunk_end + timedelta(days=1)
+    return counts
+
+# 4. Đọc rollup trong khoảng ngày, gom theo ngày / tuần (bắt đầu thứ 2) / tháng
+def period_start(day: date, granularity: str) -> date:
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
@@ -0,0 +1,145 @@
+# cache.py
+# Cache kết quả trong bộ nhớ (theo từng process) cho các API đọc nhiều, ghi ít (báo cáo).
+# - Mỗi mục có TTL, và bị xóa sớm khi 1 tag liên quan bị invalidate (gọi sau khi ghi dữ liệu)
+# - cached(): gắn tag cho kết quả báo cáo; các API ghi (hóa đơn, kê đơn, nội trú, nhập kho...) gọi
+#   report_cache.invalidate(tag) sau commit. Bảng danh mục (ít ghi) có thể đưa thêm version
+#   (TableVersions, etags.py) vào khóa để process khác sửa danh mục cũng làm kết quả cũ hết được dùng.
+# - Giới hạn tổng dung lượng theo byte, vượt thì bỏ mục lâu không dùng nhất (LRU)
+# - Đếm hit / miss để theo dõi (GET /admin/cache-stats)
+# Giá trị được lưu ở dạng pickle: biết chính xác kích thước, và người gọi không sửa được bản trong cache.
+import functools
+import inspect
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import etags
+
+REPORT_CACHE_TTL = 300                     # 5 phút
+REPORT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 32 MB
+
+# Tham số không đưa vào khóa cache (session, user đăng nhập, token)
+_SKIP_ARGS = {"db", "current_user", "token"}
+
+
+class TTLCache:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (hết hạn lúc, tags, payload)
+        self._tag_keys = {}           # tag -> các key đang gắn tag đó
+        self._tag_versions = {}       # tag -> số lần đã invalidate
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Phiên bản hiện tại của các tag: chụp trước khi tính, so lại khi lưu
+    def versions(self, tags) -> tuple:
+        with self._lock:
+            return tuple(self._tag_versions.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            payload = entry[2]
+        return True, pickle.loads(payload)
+
+    # versions: kết quả của versions() lúc bắt đầu tính. Nếu tag bị invalidate
+    # trong lúc tính (có thao tác ghi song song) thì bỏ qua, không lưu kết quả cũ.
+    def set(self, key, value, tags=(), ttl: float = None, versions: tuple = None):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if versions is not None and versions != tuple(self._tag_versions.get(tag, 0) for tag in tags):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + (ttl or self.ttl), tuple(tags), payload)
+            self._bytes += len(payload)
+            for tag in tags:
+                self._tag_keys.setdefault(tag, set()).add(key)
+
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._tag_versions[tag] = self._tag_versions.get(tag, 0) + 1
+                for key in list(self._tag_keys.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tag_keys.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
+
+    def _remove(self, key):
+        _, tags, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+        for tag in tags:
+            keys = self._tag_keys.get(tag)
+            if keys:
+                keys.discard(key)
+
+
+report_cache = TTLCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_TTL)
+
+
+# --- DECORATOR: Cache kết quả của 1 endpoint theo (tên hàm, tham số), gắn tag để invalidate ---
+# tags: invalidate(tag) ở API ghi -> xóa kết quả. Invalidate trong lúc đang tính thì không lưu kết quả cũ.
+# tables: model / cột đổi liên tục của bảng DANH MỤC mà endpoint đọc (xem etags.counter_name): version
+# của chúng nằm trong khóa (1 query theo khóa chính, hàm phải có tham số `db`).
+# Dùng được cả khi FastAPI gọi (kwargs) lẫn khi gọi trực tiếp (VD: /reports/export).
+# Đặt DƯỚI @app.get(...) để FastAPI vẫn đọc được chữ ký gốc (qua __wrapped__).
+def cached(cache: TTLCache, *tags, tables=(), ttl: float = None):
+    counters = tuple(etags.counter_name(entity) for entity in tables)
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            versions = etags.current(bound.arguments["db"], counters) if counters else ()
+            key = (func.__name__, versions) + tuple(
+                (name, repr(value)) for name, value in bound.arguments.items() if name not in _SKIP_ARGS
+            )
+
+            found, value = cache.get(key)
+            if found:
+                return value
+
+            tag_versions = cache.versions(tags)
+            value = func(*args, **kwargs)
+            cache.set(key, value, tags=tags, ttl=ttl, versions=tag_versions)
+            return value
+        return wrapper
+    return decorator
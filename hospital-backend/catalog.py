@@ -0,0 +1,184 @@
+# catalog.py
+# Cache danh mục trong bộ nhớ (theo từng process): thuốc, dịch vụ, phòng, lịch làm việc bác sĩ.
+# Đọc rất nhiều (kê đơn, chỉ định, xem hóa đơn, nhập viện, đặt lịch), rất ít khi đổi.
+# - Mỗi mục là bản chụp (dict) các cột ít thay đổi, KHÔNG gồm tồn kho / trạng thái giường (luôn đọc DB).
+# - Chỉ dùng để HIỂN THỊ (tên, giá trên hóa đơn xem trước...). Giá chốt vào dữ liệu (kê đơn, chỉ định,
+#   nhập viện) luôn đọc DB lúc ghi (billing.medicine_price / service_price / room_price).
+# - API ghi gọi invalidate(tag) sau commit; CATALOG_CACHE_TTL là giới hạn dự phòng cho thay đổi
+#   từ process khác / sửa thẳng DB. Dung lượng giới hạn + đếm hit / miss dùng chung cache.TTLCache.
+# - warm_up() nạp sẵn toàn bộ lúc khởi động; refresh() (chạy nền định kỳ) so bộ đếm TableVersions
+#   (etags.py) và chỉ nạp lại danh mục có bảng bị đổi - kể cả thay đổi từ worker khác.
+import time as _clock
+from datetime import time
+from typing import Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+import etags
+import models
+from cache import TTLCache
+
+CATALOG_CACHE_TTL = 600                    # 10 phút
+CATALOG_CACHE_MAX_BYTES = 8 * 1024 * 1024  # 8 MB
+
+# Bảng (bộ đếm trong TableVersions) -> tag danh mục cần nạp lại khi bảng đổi
+_TABLE_TAGS = {
+    "Medicines": "medicines",
+    "Services": "services",
+    "Rooms": "rooms",
+    "Departments": "rooms",
+    "DoctorSchedules": "schedules",
+}
+_seen_versions = {}  # Bộ đếm đã thấy ở lần nạp gần nhất
+_loaded_at = 0.0     # Lần nạp toàn bộ gần nhất (monotonic)
+
+catalog_cache = TTLCache(CATALOG_CACHE_MAX_BYTES, CATALOG_CACHE_TTL)
+
+# Cột lưu trong cache của từng loại danh mục: (tag, model, cột khóa, các cột)
+_CATALOGS = {
+    "medicine": ("medicines", models.Medicine, models.Medicine.medicine_id, (
+        models.Medicine.medicine_id, models.Medicine.name, models.Medicine.unit, models.Medicine.price
+    )),
+    "service": ("services", models.Service, models.Service.service_id, (
+        models.Service.service_id, models.Service.name, models.Service.type, models.Service.price
+    )),
+    "room": ("rooms", models.Room, models.Room.room_id, (
+        models.Room.room_id, models.Room.department_id, models.Room.room_number, models.Room.type, models.Room.base_price
+    )),
+}
+
+
+# --- HELPER: Lấy nhiều mục theo khóa, mục chưa có trong cache -> 1 query IN (...) ---
+def _lookup(db: Session, kind: str, ids: Iterable[int]) -> dict:
+    tag, model, key_column, columns = _CATALOGS[kind]
+    result, missing = {}, []
+    for key in dict.fromkeys(ids):
+        found, value = catalog_cache.get((kind, key))
+        if found:
+            result[key] = value
+        else:
+            missing.append(key)
+
+    if missing:
+        versions = catalog_cache.versions((tag,))
+        for row in db.query(*columns).filter(key_column.in_(missing)):
+            value = dict(row._mapping)
+            key = value[key_column.key]
+            catalog_cache.set((kind, key), value, (tag,), versions=versions)
+            result[key] = value
+    return result
+
+
+# --- 1. Tra cứu (trả về dict, None nếu không tồn tại) ---
+def medicines(db: Session, ids: Iterable[int]) -> dict:
+    return _lookup(db, "medicine", ids)
+
+def medicine(db: Session, medicine_id: int) -> Optional[dict]:
+    return medicines(db, [medicine_id]).get(medicine_id)
+
+def services(db: Session, ids: Iterable[int]) -> dict:
+    return _lookup(db, "service", ids)
+
+def service(db: Session, service_id: int) -> Optional[dict]:
+    return services(db, [service_id]).get(service_id)
+
+def room(db: Session, room_id: int) -> Optional[dict]:
+    return _lookup(db, "room", [room_id]).get(room_id)
+
+
+# Ca làm việc đang áp dụng của bác sĩ theo thứ trong tuần: (shift_start, shift_end) hoặc None (nghỉ)
+# Kết quả "nghỉ" cũng được cache (tra cứu slot trống hỏi lại liên tục)
+def doctor_shift(db: Session, doctor_id: int, day_of_week: int) -> Optional[tuple[time, time]]:
+    key = ("schedule", doctor_id, day_of_week)
+    found, value = catalog_cache.get(key)
+    if found:
+        return value
+
+    versions = catalog_cache.versions(("schedules",))
+    row = db.query(models.DoctorSchedule.shift_start, models.DoctorSchedule.shift_end).filter(
+        models.DoctorSchedule.doctor_id == doctor_id,
+        models.DoctorSchedule.day_of_week == day_of_week,
+        models.DoctorSchedule.is_active == True
+    ).first()
+    value = (row.shift_start, row.shift_end) if row else None
+    catalog_cache.set(key, value, ("schedules",), versions=versions)
+    return value
+
+
+# Khoa -> phòng (phần tĩnh của sơ đồ giường). Giường & trạng thái giường vẫn đọc DB mỗi lần.
+def bed_layout(db: Session) -> list:
+    found, value = catalog_cache.get(("bed_layout",))
+    if found:
+        return value
+
+    versions = catalog_cache.versions(("rooms",))
+    value = _load_bed_layout(db)
+    catalog_cache.set(("bed_layout",), value, ("rooms",), versions=versions)
+    return value
+
+def _load_bed_layout(db: Session) -> list:
+    departments = {
+        row.department_id: {"department_id": row.department_id, "department_name": row.name, "rooms": []}
+        for row in db.query(models.Department.department_id, models.Department.name).order_by(models.Department.department_id)
+    }
+    for row in db.query(*_CATALOGS["room"][3]).order_by(models.Room.room_id):
+        if row.department_id in departments:
+            departments[row.department_id]["rooms"].append(dict(row._mapping))
+    return list(departments.values())
+
+
+# --- 2. Xóa cache sau khi ghi (gọi sau db.commit()) ---
+# Tag: "medicines", "services", "rooms", "schedules"
+def invalidate(*tags: str):
+    catalog_cache.invalidate(*tags)
+
+
+# --- 3. Nạp sẵn / làm mới nền ---
+# Nạp lại toàn bộ các danh mục mang tag trong tags (None = tất cả). Mỗi danh mục 1 query.
+def warm_up(db: Session, tags: Iterable[str] = None):
+    tags = set(_TABLE_TAGS.values()) if tags is None else set(tags)
+
+    for kind, (tag, model, key_column, columns) in _CATALOGS.items():
+        if tag not in tags:
+            continue
+        versions = catalog_cache.versions((tag,))
+        for row in db.query(*columns):
+            value = dict(row._mapping)
+            catalog_cache.set((kind, value[key_column.key]), value, (tag,), versions=versions)
+
+    if "rooms" in tags:
+        versions = catalog_cache.versions(("rooms",))
+        catalog_cache.set(("bed_layout",), _load_bed_layout(db), ("rooms",), versions=versions)
+
+    # Ca làm việc: mọi bác sĩ x 7 ngày, ngày không có ca lưu None (giống doctor_shift)
+    if "schedules" in tags:
+        versions = catalog_cache.versions(("schedules",))
+        shifts = {
+            (row.doctor_id, row.day_of_week): (row.shift_start, row.shift_end)
+            for row in db.query(models.DoctorSchedule.doctor_id, models.DoctorSchedule.day_of_week,
+                                models.DoctorSchedule.shift_start, models.DoctorSchedule.shift_end)
+                         .filter(models.DoctorSchedule.is_active == True)
+        }
+        doctor_ids = [row.user_id for row in db.query(models.User.user_id).filter(models.User.role == 'DOCTOR')]
+        for doctor_id in doctor_ids:
+            for day_of_week in range(7):
+                catalog_cache.set(("schedule", doctor_id, day_of_week), shifts.get((doctor_id, day_of_week)),
+                                  ("schedules",), versions=versions)
+
+# So bộ đếm TableVersions với lần trước: bảng nào đổi thì xóa & nạp lại danh mục tương ứng.
+# Lần đầu (chưa có bộ đếm) và mỗi khi sắp hết TTL thì nạp lại toàn bộ. Trả về các tag đã nạp lại.
+def refresh(db: Session) -> set:
+    global _loaded_at
+    tables = tuple(_TABLE_TAGS)
+    versions = dict(zip(tables, etags.current(db, tables)))
+    if not _seen_versions or _clock.monotonic() - _loaded_at >= CATALOG_CACHE_TTL / 2:
+        tags = set(_TABLE_TAGS.values())
+        _loaded_at = _clock.monotonic()
+    else:
+        tags = {_TABLE_TAGS[table] for table in tables if versions[table] != _seen_versions.get(table)}
+
+    if tags:
+        invalidate(*tags)
+        warm_up(db, tags)
+    _seen_versions.update(versions) # Chụp TRƯỚC khi nạp: thay đổi xen giữa sẽ được bắt ở lần sau
+    return tags
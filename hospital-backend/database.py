@@ -1,5 +1,6 @@
 # database.py
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -19,4 +20,19 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Câu INSERT ... cộng dồn nếu trùng khóa (1 câu lệnh, DB tự khóa dòng -> 2 transaction cùng ghi
+# dòng đầu tiên của 1 khóa không bị lỗi trùng khóa chính). Dùng cho bảng rollup, bộ đếm TableVersions.
+# MySQL: ON DUPLICATE KEY UPDATE x = x + VALUES(x), SQLite (test): ON CONFLICT DO UPDATE
+def increment_statement(dialect_name: str, table, keys: dict, deltas: dict):
+    if dialect_name == "mysql":
+        stmt = mysql.insert(table).values(**keys, **deltas)
+        return stmt.on_duplicate_key_update({col: table.c[col] + stmt.inserted[col] for col in deltas})
+    if dialect_name == "sqlite":
+        stmt = sqlite.insert(table).values(**keys, **deltas)
+        return stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={col: table.c[col] + stmt.excluded[col] for col in deltas}
+        )
+    raise NotImplementedError(f"Chưa hỗ trợ INSERT cộng dồn trên {dialect_name}")
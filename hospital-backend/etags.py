@@ -0,0 +1,125 @@
+# etags.py
+# ETag theo phiên bản dữ liệu cho các API danh mục (dịch vụ, thuốc, bác sĩ, NCC, sơ đồ giường).
+# - Mỗi bảng danh mục có 1 bộ đếm trong TableVersions, tự tăng trong cùng transaction khi có
+#   thêm / sửa / xóa (bắt qua sự kiện của Session, không phải sửa từng API ghi dữ liệu).
+# - Chỉ đếm bảng danh mục (ít ghi): bảng nghiệp vụ (lượt khám, hóa đơn...) ghi liên tục, đếm ở đây sẽ bắt
+#   mọi transaction khóa chung vài dòng bộ đếm. Cache báo cáo dùng tag (cache.cached) + version danh mục.
+# - Cột đổi liên tục (tồn kho thuốc: mỗi lần kê đơn / nhập kho) có bộ đếm riêng "<bảng>.<cột>": sửa CHỈ
+#   các cột đó không tăng bộ đếm của bảng -> ETag / cache danh mục (tên, giá...) giữ nguyên.
+# - API gắn Depends(etags.conditional(...)): chỉ đọc bộ đếm (1 query theo khóa chính). Client gửi lại
+#   If-None-Match trùng ETag -> trả 304 rỗng, không query danh mục, không serialize.
+import hashlib
+from itertools import chain
+
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+import database
+import models
+
+# Các bảng có bộ đếm: chỉ bảng danh mục (không đếm mọi bảng để transaction không liên quan không phải ghi thêm)
+TRACKED_TABLES = {"Services", "Medicines", "Users", "Suppliers", "Departments", "Rooms", "Beds", "DoctorSchedules"}
+
+# Bảng -> các cột đổi liên tục, mỗi cột 1 bộ đếm riêng (xem counter_name)
+VOLATILE_COLUMNS = {"Medicines": {"stock_quantity"}}
+
+_TOUCHED = "etags_touched_tables" # Khóa trong session.info
+
+
+# Tên bộ đếm: model -> tên bảng; cột đổi liên tục (VD: models.Medicine.stock_quantity) -> "Medicines.stock_quantity"
+def counter_name(entity) -> str:
+    if hasattr(entity, "__tablename__"):
+        return entity.__tablename__
+    return f"{entity.class_.__tablename__}.{entity.key}"
+
+
+# --- 1. Ghi nhận các bộ đếm cần tăng trong transaction ---
+# changed: các cột bị sửa (None = không rõ / thêm / xóa dòng -> tính như sửa mọi cột)
+def _touch(session, table: str, changed=None):
+    touched = session.info.setdefault(_TOUCHED, set())
+    volatile = VOLATILE_COLUMNS.get(table, set())
+    if changed is None or set(changed) - volatile:
+        touched.add(table)
+    touched.update(f"{table}.{column}" for column in (volatile if changed is None else volatile & set(changed)))
+
+# ORM (db.add / sửa thuộc tính / db.delete): xem lại các đối tượng sau mỗi lần flush
+# (after_flush vẫn còn lịch sử thay đổi của từng thuộc tính)
+@event.listens_for(Session, "after_flush")
+def _collect_flush(session, flush_context):
+    for obj in chain(session.new, session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table in TRACKED_TABLES:
+            _touch(session, table)
+    for obj in session.dirty:
+        table = getattr(obj, "__tablename__", None)
+        if table in TRACKED_TABLES and session.is_modified(obj):
+            _touch(session, table, [attr.key for attr in inspect(obj).attrs if attr.history.has_changes()])
+
+# Câu lệnh INSERT / UPDATE / DELETE trực tiếp (db.execute(update(...)), query.update())
+@event.listens_for(Session, "do_orm_execute")
+def _collect_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        statement = orm_execute_state.statement
+        table = getattr(statement.table, "name", None)
+        if table in TRACKED_TABLES:
+            values = statement._values if orm_execute_state.is_update else None
+            changed = [getattr(column, "name", column) for column in values] if values else None
+            _touch(orm_execute_state.session, table, changed)
+
+
+# --- 2. Tăng bộ đếm ngay trước commit (khóa dòng bộ đếm chỉ trong lúc commit) ---
+@event.listens_for(Session, "before_commit")
+def _bump_on_commit(session):
+    session.flush() # Ghi nốt thay đổi đang chờ để không sót bảng
+    tables = session.info.pop(_TOUCHED, None)
+    if tables:
+        bump(session, tables)
+
+@event.listens_for(Session, "after_rollback")
+def _reset_on_rollback(session):
+    session.info.pop(_TOUCHED, None)
+
+
+# +1 cho từng bộ đếm (chưa có dòng thì tạo với version 1, 1 câu lệnh -> không lỗi trùng khóa khi song song).
+# Thứ tự cố định để 2 transaction cùng tăng nhiều bộ đếm không khóa chéo nhau.
+def bump(db: Session, tables):
+    T = models.TableVersion.__table__
+    dialect_name = db.get_bind().dialect.name
+    for table in sorted(set(tables)):
+        db.execute(database.increment_statement(dialect_name, T, {"table_name": table}, {"version": 1}))
+
+
+def current(db: Session, tables) -> tuple:
+    T = models.TableVersion.__table__
+    versions = dict(db.execute(select(T.c.table_name, T.c.version).where(T.c.table_name.in_(tables))).all())
+    return tuple(versions.get(table, 0) for table in tables)
+
+
+# --- 3. Dependency cho API danh mục: ETag = hash(đường dẫn + query string + version các bảng) ---
+# Đặt SAU dependency kiểm tra quyền để request chưa đăng nhập không nhận được 304.
+# entities: model và cột đổi liên tục mà API trả về. Cột đổi liên tục chỉ tính khi response có cột đó
+# (tham số ?fields=... của projection không chọn cột -> ETag không đổi theo tồn kho).
+# Đọc bộ đếm bằng chính session của request (get_db): không mở thêm connection.
+def conditional(*entities):
+    def dependency(request: Request, response: Response, db: Session = Depends(database.get_db)):
+        fields = request.query_params.get("fields")
+        selected = None if fields is None else {name.strip() for name in fields.split(",")}
+        tables = tuple(
+            counter_name(entity) for entity in entities
+            if hasattr(entity, "__tablename__") or selected is None or entity.key in selected
+        )
+        versions = current(db, tables)
+
+        raw = f"{request.url.path}?{request.url.query}|{versions}"
+        etag = f'W/"{hashlib.sha1(raw.encode()).hexdigest()[:20]}"'
+        # private: dữ liệu sau đăng nhập; no-cache: trình duyệt luôn hỏi lại (kèm If-None-Match)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+        if_none_match = request.headers.get("if-none-match", "")
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+    return dependency
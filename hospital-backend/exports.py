@@ -0,0 +1,180 @@
+# exports.py
+# Ghi báo cáo ra file theo từng khối dòng (xlsx / csv / parquet) cho /reports/export.
+# Nguồn dữ liệu là iterator các dict (lấy dần từ DB), cột & kiểu lấy từ schema Pydantic
+# của báo cáo -> báo cáo rỗng vẫn có dòng tiêu đề, bộ nhớ không tăng theo số dòng.
+import csv
+import io
+import os
+import pickle
+import tempfile
+from datetime import date, datetime
+from typing import Iterable, Iterator
+
+CHUNK_ROWS = 1000        # Số dòng mỗi lần đẩy ra (csv / parquet row group)
+FILE_CHUNK = 64 * 1024   # Kích thước mỗi lần đọc file tạm (xlsx)
+
+MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def columns_of(model) -> list[str]:
+    return list(model.model_fields)
+
+
+# Parquet cần pyarrow (không bắt buộc cài), các định dạng khác luôn có
+def is_available(file_format: str) -> bool:
+    if file_format != "parquet":
+        return True
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _chunks(rows: Iterable[dict], size: int = CHUNK_ROWS) -> Iterator[list[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- 1. CSV: mỗi khối dòng -> 1 lần yield (có BOM để Excel đọc đúng tiếng Việt) ---
+def stream_csv(model, rows: Iterable[dict]) -> Iterator[bytes]:
+    columns = columns_of(model)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    for chunk in _chunks(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode("utf-8")
+
+
+# --- 2. XLSX: openpyxl write-only (ghi dòng thẳng ra đĩa), rồi đọc file tạm theo từng khối ---
+# File xlsx là zip (mục lục ở cuối) nên phải ghi xong mới gửi, nhưng RAM không phụ thuộc số dòng.
+# sheets: danh sách (tên sheet, schema, các dòng) -> mỗi phần tử là 1 sheet
+def stream_workbook(sheets: list[tuple]) -> Iterator[bytes]:
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_name, model, rows in sheets:
+        columns = columns_of(model)
+        sheet = workbook.create_sheet(sheet_name)
+        sheet.append(columns)
+        for row in rows:
+            sheet.append([row.get(col) for col in columns])
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        workbook.save(path)
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(FILE_CHUNK)
+                if not data:
+                    break
+                yield data
+    finally:
+        os.remove(path)
+
+def stream_xlsx(model, rows: Iterable[dict], sheet_name: str = "Report") -> Iterator[bytes]:
+    return stream_workbook([(sheet_name, model, rows)])
+
+
+# --- 3. PARQUET: mỗi khối dòng -> 1 row group, đẩy byte ra ngay sau khi ghi ---
+_ARROW_TYPES = {int: "int64", float: "float64", str: "string", date: "date32", datetime: "timestamp"}
+
+def _arrow_schema(model):
+    import pyarrow as pa
+
+    fields = []
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        # Optional[X] -> X
+        args = [a for a in getattr(annotation, "__args__", ()) if a is not type(None)]
+        if args:
+            annotation = args[0]
+        kind = _ARROW_TYPES.get(annotation, "string")
+        arrow_type = pa.timestamp("us") if kind == "timestamp" else getattr(pa, kind)()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+# File-like chỉ ghi: giữ vị trí (tell) cho writer, phần byte đã ghi được lấy ra theo từng đợt
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def stream_parquet(model, rows: Iterable[dict]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(model)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for chunk in _chunks(rows):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+# --- 4. SPOOL: ghi dòng ra file tạm theo từng khối (pickle, giữ nguyên kiểu date / Decimal) ---
+# Dùng khi tính nhiều báo cáo song song (workbook): mỗi báo cáo đổ ra file riêng, RAM chỉ giữ 1 khối dòng.
+def spool_rows(rows: Iterable[dict]) -> str:
+    fd, path = tempfile.mkstemp(suffix=".spool")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in _chunks(rows):
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+# Đọc lại file spool theo từng khối rồi xóa file
+def read_spool(path: str) -> Iterator[dict]:
+    try:
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    break
+                yield from chunk
+    finally:
+        os.remove(path)
+
+
+WRITERS = {"xlsx": stream_xlsx, "csv": stream_csv, "parquet": stream_parquet}
@@ -0,0 +1,141 @@
+# jobs.py
+# Chạy báo cáo / xuất file dài ở nền trong process pool (không chiếm thread của API).
+# - Mỗi job có 1 file trạng thái <job_id>.json và 1 file kết quả <job_id>.out trong JOB_DIR.
+#   Trạng thái nằm trên đĩa nên process API nào (nhiều worker uvicorn) cũng trả lời được.
+# - Process con tự ghi trạng thái RUNNING / tiến độ (số dòng) / DONE / FAILED, mỗi job dùng session DB riêng.
+# - File kết quả hết hạn sau JOB_FILE_TTL giây kể từ khi xong, được dọn mỗi lần submit job mới.
+# - Pool tạo / tắt trong lifespan (start / shutdown), process con khởi động kiểu "spawn": không fork
+#   process API đang có thread, connection DB, event loop.
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+JOB_DIR = os.path.join(tempfile.gettempdir(), "hospital_report_jobs")
+JOB_WORKERS = max(1, min(4, os.cpu_count() or 1))
+JOB_FILE_TTL = 60 * 60 # 1 giờ
+PROGRESS_EVERY = 1000  # Ghi tiến độ mỗi 1000 dòng
+
+_executor = None
+
+
+# --- HELPER: Đọc / ghi file trạng thái (ghi file tạm rồi rename để không đọc phải file dở) ---
+def _meta_path(job_id: str) -> str:
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+def result_path(job_id: str) -> str:
+    return os.path.join(JOB_DIR, f"{job_id}.out")
+
+def _write_meta(job_id: str, /, **changes) -> dict:
+    meta = read(job_id) or {}
+    meta.update(changes)
+    tmp = f"{_meta_path(job_id)}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, default=str)
+    os.replace(tmp, _meta_path(job_id))
+    return meta
+
+def read(job_id: str) -> Optional[dict]:
+    # job_id do client gửi lên: chỉ chấp nhận hex (tránh đọc file ngoài JOB_DIR)
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(_meta_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# --- PROCESS POOL (gọi start / shutdown trong lifespan của main.py) ---
+# spawn: process con là interpreter mới, tự import module của task và tự mở connection DB
+def start():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+# Không chờ job đang chạy: job dở bị đánh dấu FAILED qua callback của future
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+# Đếm số dòng đã xử lý, ghi vào file trạng thái theo từng mốc PROGRESS_EVERY
+class Progress:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.rows = 0
+
+    def track(self, rows):
+        for row in rows:
+            self.rows += 1
+            if self.rows % PROGRESS_EVERY == 0:
+                _write_meta(self.job_id, progress=self.rows)
+            yield row
+
+
+# Chạy trong process con: task(*args, out_path=..., progress=...) ghi kết quả ra file
+def _run(job_id: str, task, args: tuple):
+    _write_meta(job_id, status="RUNNING", started_at=datetime.now().isoformat())
+    progress = Progress(job_id)
+    try:
+        task(*args, out_path=result_path(job_id), progress=progress)
+    except Exception as e:
+        _write_meta(job_id, status="FAILED", error=str(e), finished_at=datetime.now().isoformat())
+        raise
+    _write_meta(job_id, status="DONE", progress=progress.rows, finished_at=datetime.now().isoformat(),
+                expires_at=(datetime.now() + timedelta(seconds=JOB_FILE_TTL)).isoformat())
+
+
+# --- API dùng ở main.py ---
+
+# 1. Tạo job. task phải là hàm cấp module (pickle được) nhận thêm out_path, progress
+def submit(task, args: tuple, filename: str, media_type: str, owner: str) -> dict:
+    if _executor is None:
+        raise RuntimeError("Chưa khởi động process pool của job (jobs.start() trong lifespan)")
+    os.makedirs(JOB_DIR, exist_ok=True)
+    cleanup_expired()
+
+    job_id = uuid.uuid4().hex
+    meta = _write_meta(
+        job_id,
+        job_id=job_id,
+        status="QUEUED",
+        progress=0,
+        filename=filename,
+        media_type=media_type,
+        owner=owner,
+        created_at=datetime.now().isoformat()
+    )
+    future = _executor.submit(_run, job_id, task, args)
+
+    # Process con chết giữa chừng (không kịp tự ghi FAILED) / job bị hủy khi tắt máy chủ
+    def _on_done(f):
+        error = "Máy chủ dừng trước khi job chạy" if f.cancelled() else f.exception()
+        if error is not None and (read(job_id) or {}).get("status") != "FAILED":
+            _write_meta(job_id, status="FAILED", error=str(error), finished_at=datetime.now().isoformat())
+    future.add_done_callback(_on_done)
+    return meta
+
+# 2. Dọn job đã hết hạn (file kết quả + file trạng thái)
+def cleanup_expired():
+    if not os.path.isdir(JOB_DIR):
+        return
+    cutoff = time.time() - JOB_FILE_TTL
+    for name in os.listdir(JOB_DIR):
+        if not name.endswith(".json"):
+            continue
+        job_id = name[:-len(".json")]
+        meta = read(job_id)
+        if meta is None or meta.get("status") not in ("DONE", "FAILED"):
+            continue
+        if os.path.getmtime(_meta_path(job_id)) < cutoff:
+            for path in (result_path(job_id), _meta_path(job_id)):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,255 @@
+# mailer.py
+# Hàng đợi email (outbox): API không gửi SMTP trong request nữa.
+# - enqueue(db, ...) chỉ thêm 1 dòng EmailOutbox, người gọi commit CÙNG transaction với dữ liệu (VD: OTP)
+#   -> commit thành công thì chắc chắn có email, rollback thì không có email nào bị gửi nhầm.
+# - worker() chạy nền (lifespan ở main.py): lấy từng lô email đến hạn, gửi trên 1 kết nối SMTP dùng lại
+#   giữa các lô; lỗi thì thử lại với backoff lũy thừa, quá MAIL_MAX_ATTEMPTS lần -> FAILED.
+# - Nhiều process cùng chạy worker: lấy lô bằng SELECT ... FOR UPDATE SKIP LOCKED và giữ chỗ bằng cách lùi
+#   next_attempt_at thêm MAIL_LEASE giây -> không gửi trùng; process chết giữa chừng thì hết giữ chỗ, gửi lại.
+# - Mỗi email ghi kết quả (SENT / lỗi) ngay sau khi SMTP server trả lời, không đợi hết lô. Ghi DB lỗi thì
+#   dừng lô, giữ kết quả trong bộ nhớ và ghi lại trước khi lấy lô mới (backoff < MAIL_LEASE) -> email đã
+#   gửi không bị gửi lại khi hết giữ chỗ (trừ khi DB lỗi lâu hơn MAIL_LEASE / process chết đúng lúc đó).
+# - Cấu hình SMTP ở conf. Khi test: gán conf trỏ sang SMTP giả lập (localhost, không TLS / đăng nhập).
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formataddr
+
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+import database
+import models
+
+# --- CẤU HÌNH EMAIL (Thay đổi thông tin của bạn vào đây) ---
+conf = ConnectionConfig(
+    MAIL_USERNAME = "tuvan990.cv@gmail.com",
+    MAIL_PASSWORD = "fozy nozh sghf wlci",
+    MAIL_FROM = "tuvan990.cv@gmail.com",
+    MAIL_PORT = 587,
+    MAIL_SERVER = "smtp.gmail.com",
+    MAIL_STARTTLS = True,
+    MAIL_SSL_TLS = False,
+    USE_CREDENTIALS = True,
+    VALIDATE_CERTS = True
+)
+
+MAIL_BATCH_SIZE = 50        # Số email tối đa mỗi lô
+MAIL_POLL_INTERVAL = 5      # giây: chu kỳ quét hàng đợi khi không được notify()
+MAIL_LEASE = 120            # giây: giữ chỗ cho lô đang gửi
+MAIL_MAX_ATTEMPTS = 6
+MAIL_RETRY_BASE = 30        # giây, nhân đôi sau mỗi lần lỗi (30s, 1p, 2p, 4p...)
+MAIL_RETRY_MAX = 60 * 60    # tối đa 1 giờ giữa 2 lần thử
+MAIL_IDLE_CLOSE = 60        # giây không có gì gửi thì đóng kết nối SMTP
+MAIL_ERROR_BACKOFF_MAX = 60 # giây: chờ tối đa giữa 2 vòng khi DB / SMTP lỗi bất ngờ (phải < MAIL_LEASE)
+
+logger = logging.getLogger(__name__)
+
+_wakeup = None     # asyncio.Event của worker (notify() đánh thức)
+_unrecorded = []   # Kết quả đã gửi nhưng chưa ghi được vào DB: [(email_id, attempts, lỗi hoặc None)]
+_counters = {"sent": 0, "retried": 0, "failed": 0, "connects": 0, "batches": 0, "errors": 0}
+
+
+# --- 1. Thêm email vào hàng đợi (KHÔNG commit - để người gọi commit cùng dữ liệu) ---
+def enqueue(db: Session, recipient: str, subject: str, body: str, subtype: str = "html"):
+    now = datetime.now()
+    db.add(models.EmailOutbox(
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        subtype=subtype,
+        status="PENDING",
+        attempts=0,
+        next_attempt_at=now,
+        created_at=now
+    ))
+
+# Gọi sau db.commit() (từ API async def) để worker gửi ngay, không phải đợi tới lượt quét
+def notify():
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+# --- HELPER: Đọc / ghi hàng đợi (chạy trong thread, session riêng) ---
+# Lấy 1 lô email đến hạn và giữ chỗ (attempts +1, lùi next_attempt_at) rồi commit ngay để nhả khóa
+def _claim_batch() -> list:
+    db = database.SessionLocal()
+    try:
+        now = datetime.now()
+        rows = db.query(models.EmailOutbox).filter(
+            models.EmailOutbox.status == "PENDING",
+            models.EmailOutbox.next_attempt_at <= now
+        ).order_by(models.EmailOutbox.next_attempt_at, models.EmailOutbox.email_id
+        ).limit(MAIL_BATCH_SIZE).with_for_update(skip_locked=True).all()
+
+        batch = []
+        for row in rows:
+            row.attempts += 1
+            row.next_attempt_at = now + timedelta(seconds=MAIL_LEASE)
+            batch.append({
+                "email_id": row.email_id, "attempts": row.attempts, "recipient": row.recipient,
+                "subject": row.subject, "body": row.body, "subtype": row.subtype
+            })
+        db.commit()
+        return batch
+    finally:
+        db.close()
+
+# Ghi kết quả 1 lô: results = [(email_id, attempts, lỗi hoặc None)]
+def _record(results: list):
+    db = database.SessionLocal()
+    try:
+        now = datetime.now()
+        sent = [email_id for email_id, _, error in results if error is None]
+        if sent:
+            db.execute(update(models.EmailOutbox).where(models.EmailOutbox.email_id.in_(sent))
+                       .values(status="SENT", sent_at=now, last_error=None))
+        for email_id, attempts, error in results:
+            if error is None:
+                continue
+            if attempts >= MAIL_MAX_ATTEMPTS:
+                values = {"status": "FAILED", "last_error": error}
+            else:
+                delay = min(MAIL_RETRY_BASE * 2 ** (attempts - 1), MAIL_RETRY_MAX)
+                values = {"next_attempt_at": now + timedelta(seconds=delay), "last_error": error}
+            db.execute(update(models.EmailOutbox).where(models.EmailOutbox.email_id == email_id).values(**values))
+        db.commit()
+    finally:
+        db.close()
+
+
+# --- HELPER: SMTP ---
+def _build_message(item: dict) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = formataddr((conf.MAIL_FROM_NAME or "", conf.MAIL_FROM))
+    message["To"] = item["recipient"]
+    message["Subject"] = item["subject"]
+    message.set_content(item["body"], subtype=item["subtype"] or "html")
+    return message
+
+async def _connect() -> aiosmtplib.SMTP:
+    smtp = aiosmtplib.SMTP(
+        hostname=conf.MAIL_SERVER,
+        port=conf.MAIL_PORT,
+        use_tls=conf.MAIL_SSL_TLS,
+        start_tls=conf.MAIL_STARTTLS,
+        validate_certs=conf.VALIDATE_CERTS,
+        timeout=conf.TIMEOUT
+    )
+    await smtp.connect()
+    if conf.USE_CREDENTIALS:
+        await smtp.login(conf.MAIL_USERNAME, conf.MAIL_PASSWORD.get_secret_value())
+    _counters["connects"] += 1
+    return smtp
+
+async def _close(smtp: aiosmtplib.SMTP):
+    try:
+        await smtp.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        smtp.close()
+
+# Ghi kết quả (thread riêng). Lỗi -> giữ lại trong _unrecorded để worker ghi lại, rồi ném lỗi tiếp
+async def _save(results: list):
+    for _, attempts, error in results:
+        if error is None:
+            _counters["sent"] += 1
+        elif attempts >= MAIL_MAX_ATTEMPTS:
+            _counters["failed"] += 1
+        else:
+            _counters["retried"] += 1
+    try:
+        await asyncio.to_thread(_record, results)
+    except Exception:
+        _unrecorded.extend(results)
+        raise
+
+# Gửi 1 lô trên kết nối đang có (mở mới nếu chưa có / đã rớt). Không kết nối được thì phần còn lại coi như lỗi.
+# Mỗi email ghi kết quả ngay sau khi server trả lời; ghi lỗi thì dừng lô (phần chưa gửi hết giữ chỗ sẽ được lấy lại).
+async def _send_batch(smtp, batch: list):
+    _counters["batches"] += 1
+    for index, item in enumerate(batch):
+        if smtp is None or not smtp.is_connected:
+            try:
+                smtp = await _connect()
+            except (aiosmtplib.SMTPException, OSError) as e:
+                await _save([(rest["email_id"], rest["attempts"], f"Không kết nối được SMTP: {e}") for rest in batch[index:]])
+                return None
+        try:
+            await smtp.send_message(_build_message(item))
+            result = (item["email_id"], item["attempts"], None)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            result = (item["email_id"], item["attempts"], str(e))
+        try:
+            await _save([result])
+        except Exception:
+            await _close(smtp)
+            raise
+    return smtp
+
+
+# --- 2. Worker nền (1 task / process, khởi động trong lifespan) ---
+async def worker():
+    global _wakeup
+    _wakeup = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    smtp, last_used, errors = None, loop.time(), 0
+    try:
+        while True:
+            try:
+                # Kết quả lần trước chưa ghi được: ghi trước khi lấy lô mới (còn trong thời gian giữ chỗ)
+                if _unrecorded:
+                    await asyncio.to_thread(_record, list(_unrecorded))
+                    _unrecorded.clear()
+
+                batch = await asyncio.to_thread(_claim_batch)
+                if batch:
+                    # _send_batch tự đóng kết nối nếu lỗi giữa chừng -> không giữ lại kết nối cũ
+                    current, smtp = smtp, None
+                    smtp = await _send_batch(current, batch)
+                    last_used, errors = loop.time(), 0
+                    continue # Có thể còn email đến hạn: lấy lô tiếp ngay
+
+                errors = 0
+                if smtp is not None and loop.time() - last_used >= MAIL_IDLE_CLOSE:
+                    await _close(smtp)
+                    smtp = None
+            except Exception:
+                # DB / SMTP lỗi bất ngờ: ghi log, chờ lâu dần (tối đa MAIL_ERROR_BACKOFF_MAX) rồi thử lại.
+                # Email đang giữ chỗ mà chưa gửi sẽ được lấy lại sau MAIL_LEASE giây.
+                errors += 1
+                _counters["errors"] += 1
+                delay = min(MAIL_POLL_INTERVAL * 2 ** (errors - 1), MAIL_ERROR_BACKOFF_MAX)
+                logger.exception("Worker email lỗi (%d lần liên tiếp), thử lại sau %.0f giây", errors, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            try:
+                await asyncio.wait_for(_wakeup.wait(), MAIL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+    finally:
+        if smtp is not None:
+            await _close(smtp)
+
+
+# --- 3. Thống kê hàng đợi (GET /admin/email-stats) ---
+def stats(db: Session) -> dict:
+    now = datetime.now()
+    counts = dict(db.query(models.EmailOutbox.status, func.count()).group_by(models.EmailOutbox.status).all())
+    oldest = db.query(func.min(models.EmailOutbox.created_at)).filter(models.EmailOutbox.status == "PENDING").scalar()
+    due = db.query(func.count()).filter(
+        models.EmailOutbox.status == "PENDING",
+        models.EmailOutbox.next_attempt_at <= now
+    ).scalar()
+    return {
+        "pending": counts.get("PENDING", 0),
+        "due": due,
+        "sent": counts.get("SENT", 0),
+        "failed": counts.get("FAILED", 0),
+        "oldest_pending_seconds": round((now - oldest).total_seconds(), 1) if oldest else None,
+        "worker": dict(_counters)
+    }
@@ -1,67 +1,161 @@
 # main.py
 from datetime import datetime, timedelta, date, time
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Response
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-import models, database, schemas, security
-from sqlalchemy import func, desc, extract
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
+import models, database, schemas, security, billing, cache, exports, jobs, pagination, patient_search, projection, etags, catalog, mailer
+from sqlalchemy import func, desc, extract, update
 from pydantic import EmailStr
 import random
 import string
-from sqlalchemy.orm import joinedload 
+from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy import or_, and_
-import pandas as pd
-import io
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import case
+import asyncio
+from contextlib import asynccontextmanager
 
-app = FastAPI()
-FIXED_EXAM_FEE = 50000.0 # Phí khám cố định (VNĐ)
-# Dependency để lấy DB session
-def get_db():
+# --- KHỞI ĐỘNG: Nạp sẵn cache + làm mới nền ---
+# Sau mỗi lần deploy / restart worker, cache trong process còn trống -> các request đầu rất chậm.
+# Task nền: nạp sẵn danh mục (thuốc, dịch vụ, khoa / phòng, lịch bác sĩ), dashboard và lịch hẹn hôm nay,
+# sau đó cứ WARMUP_REFRESH_INTERVAL giây nạp lại phần có thay đổi. /health/ready trả 503 tới khi nạp xong.
+WARMUP_REFRESH_INTERVAL = 30 # giây
+
+# first_run: lần nạp đầu lúc khởi động; các lần sau chỉ nạp lại phần có thay đổi / hết hạn
+def _warm_up(first_run: bool):
     db = database.SessionLocal()
     try:
-        yield db
+        catalog.refresh(db)
+        # Dashboard: gọi thẳng các báo cáo với tham số mặc định -> kết quả vào report_cache
+        # (mục còn trong cache chỉ là 1 lần get, bị invalidate / hết TTL thì được tính lại ngay)
+        report_revenue(db=db, current_user=None)
+        report_top_medicines(db=db, current_user=None)
+        report_inpatient_census(db=db, current_user=None)
+        # Lịch hẹn hôm nay (quầy tiếp đón): đổi liên tục nên không cache, chỉ chạy thử 1 lần để
+        # biên dịch sẵn câu SQL / bộ serialize JSON và nạp dữ liệu vào buffer của DB
+        if first_run:
+            get_appointments(response=Response(), date_str=date.today().isoformat(),
+                             page=pagination.PageParams(limit=pagination.DEFAULT_LIMIT), db=db, current_user={"role": "ADMIN"})
     finally:
         db.close()
 
+async def _warm_and_refresh(state):
+    while True:
+        try:
+            await asyncio.to_thread(_warm_up, not state.ready)
+            state.ready, state.warmup_error = True, None
+        except Exception as e:
+            # DB chưa sẵn sàng...: thử lại ở vòng sau (lỗi khi làm mới không làm mất trạng thái ready)
+            state.warmup_error = str(e)
+        await asyncio.sleep(WARMUP_REFRESH_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready, app.state.warmup_error = False, None
+    jobs.start() # Process pool cho job báo cáo chạy nền
+    tasks = [
+        asyncio.create_task(_warm_and_refresh(app.state)),
+        asyncio.create_task(mailer.worker()) # Gửi email trong hàng đợi EmailOutbox
+    ]
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    jobs.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+FIXED_EXAM_FEE = billing.FIXED_EXAM_FEE # Phí khám cố định (VNĐ)
+# Dependency để lấy DB session (dùng chung database.get_db với etags.conditional -> 1 session / request)
+get_db = database.get_db
+
+# --- Health check cho load balancer / rolling restart ---
+# live: process còn chạy. ready: đã nạp xong cache khởi động, nhận traffic được.
+@app.get("/health/live")
+def liveness():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+def readiness():
+    if not getattr(app.state, "ready", False):
+        raise HTTPException(status_code=503, detail=getattr(app.state, "warmup_error", None) or "Đang nạp cache khởi động")
+    return {"status": "ready"}
+
 # Cấu hình để Swagger UI biết chỗ nhập Token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 # --- API 1: Đăng nhập (Login) ---
+# Các API băm / kiểm tra mật khẩu là async def nhưng CHỈ await bcrypt (security._run_hash, executor riêng):
+# mọi thao tác DB (SQLAlchemy sync) chạy qua run_in_threadpool, không chạy trên event loop.
+# Phần DB trước bcrypt trả connection về pool (db.rollback() khi chưa ghi gì), nếu không đợt đăng nhập
+# dồn dập sẽ giữ hết connection của pool trong lúc chờ băm.
+
+# HELPER (chạy trong threadpool): user + patient_id của hồ sơ bệnh nhân liên kết, rồi trả connection
+def _find_login_user(db: Session, username: str):
+    user = db.query(
+        models.User.user_id, models.User.username, models.User.password, models.User.role, models.Patient.patient_id
+    ).outerjoin(models.Patient, models.Patient.account_id == models.User.user_id
+    ).filter(models.User.username == username).first()
+    db.rollback()
+    return user
+
+def _username_taken(db: Session, username: str) -> bool:
+    taken = db.query(models.User.user_id).filter(models.User.username == username).first() is not None
+    db.rollback()
+    return taken
+
+def _save_new(db: Session, obj):
+    db.add(obj)
+    db.commit()
+    db.refresh(obj)
+    return obj
+
+def _set_password(db: Session, user_id: int, hashed_password: str):
+    db.execute(update(models.User).where(models.User.user_id == user_id).values(password=hashed_password))
+    db.commit()
+
 @app.post("/login", response_model=schemas.Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(), # Dùng Depends() để nhận dữ liệu từ Form Swagger
     db: Session = Depends(get_db)
 ):
-    # Tìm user dựa trên form_data.username
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
+    # Tìm user dựa trên form_data.username (kèm patient_id của hồ sơ bệnh nhân liên kết, nếu có)
+    user = await run_in_threadpool(_find_login_user, db, form_data.username)
     
     # Kiểm tra mật khẩu dựa trên form_data.password
-    if not user or not security.verify_password(form_data.password, user.password):
+    if not user or not await security.verify_password_async(form_data.password, user.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Sai tên đăng nhập hoặc mật khẩu",
         )
+
+    # Pass cũ còn lưu dạng chữ thường (dữ liệu mẫu) -> băm lại ngay khi đăng nhập đúng
+    if security.needs_rehash(user.password):
+        hashed_password = await security.hash_password_async(form_data.password)
+        await run_in_threadpool(_set_password, db, user.user_id, hashed_password)
     
-    # Tạo Token (sub=username, role=role)
+    # Tạo Token (sub=username, role=role, uid=user_id, pid=patient_id của hồ sơ bệnh nhân liên kết)
+    # API lấy người gọi từ claims (security.get_current_user), không phải query lại bảng Users
+    patient_id = user.patient_id if user.role == 'PATIENT' else None
     access_token = security.create_access_token(
-        data={"sub": user.username, "role": user.role}
+        data={"sub": user.username, "role": user.role, "uid": user.user_id, "pid": patient_id}
     )
     
     return {"access_token": access_token, "token_type": "bearer"}
 
 # --- API: Đăng ký tài khoản Bệnh nhân (Public - Ai cũng gọi được) ---
 @app.post("/register", response_model=schemas.UserResponse)
-def register_patient(user: schemas.UserRegister, db: Session = Depends(get_db)):
+async def register_patient(user: schemas.UserRegister, db: Session = Depends(get_db)):
     # 1. Check trùng username
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
+    if await run_in_threadpool(_username_taken, db, user.username):
         raise HTTPException(status_code=400, detail="Tên đăng nhập đã tồn tại")
     
     # 2. Mã hóa mật khẩu
-    hashed_password = security.pwd_context.hash(user.password)
+    hashed_password = await security.hash_password_async(user.password)
     
     # 3. Tạo user với vai trò mặc định là PATIENT
     new_user = models.User(
@@ -72,24 +166,21 @@ def register_patient(user: schemas.UserRegister, db: Session = Depends(get_db)):
         phone=user.phone,
         role="PATIENT" # <--- Mặc định
     )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
+    return await run_in_threadpool(_save_new, db, new_user)
 
 # --- API: Admin tạo nhân viên (DOCTOR, NURSE, ADMIN) ---
 @app.post("/admin/users", response_model=schemas.UserResponse)
-def create_staff(
+async def create_staff(
     user: schemas.UserCreateStaff, 
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # ✅ CHỈ ADMIN CÓ QUY HẠN TẠO NHÂN VIÊN
     # Check trùng username
-    if db.query(models.User).filter(models.User.username == user.username).first():
+    if await run_in_threadpool(_username_taken, db, user.username):
         raise HTTPException(status_code=400, detail="Username đã tồn tại")
 
-    hashed_password = security.pwd_context.hash(user.password)
+    hashed_password = await security.hash_password_async(user.password)
     
     # --- SỬA ĐOẠN NÀY ---
     # Nếu email/phone là chuỗi rỗng "", chuyển thành None để DB hiểu là NULL (được phép trùng NULL)
@@ -106,45 +197,29 @@ def create_staff(
     )
     # --------------------
 
-    db.add(new_staff)
-    db.commit()
-    db.refresh(new_staff)
-    return new_staff
-
-# --- CẤU HÌNH EMAIL (Thay đổi thông tin của bạn vào đây) ---
-conf = ConnectionConfig(
-    MAIL_USERNAME = "tuvan990.cv@gmail.com",
-    MAIL_PASSWORD = "fozy nozh sghf wlci",
-    MAIL_FROM = "tuvan990.cv@gmail.com",
-    MAIL_PORT = 587,
-    MAIL_SERVER = "smtp.gmail.com",
-    MAIL_STARTTLS = True,
-    MAIL_SSL_TLS = False,
-    USE_CREDENTIALS = True,
-    VALIDATE_CERTS = True
-)
+    return await run_in_threadpool(_save_new, db, new_staff)
+
+# Cấu hình email (SMTP): xem mailer.conf
 # Hàm sinh mã OTP 6 số ngẫu nhiên
 def generate_otp():
     return ''.join(random.choices(string.digits, k=6))
 
 # --- API: Yêu cầu quên mật khẩu (Gửi Email OTP) ---
-@app.post("/forgot-password")
-async def forgot_password(request: schemas.ForgotPasswordRequest, db: Session = Depends(get_db)):
+# Sinh OTP + đưa email vào hàng đợi trong threadpool; chỉ mailer.notify() chạy trên event loop
+def _create_reset_otp(db: Session, email: str) -> bool:
     # 1. Kiểm tra email có tồn tại không
-    user = db.query(models.User).filter(models.User.email == request.email).first()
+    user = db.query(models.User).filter(models.User.email == email).first()
     if not user:
-        # Bảo mật: Không nên báo rõ là "Email không tồn tại" để tránh bị dò quét, 
-        # nhưng để test thì ta cứ báo lỗi 404.
-        raise HTTPException(status_code=404, detail="Email không tồn tại trong hệ thống")
+        return False
 
     # 2. Sinh OTP và lưu vào DB
     otp = generate_otp()
     user.reset_token = otp
     # Token hết hạn sau 15 phút
     user.reset_token_exp = datetime.now() + timedelta(minutes=15)
-    db.commit()
 
-    # 3. Gửi Email thật
+    # 3. Đưa email vào hàng đợi, commit cùng transaction với OTP (worker nền gửi qua SMTP,
+    #    request không phải chờ / không bị lỗi theo mail server)
     html = f"""
     <h3>Yêu cầu đặt lại mật khẩu</h3>
     <p>Xin chào {user.full_name},</p>
@@ -152,66 +227,81 @@ async def forgot_password(request: schemas.ForgotPasswordRequest, db: Session =
     <p>Mã này sẽ hết hạn sau 15 phút.</p>
     <p>Nếu bạn không yêu cầu, vui lòng bỏ qua email này.</p>
     """
+    mailer.enqueue(db, email, "[Hospital App] Mã xác thực khôi phục mật khẩu", html)
+    db.commit()
+    return True
 
-    message = MessageSchema(
-        subject="[Hospital App] Mã xác thực khôi phục mật khẩu",
-        recipients=[request.email],
-        body=html,
-        subtype=MessageType.html
-    )
-
-    fm = FastMail(conf)
-    await fm.send_message(message)
+@app.post("/forgot-password")
+async def forgot_password(request: schemas.ForgotPasswordRequest, db: Session = Depends(get_db)):
+    if not await run_in_threadpool(_create_reset_otp, db, request.email):
+        # Bảo mật: Không nên báo rõ là "Email không tồn tại" để tránh bị dò quét, 
+        # nhưng để test thì ta cứ báo lỗi 404.
+        raise HTTPException(status_code=404, detail="Email không tồn tại trong hệ thống")
+    mailer.notify()
 
     return {"message": "Đã gửi mã OTP qua email"}
 
 # --- API: Xác nhận OTP và Đặt mật khẩu mới ---
-@app.post("/reset-password")
-def reset_password(request: schemas.ResetPasswordRequest, db: Session = Depends(get_db)):
-    # 1. Tìm user
-    user = db.query(models.User).filter(models.User.email == request.email).first()
+# Kiểm tra OTP 2 lần: lần đầu (chỉ đọc) để báo lỗi rõ ràng và không tốn bcrypt cho OTP sai;
+# lần cuối cùng câu UPDATE đổi mật khẩu + xóa OTP (1 câu lệnh, 1 transaction): 2 request dùng
+# cùng 1 OTP song song thì chỉ 1 request khớp điều kiện, request còn lại nhận 400.
+def _check_reset_otp(db: Session, email: str, otp: str):
+    user = db.query(models.User.user_id, models.User.reset_token, models.User.reset_token_exp)\
+        .filter(models.User.email == email).first()
+    db.rollback() # Trả connection về pool trong lúc chờ bcrypt
     if not user:
         raise HTTPException(status_code=404, detail="User không tồn tại")
-
-    # 2. Kiểm tra OTP
-    if user.reset_token != request.otp:
+    if user.reset_token is None or user.reset_token != otp:
         raise HTTPException(status_code=400, detail="Mã OTP không đúng")
-    
-    # 3. Kiểm tra thời gian hết hạn
     if user.reset_token_exp < datetime.now():
         raise HTTPException(status_code=400, detail="Mã OTP đã hết hạn")
-
-    # 4. Đổi mật khẩu
-    user.password = security.pwd_context.hash(request.new_password)
-    
-    # 5. Xóa OTP sau khi dùng xong
-    user.reset_token = None
-    user.reset_token_exp = None
+    return user.user_id
+
+def _consume_reset_otp(db: Session, user_id: int, otp: str, hashed_password: str) -> bool:
+    consumed = db.execute(
+        update(models.User)
+        .where(
+            models.User.user_id == user_id,
+            models.User.reset_token == otp,
+            models.User.reset_token_exp >= datetime.now()
+        )
+        .values(password=hashed_password, reset_token=None, reset_token_exp=None)
+    ).rowcount
     db.commit()
+    return consumed == 1
+
+@app.post("/reset-password")
+async def reset_password(request: schemas.ResetPasswordRequest, db: Session = Depends(get_db)):
+    # 1. Tìm user, kiểm tra OTP + thời gian hết hạn
+    user_id = await run_in_threadpool(_check_reset_otp, db, request.email, request.otp)
+
+    # 2. Băm mật khẩu mới (không giữ connection / khóa dòng nào trong lúc chờ)
+    hashed_password = await security.hash_password_async(request.new_password)
+
+    # 3. Đổi mật khẩu + xóa OTP, chỉ khi OTP vẫn còn hiệu lực (chưa bị request khác dùng)
+    if not await run_in_threadpool(_consume_reset_otp, db, user_id, request.otp, hashed_password):
+        raise HTTPException(status_code=400, detail="Mã OTP không đúng hoặc đã được sử dụng")
 
     return {"message": "Đặt lại mật khẩu thành công"}
 
 # --- API: Lấy danh sách nhân viên (Cho Admin xem) ---
 @app.get("/admin/users", response_model=list[schemas.UserResponse])
 def get_all_users(
+    response: Response,
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # ✅ CHỈ ADMIN CÓ QUYỀN XEM DANH SÁCH NHÂN VIÊN
     # Chỉ lấy Admin, Doctor, Nurse (bỏ qua Patient cho đỡ rối list nhân viên)
-    return db.query(models.User).filter(models.User.role.in_(['ADMIN', 'DOCTOR', 'NURSE','TECHNICIAN'])).all()
+    query = db.query(models.User).filter(models.User.role.in_(['ADMIN', 'DOCTOR', 'NURSE','TECHNICIAN']))
+    return pagination.paginate(query, page, response, [(models.User.user_id, False)])
 
 # --- API 2: Lấy thông tin người dùng hiện tại (Cần Token mới gọi được) ---
 @app.get("/users/me", response_model=schemas.UserProfileResponse)
-def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    try:
-        payload = security.jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
-        username: str = payload.get("sub")
-    except security.jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Token không hợp lệ")
-        
-    # Query User và join sẵn với Patient để lấy CCCD/BHYT nếu có
-    user = db.query(models.User).options(joinedload(models.User.patient_record)).filter(models.User.username == username).first()
+def read_users_me(current_user: dict = Depends(security.get_current_user), db: Session = Depends(get_db)):
+    # Query User theo khóa chính và join sẵn với Patient để lấy CCCD/BHYT nếu có
+    user = db.query(models.User).options(joinedload(models.User.patient_record)).filter(models.User.user_id == current_user["user_id"]).first()
     if user is None:
         raise HTTPException(status_code=404, detail="Không tìm thấy user")
     
@@ -237,32 +327,18 @@ def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get
     return resp
 
 
-@app.put("/users/me", response_model=schemas.UserProfileResponse)
-def update_user_me(
-    update_data: schemas.UserProfileUpdate,
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-):
-    # 1. Xác thực user
-    try:
-        payload = security.jwt.decode(token, security.SECRET_KEY, algorithms=[security.ALGORITHM])
-        username: str = payload.get("sub")
-    except security.jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Token không hợp lệ")
-    
-    user = db.query(models.User).filter(models.User.username == username).first()
+# Đổi thông tin cá nhân: phần DB chạy trong threadpool, chỉ await bcrypt (khi có đổi mật khẩu)
+def _load_password(db: Session, user_id: int):
+    password = db.query(models.User.password).filter(models.User.user_id == user_id).scalar()
+    db.rollback() # Trả connection về pool trong lúc chờ bcrypt
+    return password
+
+def _apply_profile_update(db: Session, user_id: int, update_data: schemas.UserProfileUpdate, hashed_password):
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User không tồn tại")
-
-    # 2. Xử lý đổi mật khẩu (Nếu có gửi lên)
-    if update_data.new_password:
-        if not update_data.current_password:
-             raise HTTPException(status_code=400, detail="Vui lòng nhập mật khẩu hiện tại để xác nhận thay đổi")
-        if not security.verify_password(update_data.current_password, user.password):
-             raise HTTPException(status_code=400, detail="Mật khẩu hiện tại không đúng")
-        
-        # Hash mật khẩu mới
-        user.password = security.pwd_context.hash(update_data.new_password)
+    if hashed_password:
+        user.password = hashed_password
 
     # 3. Kiểm tra trùng username (Nếu đổi username)
     if update_data.username != user.username:
@@ -281,6 +357,7 @@ def update_user_me(
         user.patient_record.phone = update_data.phone
         user.patient_record.address = update_data.address
         # Email và CCCD thường ít đổi, hoặc cần quy trình riêng, ở đây ta sync Phone/Address
+        patient_search.index_patient(db, user.patient_record)
 
     db.commit()
     db.refresh(user)
@@ -294,8 +371,32 @@ def update_user_me(
         )
     return resp
 
+@app.put("/users/me", response_model=schemas.UserProfileResponse)
+async def update_user_me(
+    update_data: schemas.UserProfileUpdate,
+    current_user: dict = Depends(security.get_current_user),
+    db: Session = Depends(get_db)
+):
+    # 1. User lấy theo user_id trong token (vẫn đúng sau khi đổi username)
+    # 2. Xử lý đổi mật khẩu (Nếu có gửi lên)
+    hashed_password = None
+    if update_data.new_password:
+        if not update_data.current_password:
+             raise HTTPException(status_code=400, detail="Vui lòng nhập mật khẩu hiện tại để xác nhận thay đổi")
+        current_password = await run_in_threadpool(_load_password, db, current_user["user_id"])
+        if current_password is None:
+            raise HTTPException(status_code=404, detail="User không tồn tại")
+        if not await security.verify_password_async(update_data.current_password, current_password):
+             raise HTTPException(status_code=400, detail="Mật khẩu hiện tại không đúng")
+        
+        # Hash mật khẩu mới
+        hashed_password = await security.hash_password_async(update_data.new_password)
+
+    # 3-5. Ghi thay đổi + dựng response (đọc quan hệ patient_record) trong threadpool
+    return await run_in_threadpool(_apply_profile_update, db, current_user["user_id"], update_data, hashed_password)
+
 # --- API 3: Thêm bệnh nhân mới ---
-from typing import List, Optional
+from typing import List, Literal, Optional
 @app.post("/patients", response_model=schemas.PatientResponse)
 def create_patient(
     patient: schemas.PatientCreate, 
@@ -321,32 +422,37 @@ def create_patient(
         insurance_card=patient.insurance_card
     )
     
-    # 3. Lưu vào Database
+    # 3. Lưu vào Database & cập nhật chỉ mục tìm kiếm trong cùng transaction
     db.add(db_patient)
+    db.flush() # Lấy ID vừa tự động sinh ra
+    patient_search.index_patient(db, db_patient)
     db.commit()
-    db.refresh(db_patient) # Lấy lại ID vừa tự động sinh ra
+    db.refresh(db_patient)
     return db_patient
 
 # --- API 4: Lấy danh sách & Tìm kiếm bệnh nhân ---
 @app.get("/patients", response_model=list[schemas.PatientResponse])
 def get_patients(
+    response: Response,
     search: Optional[str] = None, # Tham số tìm kiếm tùy chọn (Query param)
+    fields: Optional[str] = None, # Chọn trường trả về (VD: ?fields=patient_id,full_name)
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE"]))
 ):
     # ✅ CHỈ Y TÁ, BÁC SĨ, ADMIN CÓ QUYỀN XEM DANH SÁCH BỆNH NHÂN
-    # Nếu có từ khóa tìm kiếm (VD: ?search=Nguyen)
+    # Nếu có từ khóa tìm kiếm (VD: ?search=nguyen): tìm qua chỉ mục (tên không dấu, SĐT, CCCD, BHYT),
+    # trả về `limit` kết quả khớp nhất theo thứ tự xếp hạng (không có trang sau)
+    names = projection.parse_fields(fields, models.Patient, schemas.PatientResponse)
+    query = projection.apply(db.query(models.Patient), models.Patient, names)
     if search:
-        # Tìm theo Tên HOẶC số BHYT
-        patients = db.query(models.Patient).filter(
-            (models.Patient.full_name.contains(search)) | 
-            (models.Patient.insurance_card.contains(search))
-        ).all()
-    else:
-        # Nếu không tìm gì, trả về toàn bộ (cẩn thận nếu dữ liệu lớn sau này cần phân trang)
-        patients = db.query(models.Patient).all()
-        
-    return patients
+        ids = patient_search.search_patient_ids(db, search, page.limit)
+        patients = {p.patient_id: p for p in query.filter(models.Patient.patient_id.in_(ids))}
+        return projection.respond([patients[i] for i in ids if i in patients], schemas.PatientResponse, names, response)
+
+    # Không tìm gì: trả về theo từng trang (mặc định pagination.DEFAULT_LIMIT dòng)
+    rows = pagination.paginate(query, page, response, [(models.Patient.patient_id, False)])
+    return projection.respond(rows, schemas.PatientResponse, names, response)
 
 
 # --- API 5: Quản lý Kho thuốc (Thêm thuốc) ---
@@ -373,6 +479,7 @@ def create_medicine(
     )
     db.add(db_medicine)
     db.commit()
+    catalog.invalidate("medicines")
     db.refresh(db_medicine)
     return db_medicine
 
@@ -394,11 +501,18 @@ def get_expiring_medicines(
 # --- API 6: Lấy danh sách thuốc (Để bác sĩ chọn) ---
 @app.get("/medicines", response_model=list[schemas.MedicineResponse])
 def get_medicines(
+    response: Response,
+    fields: Optional[str] = None, # Chọn trường trả về (VD: ?fields=medicine_id,name,stock_quantity)
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
-    current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE", "TECHNICIAN"]))
+    current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE", "TECHNICIAN"])),
+    _etag: None = Depends(etags.conditional(models.Medicine, models.Medicine.stock_quantity)) # 304 nếu thuốc / tồn kho không đổi
 ):
     # ✅ CHỈ DOCTOR, NURSE, ADMIN, TECHNICIAN CÓ QUYỀN XEM DANH SÁCH THUỐC
-    return db.query(models.Medicine).all()
+    names = projection.parse_fields(fields, models.Medicine, schemas.MedicineResponse)
+    query = projection.apply(db.query(models.Medicine), models.Medicine, names)
+    rows = pagination.paginate(query, page, response, [(models.Medicine.medicine_id, False)])
+    return projection.respond(rows, schemas.MedicineResponse, names, response)
 
 # --- API 7: Tạo lượt khám (Y tá tiếp nhận) ---
 @app.post("/visits", response_model=schemas.VisitResponse)
@@ -423,22 +537,34 @@ def create_visit(
         priority=visit.priority
     )
     db.add(db_visit)
+    db.flush() # Lấy visit_id
+    billing.open_visit_charge(db, db_visit.visit_id)
     db.commit()
+    cache.report_cache.invalidate("visits")
     db.refresh(db_visit)
     return db_visit
 
 # --- API 8: Lấy danh sách khám (Lọc theo trạng thái WAITING) ---
 @app.get("/visits", response_model=list[schemas.VisitResponse])
 def get_visits(
+    response: Response,
     status: Optional[str] = None, # Cho phép lọc ?status=WAITING
+    order: Literal["asc", "desc"] = "asc", # asc: cũ trước (hàng chờ), desc: mới nhất trước
+    fields: Optional[str] = None, # Chọn trường trả về (VD: ?fields=visit_id,patient_id,status)
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE"]))
 ):
     # ✅ CHỈ DOCTOR, NURSE, ADMIN CÓ QUYỀN XEM DANH SÁCH KHÁM
-    query = db.query(models.Visit)
+    # Chỉ đọc các cột của schema (không đọc clinical_symptoms, advice...) + visit_date để phân trang
+    names = projection.parse_fields(fields, models.Visit, schemas.VisitResponse)
+    query = projection.apply(db.query(models.Visit), models.Visit, names, extra=(models.Visit.visit_date,))
     if status:
         query = query.filter(models.Visit.status == status)
-    return query.all()
+    descending = order == "desc"
+    rows = pagination.paginate(query, page, response,
+                               [(models.Visit.visit_date, descending), (models.Visit.visit_id, descending)])
+    return projection.respond(rows, schemas.VisitResponse, names, response)
 
 
 # --- API 9: Cập nhật chẩn đoán (Bác sĩ khám) ---
@@ -463,6 +589,7 @@ def update_diagnosis(
     
     visit.status = "IN_PROGRESS"
     db.commit()
+    cache.report_cache.invalidate("visits")
     return {"message": "Đã lưu hồ sơ bệnh án"}
 
 # --- API 10: Kê đơn thuốc (Logic khó nhất: Trừ kho) ---
@@ -473,20 +600,26 @@ def create_prescription(
     current_user: dict = Depends(security.check_role(["DOCTOR"]))
 ):
     # ✅ CHỈ BÁC SĨ CÓ QUYỀN KÊ ĐƠN THUỐC
-    # (Logic kiểm tra tồn kho giữ nguyên...)
-    medicine = db.query(models.Medicine).filter(models.Medicine.medicine_id == pres.medicine_id).first()
-    if not medicine:
-        raise HTTPException(status_code=404, detail="Thuốc không tồn tại")
-    if medicine.stock_quantity < pres.quantity:
-        raise HTTPException(status_code=400, detail=f"Không đủ thuốc. Kho còn {medicine.stock_quantity}")
-
-    medicine.stock_quantity -= pres.quantity
+    # Trừ kho bằng 1 câu UPDATE có điều kiện: chỉ trừ khi còn đủ (2 bác sĩ kê cùng lúc không bị mất cập nhật)
+    taken = db.execute(
+        update(models.Medicine)
+        .where(models.Medicine.medicine_id == pres.medicine_id, models.Medicine.stock_quantity >= pres.quantity)
+        .values(stock_quantity=models.Medicine.stock_quantity - pres.quantity)
+    ).rowcount
+    if not taken:
+        stock = db.query(models.Medicine.stock_quantity).filter(models.Medicine.medicine_id == pres.medicine_id).scalar()
+        if stock is None:
+            raise HTTPException(status_code=404, detail="Thuốc không tồn tại")
+        raise HTTPException(status_code=400, detail=f"Không đủ thuốc. Kho còn {stock}")
+    # Giá đọc từ dòng thuốc vừa trừ kho (đang bị khóa trong transaction này), không lấy từ cache danh mục
+    price = billing.medicine_price(db, pres.medicine_id)
     
     # Lưu đầy đủ thông tin liều dùng
     db_pres = models.Prescription(
         visit_id=pres.visit_id,
         medicine_id=pres.medicine_id,
         quantity=pres.quantity,
+        unit_price=price, # Chốt giá tại thời điểm kê đơn
         note=pres.note,
         # MỚI
         dosage_morning=pres.dosage_morning,
@@ -496,7 +629,11 @@ def create_prescription(
         usage_instruction=pres.usage_instruction
     )
     db.add(db_pres)
+    # Cộng tiền thuốc vào tổng của lượt khám (cùng transaction)
+    billing.apply_visit_charge(db, pres.visit_id, medicine_delta=pres.quantity * db_pres.unit_price)
+    billing.record_medicine_usage(db, pres.visit_id, pres.medicine_id, pres.quantity, pres.quantity * db_pres.unit_price)
     db.commit()
+    cache.report_cache.invalidate("prescriptions", "medicines")
     db.refresh(db_pres)
     return db_pres
 
@@ -514,6 +651,7 @@ def finish_visit(
         
     visit.status = "COMPLETED" # Hoặc "WAITING_PAYMENT" tùy quy ước
     db.commit()
+    cache.report_cache.invalidate("visits")
     
     return {"message": "Đã kết thúc khám, chuyển sang thanh toán"}
 
@@ -528,34 +666,21 @@ def preview_bill(
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR"]))
 ):
     # ✅ CHỈ DOCTOR VÀ ADMIN CÓ QUYỀN XEM HÓA ĐƠN
-    # 1. Tính tiền thuốc
-    prescriptions = db.query(models.Prescription).filter(models.Prescription.visit_id == visit_id).all()
-    medicine_total = 0
-    details = []
-    
-    for pres in prescriptions:
-        med = db.query(models.Medicine).filter(models.Medicine.medicine_id == pres.medicine_id).first()
-        if med:
-            cost = pres.quantity * float(med.price)
-            medicine_total += cost
-            details.append({
-                "name": med.name, "qty": pres.quantity, "price": med.price, "total": cost
-            })
+    # 1. Tính tiền thuốc (1 query, tên thuốc từ cache danh mục, không query Medicine từng dòng)
+    details = billing.visit_medicine_lines(db, [visit_id])[visit_id]
+    medicine_total = sum(d["total"] for d in details)
+
+    # 2. Tính tiền dịch vụ CLS (khớp với số tiền lưu khi tạo hóa đơn)
+    service_details = billing.visit_service_lines(db, [visit_id])[visit_id]
+    service_total = sum(d["total"] for d in service_details)
             
-    # 2. Tính toán tổng
-    sub_total = medicine_total + FIXED_EXAM_FEE + procedure_fee
-    discount = sub_total * (insurance_percent / 100)
-    final_amount = sub_total - discount
+    # 3. Tính toán tổng
+    bill = billing.summarize_bill(medicine_total, service_total, insurance_percent, procedure_fee)
     
     return {
         "medicine_details": details,
-        "medicine_total": medicine_total,
-        "exam_fee": FIXED_EXAM_FEE,
-        "procedure_fee": procedure_fee,
-        "sub_total": sub_total,
-        "insurance_percent": insurance_percent,
-        "discount": discount,
-        "final_amount": final_amount
+        "service_details": service_details,
+        **bill
     }
 
 # --- API 13 (Nâng cấp): Thanh toán & Lưu hóa đơn chi tiết ---
@@ -566,33 +691,21 @@ def create_invoice(
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # ✅ CHỈ ADMIN CÓ QUYỀN TẠO HÓA ĐƠN
-    # (Logic tính toán lặp lại để bảo mật - nên tách thành hàm riêng nếu dự án lớn)
-    prescriptions = db.query(models.Prescription).filter(models.Prescription.visit_id == inv.visit_id).all()
-    medicine_total = sum([p.quantity * float(db.query(models.Medicine).get(p.medicine_id).price) for p in prescriptions])
-    
-    sub_total = medicine_total + FIXED_EXAM_FEE + inv.procedure_fee
-    discount = sub_total * (inv.insurance_percent / 100)
-    final_amount = sub_total - discount
-    
-    # Lưu hóa đơn
-    db_invoice = models.Invoice(
-        visit_id=inv.visit_id,
-        medicine_total=medicine_total,
-        exam_fee=FIXED_EXAM_FEE,
-        procedure_fee=inv.procedure_fee,
-        insurance_percent=inv.insurance_percent,
-        final_amount=final_amount,
-        payment_method=inv.payment_method,
-        # Lưu ý: Cột total_amount cũ trong DB có thể dùng để lưu sub_total hoặc final tùy quy ước
-        # Ở đây ta tạm bỏ qua cột total_amount cũ hoặc gán nó bằng sub_total
+    # Tính lại phía server để bảo mật (dùng chung module billing)
+    items = billing.visit_invoice_items(db, [inv.visit_id], inv.insurance_percent, inv.procedure_fee)[inv.visit_id]
+    
+    # Lưu hóa đơn + dòng chi tiết (thuốc, dịch vụ, phí khám, thủ thuật)
+    db_invoice, bill = billing.build_invoice(
+        db, inv.visit_id, items, inv.insurance_percent, inv.procedure_fee, inv.payment_method
     )
-    db.add(db_invoice)
+    sub_total = bill["sub_total"]
     
     # Update trạng thái lượt khám
     visit = db.query(models.Visit).filter(models.Visit.visit_id == inv.visit_id).first()
     visit.status = "PAID"
     
     db.commit()
+    cache.report_cache.invalidate("invoices")
     db.refresh(db_invoice)
     
     # Map dữ liệu để trả về đúng schema
@@ -601,41 +714,219 @@ def create_invoice(
         "total_amount": sub_total # Trả về tổng chưa giảm để frontend hiển thị
     }
 
+# --- API 13b: Chốt ca thu ngân - Xem trước / Thanh toán hàng loạt ---
+@app.post("/visits/bills/batch", response_model=schemas.BatchBillResponse)
+def batch_bills(
+    req: schemas.BatchBillRequest,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    # ✅ CHỈ ADMIN CÓ QUYỀN CHỐT CA / TẠO HÓA ĐƠN
+    if not req.visit_ids and not (req.from_date and req.to_date):
+        raise HTTPException(status_code=400, detail="Cần truyền visit_ids hoặc from_date/to_date")
+
+    # 1. Lấy các lượt khám đã khám xong, chưa thanh toán (COMPLETED)
+    query = db.query(models.Visit.visit_id).filter(models.Visit.status == 'COMPLETED')
+    if req.visit_ids:
+        query = query.filter(models.Visit.visit_id.in_(req.visit_ids))
+    if req.from_date and req.to_date:
+        query = query.filter(
+            models.Visit.visit_date >= req.from_date,
+            models.Visit.visit_date < req.to_date + timedelta(days=1)
+        )
+    visit_ids = [row.visit_id for row in query.order_by(models.Visit.visit_id).all()]
+
+    # 2. Tính tiền cả lô (đọc VisitCharges, 1 dòng / lượt khám)
+    bills = billing.visit_bills(db, visit_ids, req.insurance_percent)
+    items = [{"visit_id": vid, **bills[vid]} for vid in visit_ids]
+
+    # 3. (Tuỳ chọn) Lưu hóa đơn + dòng chi tiết cho tất cả trong 1 transaction
+    if req.create_invoices and visit_ids:
+        try:
+            lines = billing.visit_invoice_items(db, visit_ids, req.insurance_percent)
+            now = datetime.now()
+            for item in items:
+                invoice, bill = billing.build_invoice(
+                    db, item["visit_id"], lines[item["visit_id"]],
+                    req.insurance_percent, 0, req.payment_method, now
+                )
+                item.update(bill, invoice_id=invoice.invoice_id) # Số tiền đúng như hóa đơn đã lưu
+            db.query(models.Visit).filter(
+                models.Visit.visit_id.in_(visit_ids)
+            ).update({models.Visit.status: "PAID"}, synchronize_session=False)
+            db.commit()
+            cache.report_cache.invalidate("invoices")
+        except Exception as e:
+            db.rollback() # Hoàn tác cả lô nếu lỗi
+            raise HTTPException(status_code=500, detail=f"Lỗi tạo hóa đơn hàng loạt: {str(e)}")
+
+    return {
+        "visit_count": len(items),
+        "total_amount": sum(item["final_amount"] for item in items),
+        "bills": items
+    }
+
 # --- API BÁO CÁO (ADMIN) ---
 
-# 1. Doanh thu theo ngày (7 ngày gần nhất)
+# --- HELPER: Khoảng thời gian nửa mở [from_date 00:00, to_date + 1 ngày 00:00) ---
+# So sánh trực tiếp trên cột (không bọc func.date) để MySQL dùng được index
+def _day_range(from_date: date, to_date: date) -> tuple[datetime, datetime]:
+    return datetime.combine(from_date, time.min), datetime.combine(to_date + timedelta(days=1), time.min)
+
+# 1. Doanh thu theo ngày / tuần / tháng (đọc bảng tổng hợp DailyRevenue)
+# Không truyền khoảng ngày: 7 ngày gần nhất có phát sinh hóa đơn (như trước)
 @app.get("/reports/revenue", response_model=list[schemas.RevenueReport])
+@cache.cached(cache.report_cache, "invoices")
 def report_revenue(
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    granularity: Literal["day", "week", "month"] = "day",
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # ✅ CHỈ ADMIN CÓ QUYỀN XEM BÁOCÁO DOANH THU
-    # Query Group By Date(payment_time)
-    results = db.query(
-        func.date(models.Invoice.payment_time).label("date"),
-        func.sum(models.Invoice.final_amount).label("daily_revenue"),
-        func.count(models.Invoice.invoice_id).label("patient_count")
-    ).group_by(func.date(models.Invoice.payment_time))\
-     .order_by(desc("date")).limit(7).all()
-    
-    return results
+    query = db.query(
+        models.DailyRevenue.day,
+        func.sum(models.DailyRevenue.revenue).label("revenue"),
+        func.sum(models.DailyRevenue.invoice_count).label("invoice_count")
+    )
+    if from_date is None and to_date is None:
+        latest_days = [r.day for r in db.query(models.DailyRevenue.day).distinct()
+                       .order_by(desc(models.DailyRevenue.day)).limit(7).all()]
+        query = query.filter(models.DailyRevenue.day.in_(latest_days))
+    else:
+        if from_date:
+            query = query.filter(models.DailyRevenue.day >= from_date)
+        if to_date:
+            query = query.filter(models.DailyRevenue.day <= to_date)
+    rows = query.group_by(models.DailyRevenue.day).all()
+
+    # Gom theo kỳ (ngày / tuần / tháng) - số dòng nhỏ (tối đa 1 dòng / ngày)
+    periods = {}
+    for r in rows:
+        key = billing.period_start(r.day, granularity)
+        revenue, count = periods.get(key, (0.0, 0))
+        periods[key] = (revenue + float(r.revenue or 0), count + int(r.invoice_count or 0))
+
+    return [
+        {"date": key, "daily_revenue": revenue, "patient_count": count}
+        for key, (revenue, count) in sorted(periods.items(), reverse=True)
+    ]
 
-# 2. Top thuốc bán chạy
+# 2. Top thuốc bán chạy (đọc bảng tổng hợp DailyMedicineUsage, mặc định toàn thời gian)
 @app.get("/reports/top-medicines", response_model=list[schemas.TopMedicine])
+@cache.cached(cache.report_cache, "prescriptions", "medicines",
+              tables=(models.Medicine, models.Medicine.stock_quantity))
 def report_top_medicines(
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    limit: int = 5,
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # ✅ CHỈ ADMIN CÓ QUYỀN XEM BÁOCÁO TOP THUỐC
-    results = db.query(
+    query = db.query(
         models.Medicine.name,
-        func.sum(models.Prescription.quantity).label("sold_quantity"),
+        func.sum(models.DailyMedicineUsage.quantity).label("sold_quantity"),
         models.Medicine.stock_quantity
-    ).join(models.Prescription, models.Medicine.medicine_id == models.Prescription.medicine_id)\
-     .group_by(models.Medicine.medicine_id)\
-     .order_by(desc("sold_quantity")).limit(5).all()
+    ).join(models.DailyMedicineUsage, models.Medicine.medicine_id == models.DailyMedicineUsage.medicine_id)
+    if from_date:
+        query = query.filter(models.DailyMedicineUsage.day >= from_date)
+    if to_date:
+        query = query.filter(models.DailyMedicineUsage.day <= to_date)
+
+    results = query.group_by(models.Medicine.medicine_id)\
+     .order_by(desc("sold_quantity")).limit(limit).all()
      
-    return results
+    return [
+        {"name": r.name, "sold_quantity": int(r.sold_quantity or 0), "stock_quantity": r.stock_quantity}
+        for r in results
+    ]
+
+# 3. Doanh thu theo thuốc / loại dịch vụ / bác sĩ (quét 1 bảng InvoiceItems có index)
+def _invoice_items_in_range(query, from_date: date, to_date: date):
+    start, end = _day_range(from_date, to_date)
+    return query.filter(
+        models.InvoiceItem.payment_time >= start,
+        models.InvoiceItem.payment_time < end
+    )
+
+@app.get("/reports/revenue/medicines", response_model=list[schemas.RevenueByItem])
+@cache.cached(cache.report_cache, "invoices")
+def report_revenue_by_medicine(
+    from_date: date,
+    to_date: date,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    results = _invoice_items_in_range(db.query(
+        models.InvoiceItem.item_id,
+        func.max(models.InvoiceItem.item_name).label("item_name"),
+        func.sum(models.InvoiceItem.quantity).label("quantity"),
+        func.sum(models.InvoiceItem.amount).label("amount"),
+        func.sum(models.InvoiceItem.insurance_amount).label("insurance_amount")
+    ).filter(models.InvoiceItem.item_type == 'MEDICINE'), from_date, to_date)\
+     .group_by(models.InvoiceItem.item_id)\
+     .order_by(desc("amount")).all()
+
+    return [
+        {"item_id": r.item_id, "item_name": r.item_name, "quantity": r.quantity,
+         "amount": float(r.amount), "insurance_amount": float(r.insurance_amount)}
+        for r in results
+    ]
+
+@app.get("/reports/revenue/categories", response_model=list[schemas.RevenueByCategory])
+@cache.cached(cache.report_cache, "invoices")
+def report_revenue_by_category(
+    from_date: date,
+    to_date: date,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    results = _invoice_items_in_range(db.query(
+        models.InvoiceItem.item_type,
+        models.InvoiceItem.category,
+        func.sum(models.InvoiceItem.quantity).label("quantity"),
+        func.sum(models.InvoiceItem.amount).label("amount"),
+        func.sum(models.InvoiceItem.insurance_amount).label("insurance_amount")
+    ), from_date, to_date)\
+     .group_by(models.InvoiceItem.item_type, models.InvoiceItem.category)\
+     .order_by(desc("amount")).all()
+
+    return [
+        {"item_type": r.item_type, "category": r.category, "quantity": r.quantity,
+         "amount": float(r.amount), "insurance_amount": float(r.insurance_amount)}
+        for r in results
+    ]
+
+@app.get("/reports/revenue/doctors", response_model=list[schemas.RevenueByDoctor])
+@cache.cached(cache.report_cache, "invoices")
+def report_revenue_by_doctor(
+    from_date: date,
+    to_date: date,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    results = _invoice_items_in_range(db.query(
+        models.InvoiceItem.doctor_id,
+        func.count(func.distinct(models.InvoiceItem.visit_id)).label("visit_count"),
+        func.sum(models.InvoiceItem.amount).label("amount"),
+        func.sum(models.InvoiceItem.insurance_amount).label("insurance_amount")
+    ), from_date, to_date)\
+     .group_by(models.InvoiceItem.doctor_id)\
+     .order_by(desc("amount")).all()
+
+    # Map tên bác sĩ (chỉ vài chục dòng sau khi đã GROUP BY)
+    doctor_ids = [r.doctor_id for r in results if r.doctor_id]
+    names = dict(db.query(models.User.user_id, models.User.full_name).filter(
+        models.User.user_id.in_(doctor_ids)
+    ).all()) if doctor_ids else {}
+
+    return [
+        {"doctor_id": r.doctor_id, "doctor_name": names.get(r.doctor_id), "visit_count": r.visit_count,
+         "amount": float(r.amount), "insurance_amount": float(r.insurance_amount)}
+        for r in results
+    ]
 
 
 # --- API 14: Lấy lịch sử khám của bệnh nhân ---
@@ -660,7 +951,8 @@ def get_patient_history(
     return patient
 
 # --- API 15: Lấy danh sách bác sĩ ---
-@app.get("/users/doctors", response_model=list[schemas.UserResponse])
+@app.get("/users/doctors", response_model=list[schemas.UserResponse],
+         dependencies=[Depends(etags.conditional(models.User))])
 def get_doctors(db: Session = Depends(get_db)):
     return db.query(models.User).filter(models.User.role == 'DOCTOR').all()
 
@@ -679,6 +971,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],   # Cho phép tất cả các method (GET, POST, PUT...)
     allow_headers=["*"],   # Cho phép tất cả header
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag"], # Header phân trang / phiên bản cho frontend đọc được
+)
+
+# Nén gzip response lớn (danh mục, danh sách). Bỏ qua file xlsx / parquet vốn đã nén sẵn.
+from starlette.middleware.gzip import GZipMiddleware, DEFAULT_EXCLUDED_CONTENT_TYPES
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    compresslevel=6,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + (exports.MEDIA_TYPES["xlsx"], exports.MEDIA_TYPES["parquet"])
 )
 
 # main.py (Thêm các endpoints mới)
@@ -712,6 +1014,7 @@ def create_schedule(
     )
     db.add(new_sch)
     db.commit()
+    catalog.invalidate("schedules")
     db.refresh(new_sch)
     return new_sch
 
@@ -739,18 +1042,14 @@ def get_doctor_slots(
     target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
     day_idx = target_date.weekday() # 0-6
     
-    # 2. Lấy lịch làm việc của bác sĩ ngày đó
-    schedule = db.query(models.DoctorSchedule).filter(
-        models.DoctorSchedule.doctor_id == doctor_id,
-        models.DoctorSchedule.day_of_week == day_idx,
-        models.DoctorSchedule.is_active == True
-    ).first()
+    # 2. Lấy lịch làm việc của bác sĩ ngày đó (cache danh mục)
+    shift = catalog.doctor_shift(db, doctor_id, day_idx)
     
-    if not schedule:
+    if not shift:
         return {"message": "Bác sĩ không làm việc ngày này", "slots": []}
     
     # 3. Sinh tất cả các slot có thể
-    all_slots = generate_time_slots(schedule.shift_start, schedule.shift_end)
+    all_slots = generate_time_slots(*shift)
     
     # 4. Lấy các lịch đã được đặt (không tính Cancelled)
     booked_appts = db.query(models.Appointment).filter(
@@ -856,11 +1155,14 @@ def check_in_appointment(
         priority="NORMAL"
     )
     db.add(new_visit)
+    db.flush() # Lấy visit_id
+    billing.open_visit_charge(db, new_visit.visit_id)
     
     # 3. Cập nhật trạng thái Appointment -> COMPLETED
     appt.status = "COMPLETED"
     
     db.commit()
+    cache.report_cache.invalidate("visits")
     return {"message": "Đã check-in thành công. Bệnh nhân đã vào danh sách chờ khám."}
 
 @app.post("/appointments", response_model=schemas.AppointmentResponse)
@@ -927,7 +1229,8 @@ def create_appointment(
     return new_appt
 
 # --- API SERVICES 1: Lấy danh mục dịch vụ ---
-@app.get("/services", response_model=list[schemas.ServiceResponse])
+@app.get("/services", response_model=list[schemas.ServiceResponse],
+         dependencies=[Depends(etags.conditional(models.Service))])
 def get_services(db: Session = Depends(get_db)):
     return db.query(models.Service).filter(models.Service.is_active == True).all()
 
@@ -937,29 +1240,36 @@ def create_service_request(
     visit_id: int,
     req: schemas.ServiceRequestCreate,
     db: Session = Depends(get_db),
-    token: str = Depends(oauth2_scheme)
+    current_user: dict = Depends(security.get_current_user)
 ):
-    # Lấy doctor_id từ token (giả lập logic lấy user hiện tại)
-    # Trong thực tế bạn nên decode token để lấy user_id
-    # Ở đây tôi hardcode hoặc query tạm user DOCTOR đầu tiên để demo
-    current_user = db.query(models.User).filter(models.User.role == 'DOCTOR').first() 
-    doctor_id = current_user.user_id if current_user else 2
+    # Bác sĩ chỉ định = người gọi API (user_id trong token)
+    doctor_id = current_user["user_id"]
+
+    # Tên / giá đọc từ DB lúc chốt giá (cache danh mục có thể chưa thấy lần đổi giá vừa xong)
+    service = db.query(models.Service.name, models.Service.price).filter(models.Service.service_id == req.service_id).first()
+    if not service:
+        raise HTTPException(status_code=404, detail="Dịch vụ không tồn tại")
 
     new_req = models.ServiceRequest(
         visit_id=visit_id,
         service_id=req.service_id,
         doctor_id=doctor_id,
         quantity=req.quantity,
+        unit_price=service.price, # Chốt giá tại thời điểm chỉ định
         status="PENDING"
     )
     db.add(new_req)
+    # Cộng tiền dịch vụ vào tổng của lượt khám (cùng transaction)
+    billing.apply_visit_charge(db, visit_id, service_delta=req.quantity * new_req.unit_price)
+    billing.record_service_usage(db, new_req.created_at.date(),
+                                 (new_req.service_id, new_req.quantity, req.quantity * new_req.unit_price))
     db.commit()
+    cache.report_cache.invalidate("service_requests")
     db.refresh(new_req)
     
     # Map dữ liệu trả về
-    service = db.query(models.Service).get(req.service_id)
     new_req.service_name = service.name
-    new_req.price = service.price
+    new_req.price = new_req.unit_price
     return new_req
 
 # --- API SERVICES 3: Lấy danh sách chỉ định của 1 lượt khám (kèm kết quả) ---
@@ -970,20 +1280,27 @@ def get_visit_services(visit_id: int, db: Session = Depends(get_db)):
     # Map tên dịch vụ và kết quả vào response
     for req in requests:
         req.service_name = req.service.name
-        req.price = req.service.price
+        req.price = req.unit_price if req.unit_price is not None else req.service.price
         # req.result tự động load nhờ relationship
     return requests
 
 # --- API SERVICES 4: Kỹ thuật viên xem danh sách chờ (Queue) ---
 @app.get("/service-requests", response_model=list[schemas.ServiceRequestResponse])
-def get_pending_requests(status: str = "PENDING", db: Session = Depends(get_db)):
-    # Lấy các request theo trạng thái
-    reqs = db.query(models.ServiceRequest).filter(models.ServiceRequest.status == status).all()
+def get_pending_requests(
+    response: Response,
+    status: str = "PENDING",
+    page: pagination.PageParams = Depends(),
+    db: Session = Depends(get_db)
+):
+    # Lấy các request theo trạng thái (theo thứ tự chỉ định, từng trang)
+    query = db.query(models.ServiceRequest).options(joinedload(models.ServiceRequest.service))\
+        .filter(models.ServiceRequest.status == status)
+    reqs = pagination.paginate(query, page, response, [(models.ServiceRequest.request_id, False)])
     
     # Map thêm thông tin
     for req in reqs:
         req.service_name = req.service.name
-        req.price = req.service.price
+        req.price = req.unit_price if req.unit_price is not None else req.service.price
     return reqs
 
 # --- API SERVICES 5: Kỹ thuật viên trả kết quả ---
@@ -991,11 +1308,10 @@ def get_pending_requests(status: str = "PENDING", db: Session = Depends(get_db))
 def create_service_result(
     res: schemas.ServiceResultCreate,
     db: Session = Depends(get_db),
-    token: str = Depends(oauth2_scheme)
+    current_user: dict = Depends(security.get_current_user)
 ):
-    # Lấy technician_id (Giả lập logic)
-    current_user = db.query(models.User).filter(models.User.role == 'TECHNICIAN').first() 
-    tech_id = current_user.user_id if current_user else 3 # Fallback
+    # Kỹ thuật viên trả kết quả = người gọi API (user_id trong token)
+    tech_id = current_user["user_id"]
 
     # 1. Tạo kết quả
     new_result = models.ServiceResult(
@@ -1024,95 +1340,83 @@ def preview_bill(
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)
 ):
-    # 1. Tính tiền thuốc
-    prescriptions = db.query(models.Prescription).filter(models.Prescription.visit_id == visit_id).all()
-    medicine_total = 0
-    medicine_details = []
-    for pres in prescriptions:
-        med = db.query(models.Medicine).get(pres.medicine_id)
-        cost = pres.quantity * float(med.price)
-        medicine_total += cost
-        medicine_details.append({"name": med.name, "qty": pres.quantity, "price": med.price, "total": cost})
-
-    # 2. (MỚI) Tính tiền Dịch vụ CLS (Xét nghiệm/Chụp chiếu)
-    service_requests = db.query(models.ServiceRequest).filter(
-        models.ServiceRequest.visit_id == visit_id,
-        models.ServiceRequest.status != 'CANCELLED' # Chỉ tính cái chưa hủy
-    ).all()
-    
-    service_total = 0
-    service_details = []
-    for req in service_requests:
-        srv = req.service
-        cost = req.quantity * float(srv.price)
-        service_total += cost
-        service_details.append({"name": srv.name, "qty": req.quantity, "price": srv.price, "total": cost})
+    # 1. Tính tiền thuốc (1 query, tên thuốc từ cache danh mục)
+    medicine_details = billing.visit_medicine_lines(db, [visit_id])[visit_id]
+    medicine_total = sum(d["total"] for d in medicine_details)
+
+    # 2. (MỚI) Tính tiền Dịch vụ CLS (Xét nghiệm/Chụp chiếu) - chỉ tính cái chưa hủy
+    service_details = billing.visit_service_lines(db, [visit_id])[visit_id]
+    service_total = sum(d["total"] for d in service_details)
 
     # 3. Tổng hợp
     # procedure_fee (thủ thuật ngoài) có thể giữ hoặc bỏ, ở đây ta cộng dồn vào
-    sub_total = medicine_total + service_total + FIXED_EXAM_FEE + procedure_fee
-    discount = sub_total * (insurance_percent / 100)
-    final_amount = sub_total - discount
+    bill = billing.summarize_bill(medicine_total, service_total, insurance_percent, procedure_fee)
     
     return {
         "medicine_details": medicine_details,
         "service_details": service_details, # Trả thêm chi tiết dịch vụ
-        "medicine_total": medicine_total,
-        "service_total": service_total,     # Tổng tiền dịch vụ
-        "exam_fee": FIXED_EXAM_FEE,
-        "procedure_fee": procedure_fee,
-        "sub_total": sub_total,
-        "insurance_percent": insurance_percent,
-        "discount": discount,
-        "final_amount": final_amount
+        **bill
     }
     
 # --- API NỘI TRÚ 1: Lấy Sơ đồ giường (Bed Map) ---
-@app.get("/beds/map")
+@app.get("/beds/map", dependencies=[Depends(etags.conditional(models.Department, models.Room, models.Bed))])
 def get_bed_map(db: Session = Depends(get_db)):
-    # Logic: Lấy hết Departments -> Rooms -> Beds
+    # Logic: Departments -> Rooms lấy từ cache danh mục, Beds (trạng thái thay đổi liên tục) đọc 1 query
     # Để đơn giản hóa cho Frontend, ta trả về dạng Flat list hoặc Group by Dept
-    departments = db.query(models.Department).all()
+    beds_by_room = {}
+    for bed in db.query(models.Bed.bed_id, models.Bed.room_id, models.Bed.bed_number, models.Bed.status).order_by(models.Bed.bed_id):
+        beds_by_room.setdefault(bed.room_id, []).append(bed)
     result = []
-    
-    for dept in departments:
+
+    for dept in catalog.bed_layout(db):
         dept_beds = []
-        for room in dept.rooms:
-            for bed in room.beds:
+        for room in dept["rooms"]:
+            for bed in beds_by_room.get(room["room_id"], ()):
                 # Map thông tin để hiển thị
                 dept_beds.append({
                     "bed_id": bed.bed_id,
                     "bed_number": bed.bed_number,
                     "status": bed.status,
-                    "room_number": room.room_number,
-                    "type": room.type,
-                    "price": float(room.base_price)
+                    "room_number": room["room_number"],
+                    "type": room["type"],
+                    "price": float(room["base_price"])
                 })
         result.append({
-            "department_id": dept.department_id,
-            "department_name": dept.name,
+            "department_id": dept["department_id"],
+            "department_name": dept["department_name"],
             "beds": dept_beds
         })
     return result
 
+# --- HELPER: Bác sĩ điều trị khi nhập viện ---
+# Request chỉ định thì dùng; bỏ trống thì là bác sĩ đang đăng nhập (lấy từ token, không query).
+# Người nhập không phải bác sĩ (y tá, admin) thì bắt buộc chỉ định.
+def _treating_doctor_id(requested: Optional[int], current_user: dict) -> int:
+    if requested:
+        return requested
+    if current_user["role"] == "DOCTOR":
+        return current_user["user_id"]
+    raise HTTPException(status_code=400, detail="Vui lòng chọn bác sĩ điều trị (doctor_id)")
+
 # --- API NỘI TRÚ 2: Nhập viện (Admission) ---
 @app.post("/inpatients/admit", response_model=schemas.InpatientResponse)
 def admit_patient(
     adm: schemas.AdmissionCreate, 
     db: Session = Depends(get_db),
-    token: str = Depends(oauth2_scheme)
+    current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE"]))
 ):
+    treating_doctor_id = _treating_doctor_id(adm.doctor_id, current_user)
+
     # 1. Kiểm tra giường có trống không
     bed = db.query(models.Bed).filter(models.Bed.bed_id == adm.bed_id).first()
     if not bed or bed.status != 'AVAILABLE':
         raise HTTPException(status_code=400, detail="Giường không tồn tại hoặc đã có người nằm")
 
     # 2. Tạo hồ sơ nội trú
-    # (Lấy doctor từ token nếu cần, ở đây lấy từ request)
     new_record = models.InpatientRecord(
         patient_id=adm.patient_id,
-        treating_doctor_id=adm.treating_doctor_id or 2, # Default BS mẫu
-        initial_diagnosis=adm.initial_diagnosis,
+        treating_doctor_id=treating_doctor_id,
+        initial_diagnosis=f"{adm.admission_reason}. Chẩn đoán: {adm.diagnosis}",
         status='ACTIVE'
     )
     db.add(new_record)
@@ -1122,22 +1426,24 @@ def admit_patient(
     bed.status = 'OCCUPIED'
     
     # 4. Tạo phân bổ giường (BedAllocation)
-    room = db.query(models.Room).get(bed.room_id)
     new_alloc = models.BedAllocation(
         inpatient_id=new_record.inpatient_id,
         bed_id=bed.bed_id,
-        price_per_day=room.base_price # Lưu giá tại thời điểm nhập viện
+        price_per_day=billing.room_price(db, bed.room_id) # Lưu giá tại thời điểm nhập viện (đọc DB)
     )
     db.add(new_alloc)
     
     db.commit()
+    cache.report_cache.invalidate("inpatients")
     db.refresh(new_record)
     
     # Map response
     pt = db.query(models.Patient).get(adm.patient_id)
     return {
         "inpatient_id": new_record.inpatient_id,
+        "patient_id": new_record.patient_id,
         "patient_name": pt.full_name,
+        "bed_id": bed.bed_id,
         "bed_number": bed.bed_number,
         "status": new_record.status,
         "admission_date": new_record.admission_date
@@ -1178,6 +1484,7 @@ def discharge_patient(
     record.discharge_date = datetime.now()
     
     db.commit()
+    cache.report_cache.invalidate("inpatients")
     
     return {
         "message": "Xuất viện thành công",
@@ -1187,7 +1494,8 @@ def discharge_patient(
     
 
 # --- API KHO 1: CRUD Nhà cung cấp ---
-@app.get("/suppliers", response_model=List[schemas.SupplierBase]) # Sửa response model cho đúng list
+@app.get("/suppliers", response_model=List[schemas.SupplierBase], # Sửa response model cho đúng list
+         dependencies=[Depends(etags.conditional(models.Supplier))])
 def get_suppliers(db: Session = Depends(get_db)):
     return db.query(models.Supplier).all()
 
@@ -1263,6 +1571,8 @@ def confirm_import(
     # 3. Đổi trạng thái phiếu
     receipt.status = 'COMPLETED'
     db.commit()
+    cache.report_cache.invalidate("medicines")
+    catalog.invalidate("medicines")
     
     return {"message": "Đã nhập kho thành công, tồn kho đã được cập nhật"}
 
@@ -1346,6 +1656,7 @@ def update_patient(
     update_data = patient_update.dict(exclude_unset=True) # Chỉ lấy các trường user có gửi
     for key, value in update_data.items():
         setattr(db_patient, key, value)
+    patient_search.index_patient(db, db_patient)
 
     db.commit()
     db.refresh(db_patient)
@@ -1362,8 +1673,9 @@ def delete_patient(
     if not db_patient:
         raise HTTPException(status_code=404, detail="Bệnh nhân không tồn tại")
     
-    # Logic xóa mềm
+    # Logic xóa mềm (gỡ khỏi chỉ mục tìm kiếm)
     db_patient.is_active = False
+    patient_search.index_patient(db, db_patient)
     
     # Tùy chọn: Hủy các lịch hẹn tương lai của bệnh nhân này nếu cần
     # ...
@@ -1376,6 +1688,10 @@ def delete_patient(
 @app.get("/patients/{patient_id}/history-detail", response_model=List[schemas.VisitHistoryDetail])
 def get_patient_history_detail(
     patient_id: int, 
+    response: Response,
+    # Chọn phần cần lấy kèm mỗi lượt khám (VD: ?sections=prescriptions), phần bỏ qua trả về []
+    sections: str = "prescriptions,service_requests",
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme) # Ai có token hợp lệ đều xem được (hoặc giới hạn role)
 ):
@@ -1384,22 +1700,31 @@ def get_patient_history_detail(
     if not patient:
         raise HTTPException(status_code=404, detail="Bệnh nhân không tồn tại")
 
-    # 2. Query Visits kèm theo Prescriptions và ServiceRequests (Eager Loading)
-    # Sử dụng joinedload để tránh lỗi N+1 query
-    visits = db.query(models.Visit).options(
-        joinedload(models.Visit.prescriptions).joinedload(models.Prescription.medicine), # Load thuốc + tên thuốc
-        joinedload(models.Visit.service_requests).joinedload(models.ServiceRequest.service), # Load dịch vụ + tên
-        joinedload(models.Visit.service_requests).joinedload(models.ServiceRequest.result)   # Load kết quả
-    ).filter(
-        models.Visit.patient_id == patient_id
-    ).order_by(models.Visit.visit_date.desc()).all()
+    sections = {s.strip() for s in sections.split(",") if s.strip()}
+    invalid = sections - {"prescriptions", "service_requests"}
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Phần dữ liệu không hợp lệ: {', '.join(sorted(invalid))}")
+
+    # 2. Query Visits (mới nhất trước, theo từng trang) kèm theo Prescriptions và ServiceRequests
+    # Mỗi danh sách con load bằng 1 query riêng (selectinload ... WHERE visit_id IN (...)) thay cho
+    # joinedload cả 2 danh sách trong 1 SELECT (số dòng = thuốc x dịch vụ của mỗi lượt khám)
+    options = []
+    if "prescriptions" in sections:
+        options.append(selectinload(models.Visit.prescriptions).joinedload(models.Prescription.medicine)) # Load thuốc + tên thuốc
+    if "service_requests" in sections:
+        options.append(selectinload(models.Visit.service_requests).options(
+            joinedload(models.ServiceRequest.service), # Load dịch vụ + tên
+            joinedload(models.ServiceRequest.result)   # Load kết quả
+        ))
+    query = db.query(models.Visit).options(*options).filter(models.Visit.patient_id == patient_id)
+    visits = pagination.paginate(query, page, response, [(models.Visit.visit_date, True), (models.Visit.visit_id, True)])
 
     # 3. Map dữ liệu thủ công sang Schema (để đảm bảo cấu trúc đẹp nhất)
     result = []
     for v in visits:
         # Map Prescriptions
         pres_list = []
-        for p in v.prescriptions:
+        for p in (v.prescriptions if "prescriptions" in sections else []):
             # medicine relationship cần được định nghĩa trong model Prescription 
             # (Medicine = relationship("Medicine"))
             # Nếu chưa có relationship, bạn có thể phải query thủ công hoặc dùng joinedload như trên
@@ -1416,7 +1741,7 @@ def get_patient_history_detail(
 
         # Map Service Requests
         srv_list = []
-        for req in v.service_requests:
+        for req in (v.service_requests if "service_requests" in sections else []):
             srv_name = req.service.name if req.service else "Unknown Service"
             conclusion = req.result.conclusion if req.result else None
             srv_list.append({
@@ -1488,9 +1813,7 @@ def update_schedule(
     
     # Check quyền: Nếu là Doctor, chỉ được sửa lịch của chính mình
     if current_user['role'] == 'DOCTOR':
-        # Cần logic lấy user_id từ token thực tế. Giả sử current_user['sub'] là username
-        db_user = db.query(models.User).filter(models.User.username == current_user['sub']).first()
-        if db_user.user_id != schedule.doctor_id:
+        if current_user['user_id'] != schedule.doctor_id:
             raise HTTPException(status_code=403, detail="Không có quyền sửa lịch người khác")
 
     # Update dynamic
@@ -1506,6 +1829,7 @@ def update_schedule(
          raise HTTPException(status_code=400, detail="Giờ bắt đầu phải nhỏ hơn giờ kết thúc")
 
     db.commit()
+    catalog.invalidate("schedules")
     db.refresh(schedule)
     return schedule
 
@@ -1524,6 +1848,7 @@ def delete_schedule(
     
     db.delete(schedule)
     db.commit()
+    catalog.invalidate("schedules")
     return {"message": "Đã xóa lịch làm việc"}
 
 # --- MAIN.PY: MODULE QUẢN LÝ LỊCH HẸN (FULL CRUD) ---
@@ -1531,17 +1856,30 @@ def delete_schedule(
 # 1. Lấy danh sách (Có Filter & JoinedLoad)
 @app.get("/appointments", response_model=list[schemas.AppointmentDetailResponse])
 def get_appointments(
+    response: Response,
     doctor_id: Optional[int] = None,
     patient_id: Optional[int] = None,
     date_str: Optional[str] = None, # YYYY-MM-DD
     status: Optional[str] = None,
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE", "PATIENT"]))
 ):
-    query = db.query(models.Appointment).options(
-        joinedload(models.Appointment.patient),
-        joinedload(models.Appointment.doctor)
-    )
+    # Chỉ lấy các cột cần trả về (kèm tên bệnh nhân / bác sĩ qua join), không dựng đối tượng ORM
+    query = db.query(
+        models.Appointment.appointment_id,
+        models.Appointment.patient_id,
+        models.Appointment.doctor_id,
+        models.Appointment.appointment_date,
+        models.Appointment.start_time,
+        models.Appointment.end_time,
+        models.Appointment.status,
+        models.Appointment.reason,
+        func.coalesce(models.Patient.full_name, "Unknown").label("patient_full_name"),
+        func.coalesce(models.Patient.phone, "").label("patient_phone"),
+        func.coalesce(models.User.full_name, "Unknown").label("doctor_full_name")
+    ).outerjoin(models.Patient, models.Patient.patient_id == models.Appointment.patient_id
+    ).outerjoin(models.User, models.User.user_id == models.Appointment.doctor_id)
     
     # Filter logic
     if doctor_id:
@@ -1553,23 +1891,17 @@ def get_appointments(
     if status:
         query = query.filter(models.Appointment.status == status)
         
-    # Role Guard: Nếu là PATIENT, chỉ xem của mình (Logic giả định lấy ID từ token)
-    # if current_user['role'] == 'PATIENT':
-    #     user = db.query(models.User).filter(models.User.username == current_user['sub']).first()
-    #     # Tìm patient_id tương ứng... (cần query bảng Patients)
+    # Role Guard: Nếu là PATIENT, chỉ xem của mình (patient_id lấy từ token)
+    if current_user['role'] == 'PATIENT':
+        query = query.filter(models.Appointment.patient_id == current_user['patient_id'])
     
-    results = query.order_by(desc(models.Appointment.appointment_date)).all()
+    results = pagination.paginate(query, page, response, [
+        (models.Appointment.appointment_date, True),
+        (models.Appointment.appointment_id, True)
+    ])
     
-    # Map response
-    response = []
-    for appt in results:
-        item = schemas.AppointmentDetailResponse.from_orm(appt)
-        item.patient_full_name = appt.patient.full_name if appt.patient else "Unknown"
-        item.doctor_full_name = appt.doctor.full_name if appt.doctor else "Unknown"
-        item.patient_phone = appt.patient.phone if appt.patient else ""
-        response.append(item)
-        
-    return response
+    # Map response: các dòng đã đúng tên trường của schema -> ghi JSON trực tiếp
+    return projection.json_response(list[schemas.AppointmentDetailResponse], results, response)
 
 # 2. Xem chi tiết
 @app.get("/appointments/{appt_id}", response_model=schemas.AppointmentDetailResponse)
@@ -1693,25 +2025,39 @@ def update_service_request(
     if db_req.status != 'PENDING':
         raise HTTPException(status_code=400, detail="Không thể sửa yêu cầu đã thực hiện hoặc đã hủy")
 
+    # Giá trị cũ để điều chỉnh tổng tiền lượt khám
+    # (dòng cũ chưa backfill giá thì chốt theo giá danh mục hiện tại)
+    if db_req.unit_price is None:
+        db_req.unit_price = billing.service_price(db, db_req.service_id)
+    old_service_id, old_quantity = db_req.service_id, db_req.quantity
+    old_amount = db_req.quantity * db_req.unit_price
+
     # Cập nhật
     if req_update.service_id:
         # Check service tồn tại
-        svc = db.query(models.Service).get(req_update.service_id)
-        if not svc:
+        price = billing.service_price(db, req_update.service_id)
+        if price is None:
             raise HTTPException(status_code=404, detail="Dịch vụ mới không hợp lệ")
         db_req.service_id = req_update.service_id
+        db_req.unit_price = price # Đổi dịch vụ thì chốt theo giá mới
         
     if req_update.quantity:
         if req_update.quantity < 1:
              raise HTTPException(status_code=400, detail="Số lượng phải lớn hơn 0")
         db_req.quantity = req_update.quantity
 
+    new_amount = db_req.quantity * db_req.unit_price
+    billing.apply_visit_charge(db, db_req.visit_id, service_delta=new_amount - old_amount)
+    billing.record_service_usage(db, db_req.created_at.date(),
+                                 (old_service_id, -old_quantity, -old_amount),
+                                 (db_req.service_id, db_req.quantity, new_amount))
     db.commit()
+    cache.report_cache.invalidate("service_requests")
     db.refresh(db_req)
     
     # Map tên để trả về (vì response model cần service_name)
     db_req.service_name = db_req.service.name
-    db_req.price = db_req.service.price
+    db_req.price = db_req.unit_price
     return db_req
 
 # 2. Xóa chỉ định (Soft Delete -> CANCELLED)
@@ -1730,7 +2076,14 @@ def delete_service_request(
         raise HTTPException(status_code=400, detail="Chỉ có thể hủy các yêu cầu đang chờ")
         
     db_req.status = 'CANCELLED'
+    # Trừ tiền dịch vụ đã hủy khỏi tổng của lượt khám
+    if db_req.unit_price is None:
+        db_req.unit_price = billing.service_price(db, db_req.service_id)
+    billing.apply_visit_charge(db, db_req.visit_id, service_delta=-(db_req.quantity * db_req.unit_price))
+    billing.record_service_usage(db, db_req.created_at.date(),
+                                 (db_req.service_id, -db_req.quantity, -(db_req.quantity * db_req.unit_price)))
     db.commit()
+    cache.report_cache.invalidate("service_requests")
     return {"message": "Đã hủy yêu cầu dịch vụ"}
 
 
@@ -1743,11 +2096,25 @@ def get_patient_service_results(
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["DOCTOR", "ADMIN", "PATIENT", "TECHNICIAN"]))
 ):
-    # Role Guard cho Patient: Chỉ xem của mình (Logic giả định check ID)
-    # if current_user['role'] == 'PATIENT' and current_user['patient_id'] != patient_id: ...
-    
-    # Query: ServiceRequest (COMPLETED) -> Join Visit -> Join Service -> Join Result
-    query = db.query(models.ServiceRequest).join(models.Visit).join(models.Service).outerjoin(models.ServiceResult).filter(
+    # Role Guard cho Patient: Chỉ xem của mình
+    if current_user['role'] == 'PATIENT' and current_user['patient_id'] != patient_id:
+        raise HTTPException(status_code=403, detail="Không có quyền xem kết quả của bệnh nhân khác")
+    
+    # Query: ServiceRequest (COMPLETED) -> Join Visit -> Join Service -> Join Result -> Join KTV
+    # Lấy thẳng các cột của schema trong 1 query (không lazy load result / technician từng dòng)
+    query = db.query(
+        models.ServiceRequest.request_id,
+        models.Service.name.label("service_name"),
+        models.Service.type.label("service_type"),
+        models.ServiceResult.performed_at,
+        func.coalesce(models.User.full_name, "Unknown").label("technician_name"), # Tên kỹ thuật viên nếu có kết quả
+        models.ServiceResult.conclusion,
+        models.ServiceResult.image_url,
+        models.ServiceRequest.status
+    ).join(models.Visit, models.Visit.visit_id == models.ServiceRequest.visit_id
+    ).join(models.Service, models.Service.service_id == models.ServiceRequest.service_id
+    ).outerjoin(models.ServiceResult, models.ServiceResult.request_id == models.ServiceRequest.request_id
+    ).outerjoin(models.User, models.User.user_id == models.ServiceResult.technician_id).filter(
         models.Visit.patient_id == patient_id,
         models.ServiceRequest.status == 'COMPLETED' # Chỉ lấy cái đã có kết quả
     )
@@ -1756,26 +2123,7 @@ def get_patient_service_results(
         query = query.filter(models.Service.type == service_type)
         
     results = query.order_by(desc(models.ServiceRequest.created_at)).all()
-    
-    # Map data thủ công sang Schema
-    response = []
-    for req in results:
-        # Lấy tên kỹ thuật viên nếu có kết quả
-        tech_name = req.result.technician.full_name if (req.result and req.result.technician) else "Unknown"
-        
-        item = schemas.PatientServiceHistoryItem(
-            request_id=req.request_id,
-            service_name=req.service.name,
-            service_type=req.service.type,
-            performed_at=req.result.performed_at if req.result else None,
-            technician_name=tech_name,
-            conclusion=req.result.conclusion if req.result else None,
-            image_url=req.result.image_url if req.result else None,
-            status=req.status
-        )
-        response.append(item)
-        
-    return response
+    return projection.json_response(list[schemas.PatientServiceHistoryItem], results)
 
 
 # C. API BÁO CÁO & IN KẾT QUẢ (PRINT VIEW)
@@ -1817,7 +2165,7 @@ def get_service_report(
         doctor_name=doctor.full_name if doctor else "Unknown Doctor",
         visit_date=visit.visit_date,
         service_name=service.name,
-        service_price=float(service.price),
+        service_price=float(req.unit_price if req.unit_price is not None else service.price),
         
         # Result Info
         technician_name=technician.full_name if technician else "Unknown Technician",
@@ -1837,14 +2185,20 @@ def get_service_report(
 # 1. Lấy danh sách nội trú (Filter theo khoa hoặc trạng thái)
 @app.get("/inpatients", response_model=list[schemas.InpatientResponse])
 def get_inpatients(
+    response: Response,
     status: Optional[str] = None, # 'ACTIVE'
     department_id: Optional[int] = None,
+    page: pagination.PageParams = Depends(),
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE"]))
 ):
-    query = db.query(models.InpatientRecord).join(models.Patient).options(
-        joinedload(models.InpatientRecord.patient)
-    )
+    query = db.query(
+        models.InpatientRecord.inpatient_id,
+        models.InpatientRecord.patient_id,
+        models.Patient.full_name.label("patient_name"),
+        models.InpatientRecord.status,
+        models.InpatientRecord.admission_date
+    ).join(models.Patient, models.Patient.patient_id == models.InpatientRecord.patient_id)
     
     if status:
         query = query.filter(models.InpatientRecord.status == status)
@@ -1857,39 +2211,40 @@ def get_inpatients(
             models.BedAllocation.check_out_time == None # Chỉ tính giường đang nằm
         )
 
-    results = query.order_by(desc(models.InpatientRecord.admission_date)).all()
+    results = pagination.paginate(query, page, response, [
+        (models.InpatientRecord.admission_date, True),
+        (models.InpatientRecord.inpatient_id, True)
+    ])
+    
+    # Giường hiện tại của cả trang: 1 query
+    current_beds = {row.inpatient_id: row for row in db.query(
+        models.BedAllocation.inpatient_id,
+        models.BedAllocation.bed_id,
+        models.Bed.bed_number
+    ).join(models.Bed, models.Bed.bed_id == models.BedAllocation.bed_id).filter(
+        models.BedAllocation.inpatient_id.in_([r.inpatient_id for r in results]),
+        models.BedAllocation.check_out_time == None
+    )} if results else {}
     
-    # Map data
-    response = []
+    # Map data (dict thay vì dựng từng đối tượng Pydantic)
+    items = []
     for r in results:
         # Tìm giường hiện tại
-        current_alloc = db.query(models.BedAllocation).filter(
-            models.BedAllocation.inpatient_id == r.inpatient_id,
-            models.BedAllocation.check_out_time == None
-        ).join(models.Bed).first()
-        
-        bed_num = current_alloc.bed.bed_number if current_alloc else "Chờ xếp giường"
-        bed_id_val = current_alloc.bed_id if current_alloc else None
-        
-        # Tạo dict thay vì dùng from_orm
-        item = schemas.InpatientResponse(
-            inpatient_id=r.inpatient_id,
-            patient_id=r.patient_id,
-            patient_name=r.patient.full_name,
-            bed_id=bed_id_val,
-            bed_number=bed_num,
-            status=r.status,
-            admission_date=r.admission_date
-        )
-        response.append(item)
+        current_bed = current_beds.get(r.inpatient_id)
+        items.append({
+            **r._mapping,
+            "bed_id": current_bed.bed_id if current_bed else None,
+            "bed_number": current_bed.bed_number if current_bed else "Chờ xếp giường"
+        })
         
-    return response
+    return projection.json_response(list[schemas.InpatientResponse], items, response)
 
 # ====== ENDPOINT: Lấy danh sách bác sĩ ======
 @app.get("/doctors")
 def get_doctors(
     db: Session = Depends(get_db),
-    current_user: dict = Depends(security.get_current_user)
+    current_user: dict = Depends(security.get_current_user),
+    _etag: None = Depends(etags.conditional(models.User))
 ):
     """Lấy danh sách tất cả bác sĩ trong hệ thống"""
     doctors = db.query(models.User).filter(models.User.role == 'DOCTOR').all()
@@ -1908,7 +2263,7 @@ def create_inpatient(
     - bed_id: ID giường
     - admission_reason: Lý do nhập viện
     - diagnosis: Chẩn đoán ban đầu
-    - doctor_id: ID bác sĩ điều trị
+    - doctor_id: ID bác sĩ điều trị (bỏ trống: bác sĩ đang đăng nhập)
     """
     # Kiểm tra bệnh nhân tồn tại
     patient = db.query(models.Patient).get(data.patient_id)
@@ -1931,7 +2286,7 @@ def create_inpatient(
     # Tạo InpatientRecord
     new_record = models.InpatientRecord(
         patient_id=data.patient_id,
-        treating_doctor_id=data.doctor_id,
+        treating_doctor_id=_treating_doctor_id(data.doctor_id, current_user),
         admission_date=datetime.now(),
         initial_diagnosis=f"{data.admission_reason}. Chẩn đoán: {data.diagnosis}",  # Combine vào initial_diagnosis
         status='ACTIVE'
@@ -1953,6 +2308,7 @@ def create_inpatient(
     bed.status = 'OCCUPIED'
     
     db.commit()
+    cache.report_cache.invalidate("inpatients")
     db.refresh(new_record)
     
     return {
@@ -1966,58 +2322,41 @@ def create_inpatient(
 @app.get("/inpatients/{inpatient_id}", response_model=schemas.InpatientDetailResponse)
 def get_inpatient_detail(inpatient_id: int, db: Session = Depends(get_db)):
     record = db.query(models.InpatientRecord).options(
-        joinedload(models.InpatientRecord.patient),
-        joinedload(models.InpatientRecord.allocations).joinedload(models.BedAllocation.bed),
-        joinedload(models.InpatientRecord.daily_orders)
+        joinedload(models.InpatientRecord.patient)
     ).filter(models.InpatientRecord.inpatient_id == inpatient_id).first()
     
     if not record:
         raise HTTPException(status_code=404, detail="Hồ sơ không tồn tại")
     
-    # Get current bed allocation
-    current_alloc = db.query(models.BedAllocation).filter(
-        models.BedAllocation.inpatient_id == inpatient_id,
-        models.BedAllocation.check_out_time == None
-    ).first()
-    
-    bed_id = current_alloc.bed_id if current_alloc else None
-    bed_number = current_alloc.bed.bed_number if current_alloc and current_alloc.bed else None
-    
     # Lấy tên bác sĩ điều trị
-    doc = db.query(models.User).get(record.treating_doctor_id)
-    
-    # Manually construct response with all required fields
-    resp = schemas.InpatientDetailResponse(
-        inpatient_id=record.inpatient_id,
-        patient_id=record.patient_id,
-        patient_name=record.patient.full_name,
-        bed_id=bed_id,
-        bed_number=bed_number,
-        status=record.status,
-        admission_date=record.admission_date,
-        treating_doctor_name=doc.full_name if doc else "Unknown",
-        daily_orders=[],
-        bed_history=[],
-        current_bed_fee=0.0
-    )
+    doctor_name = db.query(models.User.full_name).filter(models.User.user_id == record.treating_doctor_id).scalar()
 
-    # 1. Get Daily Orders
-    orders = db.query(models.DailyOrder).filter(
+    # 1. Get Daily Orders (kèm tên bác sĩ ra y lệnh trong cùng query)
+    orders = db.query(models.DailyOrder).options(joinedload(models.DailyOrder.doctor)).filter(
         models.DailyOrder.inpatient_id == inpatient_id
     ).order_by(desc(models.DailyOrder.date)).all()
     
     order_list = []
     for o in orders:
-        od = schemas.DailyOrderResponse.from_orm(o)
-        od.doctor_name = o.doctor.full_name if o.doctor else "Unknown"
-        order_list.append(od)
-    resp.daily_orders = order_list
+        order_list.append({
+            "order_id": o.order_id,
+            "doctor_id": o.doctor_id,
+            "date": o.date,
+            "progress_note": o.progress_note,
+            "doctor_instruction": o.doctor_instruction,
+            "nurse_notes": o.nurse_notes,
+            "vitals": o.vitals,
+            "doctor_name": o.doctor.full_name if o.doctor else "Unknown"
+        })
 
-    # 2. Get Bed History & Calculate Fee
-    allocs = db.query(models.BedAllocation).filter(
+    # 2. Get Bed History & Calculate Fee (giường + phòng load cùng lúc, giường hiện tại = dòng chưa check-out)
+    allocs = db.query(models.BedAllocation).options(
+        joinedload(models.BedAllocation.bed).joinedload(models.Bed.room)
+    ).filter(
         models.BedAllocation.inpatient_id == inpatient_id
     ).order_by(models.BedAllocation.check_in_time).all()
     
+    current_alloc = next((a for a in allocs if a.check_out_time is None), None)
     bed_hist = []
     total_bed_fee = 0
     now = datetime.now()
@@ -2034,23 +2373,30 @@ def get_inpatient_detail(inpatient_id: int, db: Session = Depends(get_db)):
         fee = days * float(a.price_per_day)
         total_bed_fee += fee
         
-        # Get room info
-        bed = db.query(models.Bed).options(joinedload(models.Bed.room)).get(a.bed_id)
-        
-        bed_hist.append(schemas.BedAllocationResponse(
-            allocation_id=a.allocation_id,
-            bed_number=bed.bed_number,
-            room_number=bed.room.room_number,
-            check_in_time=a.check_in_time,
-            check_out_time=a.check_out_time,
-            price_per_day=a.price_per_day,
-            total_price=fee
-        ))
+        bed_hist.append({
+            "allocation_id": a.allocation_id,
+            "bed_number": a.bed.bed_number,
+            "room_number": a.bed.room.room_number,
+            "check_in_time": a.check_in_time,
+            "check_out_time": a.check_out_time,
+            "price_per_day": a.price_per_day,
+            "total_price": fee
+        })
         
-    resp.bed_history = bed_hist
-    resp.current_bed_fee = total_bed_fee
-    
-    return resp
+    # Ghép response (validate + ghi JSON 1 lần)
+    return projection.json_response(schemas.InpatientDetailResponse, {
+        "inpatient_id": record.inpatient_id,
+        "patient_id": record.patient_id,
+        "patient_name": record.patient.full_name,
+        "bed_id": current_alloc.bed_id if current_alloc else None,
+        "bed_number": current_alloc.bed.bed_number if current_alloc and current_alloc.bed else None,
+        "status": record.status,
+        "admission_date": record.admission_date,
+        "treating_doctor_name": doctor_name or "Unknown",
+        "daily_orders": order_list,
+        "bed_history": bed_hist,
+        "current_bed_fee": total_bed_fee
+    })
 
 # 3. Cập nhật trạng thái nhanh
 @app.patch("/inpatients/{inpatient_id}/status")
@@ -2069,6 +2415,7 @@ def update_inpatient_status(
         rec.treating_doctor_id = status_update.treating_doctor_id
         
     db.commit()
+    cache.report_cache.invalidate("inpatients")
     return {"message": "Đã cập nhật trạng thái"}
 
 
@@ -2079,12 +2426,9 @@ def create_daily_order(
     inpatient_id: int,
     order: schemas.DailyOrderCreate,
     db: Session = Depends(get_db),
-    # Giả sử token có chứa user_id (Bác sĩ/Y tá)
-    token: str = Depends(oauth2_scheme) 
+    current_user: dict = Depends(security.get_current_user) # Bác sĩ / Y tá ghi diễn tiến
 ):
-    # Decode token lấy doctor_id (Logic giả lập)
-    # user_id = decode_token(token)['sub'] ...
-    current_doctor_id = 2 # Hardcode for demo
+    current_doctor_id = current_user["user_id"]
     
     new_order = models.DailyOrder(
         inpatient_id=inpatient_id,
@@ -2135,12 +2479,11 @@ def transfer_bed(
         old_bed.status = 'AVAILABLE' 
         
         # 4. Checkin giường mới
-        new_room = db.query(models.Room).get(new_bed.room_id)
         new_alloc = models.BedAllocation(
             inpatient_id=inpatient_id,
             bed_id=new_bed.bed_id,
             check_in_time=now,
-            price_per_day=new_room.base_price # Lấy giá của phòng mới
+            price_per_day=billing.room_price(db, new_bed.room_id) # Lấy giá của phòng mới (đọc DB)
         )
         db.add(new_alloc)
         
@@ -2148,6 +2491,7 @@ def transfer_bed(
         new_bed.status = 'OCCUPIED'
         
         db.commit() # Commit tất cả cùng lúc
+        cache.report_cache.invalidate("inpatients")
         return {"message": f"Đã chuyển sang giường {new_bed.bed_number}"}
         
     except Exception as e:
@@ -2166,57 +2510,18 @@ def preview_inpatient_billing(
     record = db.query(models.InpatientRecord).get(inpatient_id)
     if not record: raise HTTPException(status_code=404)
     
-    # 1. TÍNH TIỀN GIƯỜNG (Lặp lại logic ở trên hoặc tách hàm)
-    allocs = db.query(models.BedAllocation).filter(models.BedAllocation.inpatient_id == inpatient_id).all()
-    bed_total = 0
-    bed_details = []
     now = datetime.now()
-    
-    for a in allocs:
-        end = a.check_out_time if a.check_out_time else now
-        days = max(1, (end - a.check_in_time).days + (1 if (end - a.check_in_time).seconds > 0 else 0))
-        cost = days * float(a.price_per_day)
-        bed_total += cost
-        
-        bed_obj = db.query(models.Bed).get(a.bed_id)
-        bed_details.append({
-            "bed": bed_obj.bed_number,
-            "days": days,
-            "price": float(a.price_per_day),
-            "total": cost
-        })
+
+    # 1. TÍNH TIỀN GIƯỜNG (1 query JOIN Beds)
+    bed_details = billing.stay_bed_lines(db, [inpatient_id], now)[inpatient_id]
+    bed_total = sum(b["total"] for b in bed_details)
 
     # 2. TÍNH TIỀN THUỐC & DỊCH VỤ
-    # Logic: Tìm các Visits trong khoảng thời gian nằm viện
-    # Giả sử InpatientRecord không link trực tiếp Visit, ta query Visit theo time range
-    discharge_time = record.discharge_date if record.discharge_date else now
-    
-    visits = db.query(models.Visit).filter(
-        models.Visit.patient_id == record.patient_id,
-        models.Visit.visit_date >= record.admission_date,
-        models.Visit.visit_date <= discharge_time
-    ).all()
-    
-    med_total = 0
-    med_details = []
-    srv_total = 0
-    srv_details = []
-    
-    for v in visits:
-        # Thuốc
-        for p in v.prescriptions:
-            med = db.query(models.Medicine).get(p.medicine_id)
-            cost = p.quantity * float(med.price)
-            med_total += cost
-            med_details.append({"name": med.name, "qty": p.quantity, "total": cost})
-            
-        # Dịch vụ
-        for req in v.service_requests:
-            if req.status != 'CANCELLED':
-                srv = req.service
-                cost = req.quantity * float(srv.price)
-                srv_total += cost
-                srv_details.append({"name": srv.name, "qty": req.quantity, "total": cost})
+    # Logic: Các Visits của bệnh nhân trong khoảng thời gian nằm viện (JOIN theo time range)
+    med_details = billing.stay_medicine_lines(db, [inpatient_id], now)[inpatient_id]
+    med_total = sum(m["total"] for m in med_details)
+    srv_details = billing.stay_service_lines(db, [inpatient_id], now)[inpatient_id]
+    srv_total = sum(s["total"] for s in srv_details)
 
     return {
         "inpatient_id": inpatient_id,
@@ -2232,6 +2537,7 @@ def preview_inpatient_billing(
     }
 
 @app.get("/reports/doctors-performance", response_model=list[schemas.DoctorPerformanceReport])
+@cache.cached(cache.report_cache, "visits", "service_requests", tables=(models.User,))
 def report_doctor_performance(
     from_date: date,
     to_date: date,
@@ -2242,71 +2548,70 @@ def report_doctor_performance(
     # Tính tổng số ca khám (visits)
     # Tính tổng tiền dịch vụ (service_requests)
     
+    start, end = _day_range(from_date, to_date)
+
     # 1. Thống kê Visits
     visits_sub = db.query(
         models.Visit.doctor_id,
         func.count(models.Visit.visit_id).label("visit_count")
     ).filter(
-        func.date(models.Visit.visit_date) >= from_date,
-        func.date(models.Visit.visit_date) <= to_date
+        models.Visit.visit_date >= start,
+        models.Visit.visit_date < end
     ).group_by(models.Visit.doctor_id).subquery()
 
     # 2. Thống kê Revenue từ Service Requests
     revenue_sub = db.query(
         models.ServiceRequest.doctor_id,
-        func.sum(models.ServiceRequest.quantity * models.Service.price).label("service_rev")
-    ).join(models.Service).join(models.Visit).filter(
-        func.date(models.Visit.visit_date) >= from_date,
-        func.date(models.Visit.visit_date) <= to_date,
+        func.sum(models.ServiceRequest.quantity * billing.service_line_price()).label("service_rev")
+    ).join(models.Visit
+    ).outerjoin(models.Service, models.Service.service_id == models.ServiceRequest.service_id).filter(
+        models.Visit.visit_date >= start,
+        models.Visit.visit_date < end,
         models.ServiceRequest.status != 'CANCELLED'
     ).group_by(models.ServiceRequest.doctor_id).subquery()
 
-    # 3. Tổng hợp
-    doctors = db.query(models.User).filter(models.User.role == 'DOCTOR').all()
+    # 3. Tổng hợp: 1 query duy nhất, LEFT JOIN 2 subquery theo doctor_id
+    # (bác sĩ không có ca khám / doanh thu vẫn hiện với giá trị 0)
+    rows = db.query(
+        models.User.user_id,
+        models.User.full_name,
+        func.coalesce(visits_sub.c.visit_count, 0).label("visit_count"),
+        func.coalesce(revenue_sub.c.service_rev, 0).label("service_rev")
+    ).outerjoin(visits_sub, visits_sub.c.doctor_id == models.User.user_id)\
+     .outerjoin(revenue_sub, revenue_sub.c.doctor_id == models.User.user_id)\
+     .filter(models.User.role == 'DOCTOR')\
+     .order_by(models.User.user_id).all()
     
-    result = []
-    # Query phụ để map dữ liệu (hoặc dùng Outer Join phức tạp hơn)
-    # Ở đây dùng loop đơn giản vì số lượng bác sĩ không quá lớn
-    for doc in doctors:
-        v_count = 0
-        s_rev = 0
-        
-        # Check visit count
-        v_data = db.query(visits_sub).filter(visits_sub.c.doctor_id == doc.user_id).first()
-        if v_data: v_count = v_data.visit_count
-        
-        # Check revenue
-        r_data = db.query(revenue_sub).filter(revenue_sub.c.doctor_id == doc.user_id).first()
-        if r_data: s_rev = r_data.service_rev or 0
-
-        result.append({
-            "doctor_id": doc.user_id,
-            "doctor_name": doc.full_name,
-            "total_visits": v_count,
-            "total_service_revenue": float(s_rev)
-        })
-        
-    return result
+    return [
+        {
+            "doctor_id": r.user_id,
+            "doctor_name": r.full_name,
+            "total_visits": r.visit_count,
+            "total_service_revenue": float(r.service_rev)
+        } for r in rows
+    ]
 
 # B. BÁO CÁO SỬ DỤNG DỊCH VỤ
 @app.get("/reports/services-usage", response_model=list[schemas.ServiceUsageReport])
+@cache.cached(cache.report_cache, "service_requests", tables=(models.Service,))
 def report_service_usage(
     from_date: date,
     to_date: date,
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
+    # Đọc bảng tổng hợp DailyServiceUsage (đã bỏ CANCELLED, tính theo ngày chỉ định)
     results = db.query(
         models.Service.service_id,
         models.Service.name,
         models.Service.type.label("category"),
-        func.sum(models.ServiceRequest.quantity).label("usage_count"),
-        func.sum(models.ServiceRequest.quantity * models.Service.price).label("total_revenue")
-    ).join(models.ServiceRequest).filter(
-        func.date(models.ServiceRequest.created_at) >= from_date,
-        func.date(models.ServiceRequest.created_at) <= to_date,
-        models.ServiceRequest.status != 'CANCELLED'
-    ).group_by(models.Service.service_id).all()
+        func.sum(models.DailyServiceUsage.usage_count).label("usage_count"),
+        func.sum(models.DailyServiceUsage.revenue).label("total_revenue")
+    ).join(models.DailyServiceUsage, models.DailyServiceUsage.service_id == models.Service.service_id).filter(
+        models.DailyServiceUsage.day >= from_date,
+        models.DailyServiceUsage.day <= to_date
+    ).group_by(models.Service.service_id)\
+     .having(func.sum(models.DailyServiceUsage.usage_count) > 0).all()
     
     return [
         {
@@ -2320,6 +2625,7 @@ def report_service_usage(
 
 # C. BÁO CÁO HIỆN TRẠNG NỘI TRÚ (CENSUS)
 @app.get("/reports/inpatients/census", response_model=list[schemas.InpatientCensusReport])
+@cache.cached(cache.report_cache, "inpatients", tables=(models.Department, models.Room, models.Bed))
 def report_inpatient_census(
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN", "DOCTOR", "NURSE"]))
@@ -2350,111 +2656,233 @@ def report_inpatient_census(
 
 # D. BÁO CÁO CHI PHÍ NỘI TRÚ (Đã xuất viện)
 @app.get("/reports/inpatients/costs", response_model=list[schemas.InpatientCostReport])
+@cache.cached(cache.report_cache, "inpatients", "prescriptions", "service_requests")
 def report_inpatient_costs(
     from_date: date,
     to_date: date,
     db: Session = Depends(get_db),
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
-    # Lấy danh sách BN đã xuất viện trong khoảng thời gian
-    records = db.query(models.InpatientRecord).filter(
-        models.InpatientRecord.status == 'DISCHARGED',
-        func.date(models.InpatientRecord.discharge_date) >= from_date,
-        func.date(models.InpatientRecord.discharge_date) <= to_date
-    ).all()
-    
-    result = []
-    for rec in records:
-        # Tái sử dụng logic tính tiền (Có thể tách hàm common để tối ưu code)
-        # 1. Tiền giường
-        allocs = db.query(models.BedAllocation).filter(models.BedAllocation.inpatient_id == rec.inpatient_id).all()
-        bed_fee = 0
-        for a in allocs:
-            if a.check_out_time and a.check_in_time:
-                days = max(1, (a.check_out_time - a.check_in_time).days + 1) # Simple logic
-                bed_fee += days * float(a.price_per_day)
-        
-        # 2. Tiền thuốc & DV (Query Visits trong khoảng thời gian nằm viện)
-        visits = db.query(models.Visit).filter(
-            models.Visit.patient_id == rec.patient_id,
-            models.Visit.visit_date >= rec.admission_date,
-            models.Visit.visit_date <= rec.discharge_date
-        ).all()
-        
-        med_fee = 0
-        srv_fee = 0
-        for v in visits:
-            for p in v.prescriptions:
-                med = db.query(models.Medicine).get(p.medicine_id)
-                med_fee += p.quantity * float(med.price)
-            for req in v.service_requests:
-                if req.status != 'CANCELLED':
-                    srv = req.service
-                    srv_fee += req.quantity * float(srv.price)
-        
-        result.append({
-            "inpatient_id": rec.inpatient_id,
-            "patient_name": rec.patient.full_name,
-            "admission_date": rec.admission_date.date(),
-            "discharge_date": rec.discharge_date.date(),
-            "bed_fee": bed_fee,
-            "service_fee": srv_fee,
-            "medicine_fee": med_fee,
-            "total_cost": bed_fee + srv_fee + med_fee
-        })
-        
-    return result
+    # Hồ sơ đã xuất viện trong khoảng thời gian, tính theo từng khối (vài query / khối)
+    return list(billing.inpatient_cost_rows(db, from_date, to_date))
+
+# E. XUẤT BÁO CÁO RA FILE (xlsx / csv / parquet, CHUNG CHO CÁC LOẠI BÁO CÁO)
+# Dòng được lấy dần từ DB và ghi ra theo từng khối -> RAM không tăng theo độ dài khoảng thời gian
+EXPORT_REPORTS = {
+    'doctors': schemas.DoctorPerformanceReport,
+    'services': schemas.ServiceUsageReport,
+    'inpatients_cost': schemas.InpatientCostReport,
+    'revenue': schemas.RevenueReport,
+    'top_medicines': schemas.TopMedicine,
+}
+# Tên sheet khi gộp nhiều báo cáo vào 1 workbook (Excel giới hạn 31 ký tự)
+EXPORT_SHEET_TITLES = {
+    'doctors': "Hiệu suất bác sĩ",
+    'services': "Sử dụng dịch vụ",
+    'inpatients_cost': "Chi phí nội trú",
+    'revenue': "Doanh thu",
+    'top_medicines': "Top thuốc",
+}
+
+# Session riêng: generator còn chạy sau khi endpoint return (lúc đang gửi response)
+def _export_rows(report_type: str, f_date: date, t_date: date, current_user: dict):
+    db = database.SessionLocal()
+    try:
+        if report_type == 'doctors':
+            yield from report_doctor_performance(f_date, t_date, db, current_user)
+        elif report_type == 'services':
+            yield from report_service_usage(f_date, t_date, db, current_user)
+        elif report_type == 'revenue':
+            yield from report_revenue(from_date=f_date, to_date=t_date, db=db, current_user=current_user)
+        elif report_type == 'top_medicines':
+            yield from report_top_medicines(from_date=f_date, to_date=t_date, db=db, current_user=current_user)
+        else:
+            yield from billing.inpatient_cost_rows(db, f_date, t_date)
+    finally:
+        db.close()
 
-# E. XUẤT EXCEL (CHUNG CHO CÁC LOẠI BÁO CÁO)
 @app.get("/reports/export")
 def export_report_excel(
-    report_type: str, # 'doctors', 'services', 'inpatients_cost'
+    report_type: str, # 'doctors', 'services', 'inpatients_cost', 'revenue', 'top_medicines'
     from_date: str,   # YYYY-MM-DD
     to_date: str,     # YYYY-MM-DD
-    db: Session = Depends(get_db),
+    format: Literal["xlsx", "csv", "parquet"] = "xlsx",
     current_user: dict = Depends(security.check_role(["ADMIN"]))
 ):
     # Parse date
     f_date = datetime.strptime(from_date, "%Y-%m-%d").date()
     t_date = datetime.strptime(to_date, "%Y-%m-%d").date()
-    
-    data = []
-    filename = f"report_{report_type}_{from_date}_{to_date}.xlsx"
-    
-    # 1. Gọi logic lấy dữ liệu tương ứng (Tái sử dụng code hoặc gọi hàm)
-    if report_type == 'doctors':
-        # Gọi lại logic của report_doctor_performance
-        raw_data = report_doctor_performance(f_date, t_date, db, current_user)
-        # raw_data đã là list of dict, không cần convert
-        data = raw_data if isinstance(raw_data[0], dict) else [item.dict() for item in raw_data]
-        
-    elif report_type == 'services':
-        raw_data = report_service_usage(f_date, t_date, db, current_user)
-        data = raw_data if isinstance(raw_data[0], dict) else [item.dict() for item in raw_data]
-        
-    elif report_type == 'inpatients_cost':
-        raw_data = report_inpatient_costs(f_date, t_date, db, current_user)
-        data = raw_data if isinstance(raw_data[0], dict) else [item.dict() for item in raw_data]
-        
-    else:
+
+    # 1. Kiểm tra trước khi bắt đầu gửi file
+    model = EXPORT_REPORTS.get(report_type)
+    if model is None:
         raise HTTPException(status_code=400, detail="Loại báo cáo không hợp lệ")
+    if not exports.is_available(format):
+        raise HTTPException(status_code=400, detail=f"Máy chủ chưa hỗ trợ định dạng {format} (cần cài pyarrow)")
 
-    # 2. Tạo DataFrame và Excel File
-    df = pd.DataFrame(data)
-    
-    # Tạo Buffer trong bộ nhớ
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name="Report")
-    
-    output.seek(0)
-    
-    # 3. Trả về StreamingResponse
+    # 2. Trả về StreamingResponse: ghi file theo từng khối dòng
+    filename = f"report_{report_type}_{from_date}_{to_date}.{format}"
     headers = {
         'Content-Disposition': f'attachment; filename="{filename}"'
     }
     return StreamingResponse(
-        output, 
+        exports.WRITERS[format](model, _export_rows(report_type, f_date, t_date, current_user)),
         headers=headers, 
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
\ No newline at end of file
+        media_type=exports.MEDIA_TYPES[format]
+    )
+
+# Gộp nhiều báo cáo thành các sheet của 1 workbook (VD: báo cáo tháng cho phòng Tài chính)
+# Mỗi báo cáo chạy trên 1 thread với session riêng (_export_rows) và đổ dòng ra file spool tạm
+# -> tổng thời gian ~ báo cáo chậm nhất, RAM chỉ giữ 1 khối dòng / báo cáo.
+# Sheet được ghi theo đúng thứ tự yêu cầu: báo cáo nào xong trước thì chờ sẵn trên đĩa.
+def _workbook_sheets(types: list, futures: dict):
+    readers = []
+    try:
+        for t in types:
+            readers.append(exports.read_spool(futures[t].result()))
+            yield EXPORT_SHEET_TITLES[t], EXPORT_REPORTS[t], readers[-1]
+    finally:
+        # Lỗi / client ngắt giữa chừng: đợi các báo cáo còn chạy rồi xóa file spool chưa đọc
+        for reader in readers:
+            reader.close()
+        for future in futures.values():
+            if future.exception() is None and os.path.exists(future.result()):
+                os.remove(future.result())
+
+def _stream_workbook(types: list, futures: dict):
+    sheets = _workbook_sheets(types, futures)
+    try:
+        yield from exports.stream_workbook(sheets)
+    finally:
+        sheets.close()
+
+@app.get("/reports/export/workbook")
+def export_report_workbook(
+    from_date: date,
+    to_date: date,
+    report_types: str = "doctors,services,inpatients_cost,revenue,top_medicines",
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    types = [t.strip() for t in report_types.split(",") if t.strip()]
+    invalid = [t for t in types if t not in EXPORT_REPORTS]
+    if not types or invalid:
+        raise HTTPException(status_code=400, detail=f"Loại báo cáo không hợp lệ: {', '.join(invalid)}")
+    types = list(dict.fromkeys(types)) # Bỏ trùng, giữ thứ tự
+
+    # 1. Bắt đầu tính song song tất cả báo cáo ngay (không đợi tới lúc ghi sheet)
+    pool = ThreadPoolExecutor(max_workers=len(types), thread_name_prefix="workbook")
+    futures = {t: pool.submit(lambda t=t: exports.spool_rows(_export_rows(t, from_date, to_date, current_user)))
+               for t in types}
+    pool.shutdown(wait=False) # Thread tự kết thúc khi xong báo cáo của mình
+
+    # 2. Ghi từng sheet theo thứ tự vào 1 workbook (write-only) và stream file
+    filename = f"report_workbook_{from_date}_{to_date}.xlsx"
+    headers = {
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    }
+    return StreamingResponse(
+        _stream_workbook(types, futures),
+        headers=headers,
+        media_type=exports.MEDIA_TYPES["xlsx"]
+    )
+
+# F. THỐNG KÊ CACHE BÁO CÁO (hit / miss / dung lượng)
+@app.get("/admin/cache-stats")
+def get_cache_stats(
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    return {"reports": cache.report_cache.stats(), "catalog": catalog.catalog_cache.stats(),
+            "tokens": security.token_cache.stats()}
+
+# Hàng đợi email: số email chờ gửi / đến hạn / đã gửi / thất bại, email chờ lâu nhất, bộ đếm của worker
+@app.get("/admin/email-stats")
+def get_email_stats(
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    return mailer.stats(db)
+
+# Hàng chờ băm mật khẩu (bcrypt): số đang chờ / đang chạy, thời gian chờ, số request bị từ chối (503)
+@app.get("/admin/hash-stats")
+def get_hash_stats(
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    return security.hash_stats()
+
+# G. JOB BÁO CÁO CHẠY NỀN (process pool) - cho khoảng thời gian dài, không giữ request chờ
+# Tạo job -> xem trạng thái / tiến độ -> tải file kết quả (hết hạn sau jobs.JOB_FILE_TTL)
+JOB_REPORTS = {
+    'doctors': report_doctor_performance,
+    'services': report_service_usage,
+    'inpatients_cost': report_inpatient_costs,
+    'revenue': report_revenue,
+    'top_medicines': report_top_medicines,
+    'revenue_medicines': report_revenue_by_medicine,
+    'revenue_categories': report_revenue_by_category,
+    'revenue_doctors': report_revenue_by_doctor,
+}
+
+# Chạy trong process con: báo cáo dạng JSON (gọi thẳng hàm gốc, bỏ qua cache của process con)
+def _report_job(report_type: str, f_date: date, t_date: date, current_user: dict, out_path: str, progress):
+    db = database.SessionLocal()
+    try:
+        report = JOB_REPORTS[report_type].__wrapped__
+        rows = report(from_date=f_date, to_date=t_date, db=db, current_user=current_user)
+        rows = [jsonable_encoder(row) for row in progress.track(rows)]
+    finally:
+        db.close()
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False)
+
+# Chạy trong process con: xuất file xlsx / csv / parquet (cùng logic với /reports/export)
+def _export_job(report_type: str, f_date: date, t_date: date, file_format: str, current_user: dict,
+                out_path: str, progress):
+    rows = progress.track(_export_rows(report_type, f_date, t_date, current_user))
+    with open(out_path, "wb") as f:
+        for chunk in exports.WRITERS[file_format](EXPORT_REPORTS[report_type], rows):
+            f.write(chunk)
+
+@app.post("/reports/jobs", response_model=schemas.ReportJobResponse, status_code=202)
+def create_report_job(
+    req: schemas.ReportJobCreate,
+    current_user: dict = Depends(security.check_role(["ADMIN"]))
+):
+    filename = f"report_{req.report_type}_{req.from_date}_{req.to_date}.{req.format}"
+    if req.format == "json":
+        if req.report_type not in JOB_REPORTS:
+            raise HTTPException(status_code=400, detail="Loại báo cáo không hợp lệ")
+        return jobs.submit(_report_job, (req.report_type, req.from_date, req.to_date, current_user),
+                           filename, "application/json", current_user["username"])
+
+    if req.report_type not in EXPORT_REPORTS or req.format not in exports.WRITERS:
+        raise HTTPException(status_code=400, detail="Loại báo cáo hoặc định dạng không hợp lệ")
+    if not exports.is_available(req.format):
+        raise HTTPException(status_code=400, detail=f"Máy chủ chưa hỗ trợ định dạng {req.format} (cần cài pyarrow)")
+    return jobs.submit(_export_job, (req.report_type, req.from_date, req.to_date, req.format, current_user),
+                       filename, exports.MEDIA_TYPES[req.format], current_user["username"])
+
+# HELPER: Đọc job, chỉ người tạo job hoặc ADMIN được xem / tải
+def _get_own_job(job_id: str, current_user: dict) -> dict:
+    job = jobs.read(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job không tồn tại hoặc đã hết hạn")
+    if job.get("owner") != current_user["username"] and current_user["role"] != "ADMIN":
+        raise HTTPException(status_code=403, detail="Không có quyền xem job của người khác")
+    return job
+
+@app.get("/reports/jobs/{job_id}", response_model=schemas.ReportJobResponse)
+def get_report_job(
+    job_id: str,
+    current_user: dict = Depends(security.get_current_user)
+):
+    return _get_own_job(job_id, current_user)
+
+@app.get("/reports/jobs/{job_id}/download")
+def download_report_job(
+    job_id: str,
+    current_user: dict = Depends(security.get_current_user)
+):
+    job = _get_own_job(job_id, current_user)
+    if job["status"] != "DONE":
+        raise HTTPException(status_code=409, detail=f"Job chưa hoàn thành (trạng thái: {job['status']})")
+    return FileResponse(jobs.result_path(job_id), media_type=job["media_type"], filename=job["filename"])
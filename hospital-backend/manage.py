@@ -0,0 +1,125 @@
+# manage.py
+# Các lệnh bảo trì chạy ngoài server (cron / thủ công):
+#   python manage.py upgrade-schema
+#   python manage.py rebuild-visit-charges [--check]
+#   python manage.py backfill-line-prices
+#   python manage.py rebuild-daily-rollups [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+#   python manage.py rebuild-patient-search
+import argparse
+from datetime import date
+from sqlalchemy import inspect, text
+import database, models, billing, patient_search
+
+
+# --- HELPER: Thêm cột mới vào bảng đã tồn tại (create_all không tự ALTER) ---
+def add_missing_columns(table: str, columns: dict[str, str]):
+    existing = {c["name"] for c in inspect(database.engine).get_columns(table)}
+    quote = database.engine.dialect.identifier_preparer.quote
+    with database.engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(name)} {ddl}"))
+                print(f"Đã thêm cột {table}.{name}")
+
+
+# --- HELPER: Tạo các index khai báo trong models còn thiếu trên bảng đã tồn tại ---
+def add_missing_indexes():
+    inspector = inspect(database.engine)
+    for table in database.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=database.engine)
+                print(f"Đã tạo index {index.name}")
+
+
+# --- LỆNH: Tạo bảng mới & thêm cột / index mới cho DB đang chạy ---
+def upgrade_schema(args=None):
+    database.Base.metadata.create_all(bind=database.engine)
+    add_missing_columns("Prescriptions", {"unit_price": "DECIMAL(10, 2) NULL"})
+    add_missing_columns("ServiceRequests", {"unit_price": "DECIMAL(10, 2) NULL"})
+    add_missing_columns("Invoices", {"service_total": "DECIMAL(15, 2) NULL DEFAULT 0"})
+    add_missing_indexes()
+
+
+# --- LỆNH: Tính lại bảng VisitCharges & kiểm tra chênh lệch ---
+def rebuild_visit_charges(args):
+    db = database.SessionLocal()
+    try:
+        drift = billing.rebuild_visit_charges(db, check_only=args.check)
+    finally:
+        db.close()
+
+    for d in drift:
+        print(f"Visit #{d['visit_id']}: đang lưu {d['stored']} - đúng {d['expected']}")
+    action = "phát hiện" if args.check else "đã sửa"
+    print(f"Hoàn tất: {action} {len(drift)} lượt khám bị lệch")
+
+
+# --- LỆNH: Chốt giá cho các dòng đơn thuốc / chỉ định cũ (chạy 1 lần) ---
+def backfill_line_prices(args):
+    upgrade_schema()
+
+    db = database.SessionLocal()
+    try:
+        counts = billing.backfill_line_prices(db)
+    finally:
+        db.close()
+
+    for table, count in counts.items():
+        print(f"{table}: đã chốt giá cho {count} dòng")
+
+
+# --- LỆNH: Tính lại các bảng tổng hợp theo ngày (DailyRevenue / DailyMedicineUsage / DailyServiceUsage) ---
+def rebuild_daily_rollups(args):
+    upgrade_schema()
+
+    db = database.SessionLocal()
+    try:
+        counts = billing.rebuild_daily_rollups(db, from_date=args.from_date, to_date=args.to_date)
+    finally:
+        db.close()
+
+    for table, count in counts.items():
+        print(f"{table}: đã ghi {count} dòng")
+
+
+# --- LỆNH: Dựng lại chỉ mục tìm kiếm bệnh nhân (lần đầu / khi nghi lệch) ---
+def rebuild_patient_search(args):
+    upgrade_schema()
+
+    db = database.SessionLocal()
+    try:
+        count = patient_search.rebuild_index(db)
+    finally:
+        db.close()
+
+    print(f"Đã lập chỉ mục tìm kiếm cho {count} bệnh nhân")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lệnh bảo trì Hospital Backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("upgrade-schema", help="Tạo bảng mới & thêm cột / index mới (create_all không tự ALTER)")
+    cmd.set_defaults(func=upgrade_schema)
+
+    cmd = commands.add_parser("rebuild-visit-charges", help="Tính lại VisitCharges từ Prescriptions / ServiceRequests")
+    cmd.add_argument("--check", action="store_true", help="Chỉ báo cáo chênh lệch, không ghi DB")
+    cmd.set_defaults(func=rebuild_visit_charges)
+
+    cmd = commands.add_parser("backfill-line-prices", help="Thêm cột unit_price & chốt giá cho dữ liệu cũ")
+    cmd.set_defaults(func=backfill_line_prices)
+
+    cmd = commands.add_parser("rebuild-daily-rollups", help="Tính lại bảng tổng hợp báo cáo theo ngày")
+    cmd.add_argument("--from", dest="from_date", type=date.fromisoformat, help="Ngày bắt đầu (mặc định: dữ liệu cũ nhất)")
+    cmd.add_argument("--to", dest="to_date", type=date.fromisoformat, help="Ngày kết thúc (mặc định: hôm nay)")
+    cmd.set_defaults(func=rebuild_daily_rollups)
+
+    cmd = commands.add_parser("rebuild-patient-search", help="Dựng lại chỉ mục tìm kiếm bệnh nhân (tên không dấu, SĐT, CCCD, BHYT)")
+    cmd.set_defaults(func=rebuild_patient_search)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Enum, ForeignKey, DateTime, Text, DECIMAL, Float
+from sqlalchemy import Column, Integer, String, Enum, ForeignKey, DateTime, Text, DECIMAL, Float, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -88,7 +88,7 @@ class Visit(Base):
     visit_id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("Patients.patient_id"), nullable=False)
     doctor_id = Column(Integer, ForeignKey("Users.user_id"), nullable=True) 
-    visit_date = Column(DateTime(timezone=True), server_default=func.now())
+    visit_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     diagnosis = Column(Text, nullable=True)
     status = Column(Enum('WAITING', 'IN_PROGRESS', 'COMPLETED', 'PAID'), default='WAITING')
     chief_complaint = Column(Text)
@@ -115,6 +115,7 @@ class Prescription(Base):
     visit_id = Column(Integer, ForeignKey("Visits.visit_id"), nullable=False)
     medicine_id = Column(Integer, ForeignKey("Medicines.medicine_id"), nullable=False)
     quantity = Column(Integer, nullable=False)
+    unit_price = Column(DECIMAL(10, 2), nullable=True) # Giá bán tại thời điểm kê đơn
     note = Column(String(255), nullable=True)
     dosage_morning = Column(String(10))
     dosage_noon = Column(String(10))
@@ -122,16 +123,30 @@ class Prescription(Base):
     dosage_evening = Column(String(10))
     usage_instruction = Column(String(255))
 
+    medicine = relationship("Medicine")
+
+# Bảng VisitCharges (Tổng tiền thuốc / dịch vụ theo lượt khám)
+# Cập nhật cộng dồn trong cùng transaction khi kê đơn / chỉ định dịch vụ,
+# để hóa đơn & báo cáo chỉ cần đọc 1 dòng / lượt khám
+class VisitCharge(Base):
+    __tablename__ = "VisitCharges"
+
+    visit_id = Column(Integer, ForeignKey("Visits.visit_id"), primary_key=True)
+    medicine_total = Column(DECIMAL(15, 2), nullable=False, default=0)
+    service_total = Column(DECIMAL(15, 2), nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 # Bảng Invoices (Hóa đơn)
 class Invoice(Base):
     __tablename__ = "Invoices"
     
     invoice_id = Column(Integer, primary_key=True, index=True)
     visit_id = Column(Integer, ForeignKey("Visits.visit_id"), unique=True)
-    payment_time = Column(DateTime(timezone=True), server_default=func.now())
+    payment_time = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     
     # --- CÁC TRƯỜNG MỚI ---
     medicine_total = Column(DECIMAL(15, 2))
+    service_total = Column(DECIMAL(15, 2), default=0) # Tiền dịch vụ CLS
     exam_fee = Column(DECIMAL(15, 2))
     procedure_fee = Column(DECIMAL(15, 2))
     insurance_percent = Column(Integer)
@@ -140,7 +155,106 @@ class Invoice(Base):
     
     # Quan hệ
     visit = relationship("Visit")
-    
+    items = relationship("InvoiceItem", back_populates="invoice")
+
+# Bảng InvoiceItems (Dòng chi tiết hóa đơn - ghi 1 lần khi thanh toán, không sửa)
+# Lưu sẵn tên, giá, bác sĩ, thời điểm thanh toán để báo cáo doanh thu
+# chỉ cần quét 1 bảng có index, không JOIN ngược Visits / Prescriptions / danh mục
+class InvoiceItem(Base):
+    __tablename__ = "InvoiceItems"
+    __table_args__ = (
+        Index("ix_invoice_items_type_time", "item_type", "payment_time"),
+        Index("ix_invoice_items_doctor_time", "doctor_id", "payment_time"),
+    )
+
+    invoice_item_id = Column(Integer, primary_key=True, index=True)
+    invoice_id = Column(Integer, ForeignKey("Invoices.invoice_id"), nullable=False, index=True)
+    visit_id = Column(Integer, nullable=False)
+    doctor_id = Column(Integer, nullable=True) # BS khám (thuốc, phí khám) hoặc BS chỉ định (dịch vụ)
+    payment_time = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    item_type = Column(Enum('MEDICINE', 'SERVICE', 'EXAM', 'PROCEDURE'), nullable=False)
+    item_id = Column(Integer, nullable=True) # medicine_id / service_id (Không dùng FK cứng)
+    item_name = Column(String(255))
+    category = Column(String(100)) # Nhóm thuốc hoặc loại dịch vụ (LAB / IMAGING / OTHER)
+
+    quantity = Column(Integer, nullable=False, default=1)
+    unit_price = Column(DECIMAL(15, 2), nullable=False)
+    amount = Column(DECIMAL(15, 2), nullable=False)
+    insurance_amount = Column(DECIMAL(15, 2), nullable=False, default=0) # Phần BHYT chi trả
+
+    invoice = relationship("Invoice", back_populates="items")
+
+# --- BẢNG TỔNG HỢP THEO NGÀY (Rollup cho báo cáo) ---
+# Cập nhật cộng dồn khi ghi hóa đơn / đơn thuốc / chỉ định (billing.apply_daily_rollup),
+# tính lại toàn bộ bằng: python manage.py rebuild-daily-rollups
+
+# Doanh thu theo ngày thanh toán & hình thức thanh toán
+class DailyRevenue(Base):
+    __tablename__ = "DailyRevenue"
+
+    day = Column(Date, primary_key=True)
+    payment_method = Column(Enum('CASH', 'TRANSFER', 'CARD'), primary_key=True)
+    invoice_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(DECIMAL(15, 2), nullable=False, default=0)
+
+# Số lượng thuốc kê theo ngày khám & thuốc
+class DailyMedicineUsage(Base):
+    __tablename__ = "DailyMedicineUsage"
+
+    day = Column(Date, primary_key=True)
+    medicine_id = Column(Integer, ForeignKey("Medicines.medicine_id"), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    amount = Column(DECIMAL(15, 2), nullable=False, default=0)
+
+# Lượt sử dụng dịch vụ theo ngày chỉ định & dịch vụ (bỏ CANCELLED)
+class DailyServiceUsage(Base):
+    __tablename__ = "DailyServiceUsage"
+
+    day = Column(Date, primary_key=True)
+    service_id = Column(Integer, ForeignKey("Services.service_id"), primary_key=True)
+    usage_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(DECIMAL(15, 2), nullable=False, default=0)
+
+# --- CHỈ MỤC TÌM KIẾM BỆNH NHÂN (search.py) ---
+# Mỗi dòng: 1 từ đã chuẩn hóa (bỏ dấu, chữ thường) của 1 trường. Khóa chính bắt đầu bằng token
+# -> tìm theo tiền tố (token LIKE 'nguy%') chạy trên index, không quét bảng Patients.
+class PatientSearchToken(Base):
+    __tablename__ = "PatientSearchTokens"
+
+    token = Column(String(40), primary_key=True)
+    patient_id = Column(Integer, ForeignKey("Patients.patient_id"), primary_key=True, index=True)
+    field = Column(Enum('name', 'phone', 'cccd', 'insurance_card'), primary_key=True)
+
+# --- BỘ ĐẾM THAY ĐỔI THEO BẢNG (etags.py) ---
+# Mỗi lần commit có sửa 1 bảng danh mục -> version của bảng đó +1 (ETag của API danh mục dựa vào đây)
+class TableVersion(Base):
+    __tablename__ = "TableVersions"
+
+    table_name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# --- HÀNG ĐỢI EMAIL (mailer.py) ---
+# API chỉ ghi email vào bảng này trong cùng transaction với dữ liệu (VD: OTP), worker nền gửi qua SMTP
+class EmailOutbox(Base):
+    __tablename__ = "EmailOutbox"
+
+    email_id = Column(Integer, primary_key=True, index=True)
+    recipient = Column(String(100), nullable=False)
+    subject = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)
+    subtype = Column(Enum('html', 'plain'), default='html')
+    status = Column(Enum('PENDING', 'SENT', 'FAILED'), default='PENDING', nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False) # Chưa tới giờ này thì worker chưa lấy (chờ retry / đang gửi)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_email_outbox_status_next", "status", "next_attempt_at"),
+    )
+
 # 1. Bảng Lịch làm việc của Bác sĩ
 class DoctorSchedule(Base):
     __tablename__ = "DoctorSchedules"
@@ -165,7 +279,7 @@ class Appointment(Base):
     patient_id = Column(Integer, ForeignKey("Patients.patient_id"), nullable=False)
     doctor_id = Column(Integer, ForeignKey("Users.user_id"), nullable=False)
     
-    appointment_date = Column(Date, nullable=False)
+    appointment_date = Column(Date, nullable=False, index=True)
     start_time = Column(Time, nullable=False) # VD: 09:30
     end_time = Column(Time, nullable=False)   # VD: 10:00 (thường +30p)
     
@@ -196,8 +310,9 @@ class ServiceRequest(Base):
     service_id = Column(Integer, ForeignKey("Services.service_id"))
     doctor_id = Column(Integer, ForeignKey("Users.user_id"))
     quantity = Column(Integer, default=1)
+    unit_price = Column(DECIMAL(10, 2), nullable=True) # Giá dịch vụ tại thời điểm chỉ định
     status = Column(Enum('PENDING', 'COMPLETED', 'CANCELLED'), default='PENDING')
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
 
     # Quan hệ
     service = relationship("Service")
@@ -253,8 +368,8 @@ class InpatientRecord(Base):
     inpatient_id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("Patients.patient_id"))
     treating_doctor_id = Column(Integer, ForeignKey("Users.user_id"))
-    admission_date = Column(DateTime(timezone=True), server_default=func.now())
-    discharge_date = Column(DateTime(timezone=True), nullable=True)
+    admission_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    discharge_date = Column(DateTime(timezone=True), nullable=True, index=True)
     initial_diagnosis = Column(Text)
     status = Column(Enum('ACTIVE', 'DISCHARGED', 'TRANSFERRED'), default='ACTIVE')
     
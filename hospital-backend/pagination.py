@@ -0,0 +1,88 @@
+# pagination.py
+# Phân trang keyset (cursor) cho các API danh sách.
+# - Sắp xếp theo 1 hoặc nhiều cột, cột cuối luôn là khóa chính -> thứ tự ổn định, không trùng / sót dòng.
+# - Trang sau lọc bằng WHERE (cột sắp xếp) > (giá trị dòng cuối) thay cho OFFSET -> dùng index,
+#   thời gian không tăng theo số trang.
+# - Body vẫn là mảng như cũ (frontend không phải sửa); cursor trang sau nằm ở header X-Next-Cursor,
+#   tổng số dòng (khi ?include_total=true) ở header X-Total-Count.
+import base64
+import json
+from datetime import date, datetime
+from typing import Optional
+
+from fastapi import HTTPException, Query, Response
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+# Tham số chung của các API danh sách (dùng với Depends)
+class PageParams:
+    def __init__(
+        self,
+        limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+        cursor: Optional[str] = None,
+        include_total: bool = False
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.include_total = include_total
+
+
+# --- HELPER: Mã hóa / giải mã cursor (base64 của JSON, client không cần hiểu nội dung) ---
+def _encode_cursor(values: list) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, (date, datetime)) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str, columns: list) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        # Chuyển lại kiểu ngày giờ theo kiểu của cột
+        result = []
+        for value, column in zip(values, columns):
+            python_type = column.type.python_type
+            if value is not None and python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif value is not None and python_type is date:
+                value = date.fromisoformat(value)
+            result.append(value)
+        return result
+    except (ValueError, TypeError, json.JSONDecodeError, NotImplementedError):
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+
+
+# Điều kiện "đứng sau" dòng có giá trị `values` theo thứ tự order_by:
+# (a, b) sau (x, y)  <=>  a > x  HOẶC  (a = x VÀ b > y)   (cột giảm dần thì đổi > thành <)
+def _after(order_by: list, values: list):
+    clauses = []
+    for i, (column, descending) in enumerate(order_by):
+        equal = [order_by[j][0] == values[j] for j in range(i)]
+        beyond = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+
+# Phân trang 1 query. order_by: [(cột, giảm dần?)], cột cuối phải là khóa chính.
+# Trả về danh sách đối tượng của trang hiện tại, ghi header X-Next-Cursor / X-Total-Count.
+def paginate(query, page: PageParams, response: Response, order_by: list, key=None) -> list:
+    if page.include_total:
+        response.headers["X-Total-Count"] = str(query.order_by(None).count())
+
+    columns = [column for column, _ in order_by]
+    if page.cursor:
+        query = query.filter(_after(order_by, _decode_cursor(page.cursor, columns)))
+
+    query = query.order_by(*[column.desc() if descending else column.asc() for column, descending in order_by])
+    rows = query.limit(page.limit + 1).all()
+
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        # key: lấy giá trị các cột sắp xếp từ 1 dòng (mặc định đọc thuộc tính trùng tên cột)
+        last = rows[-1]
+        values = key(last) if key else [getattr(last, column.key) for column in columns]
+        response.headers["X-Next-Cursor"] = _encode_cursor(values)
+    return rows
@@ -0,0 +1,123 @@
+# patient_search.py
+# Tìm kiếm bệnh nhân cho quầy tiếp đón (gõ tới đâu tìm tới đó).
+# - Họ tên được bỏ dấu, đưa về chữ thường rồi tách từ: "Nguyễn Văn Đức" -> nguyen, van, duc
+#   => gõ "nguyen" vẫn ra "Nguyễn". SĐT / CCCD / BHYT lưu nguyên chuỗi (chỉ giữ chữ & số).
+# - Các từ nằm trong bảng PatientSearchTokens (khóa chính bắt đầu bằng token), mỗi từ khóa
+#   tìm kiếm khớp theo tiền tố (token LIKE 'ngu%') -> dùng index, không quét bảng Patients.
+# - Bệnh nhân phải khớp TẤT CẢ từ khóa; xếp hạng: khớp trọn từ > khớp tiền tố, SĐT / giấy tờ > họ tên.
+# - Chỉ mục được cập nhật trong cùng transaction khi thêm / sửa / xóa bệnh nhân (index_patient),
+#   dữ liệu cũ: python manage.py rebuild-patient-search
+import re
+import unicodedata
+
+from sqlalchemy import case, delete, func, insert, literal, select, union_all
+from sqlalchemy.orm import Session
+
+import models
+
+TOKEN_MAX_LEN = 40     # = độ dài cột PatientSearchToken.token
+MIN_PREFIX_LEN = 2     # Từ khóa 1 ký tự chỉ khớp trọn từ (tránh "n%" khớp nửa bảng), trừ từ cuối khi đã có từ khác
+MAX_TERMS = 6          # Số từ khóa tối đa mỗi lần tìm
+IDENTIFIER_FIELDS = ("phone", "cccd", "insurance_card")
+
+
+# --- HELPER: Chuẩn hóa chuỗi (bỏ dấu tiếng Việt, chữ thường) ---
+def fold(text: str) -> str:
+    text = text.replace("đ", "d").replace("Đ", "D")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+def tokenize(text: str) -> list[str]:
+    return [token[:TOKEN_MAX_LEN] for token in re.findall(r"[a-z0-9]+", fold(text or ""))]
+
+def _identifier(value: str) -> str:
+    return "".join(tokenize(value))[:TOKEN_MAX_LEN]
+
+
+# Từ khóa của câu tìm kiếm. Chỉ có số (VD: "0912 345 678") -> coi là 1 mã (SĐT / giấy tờ) liền nhau
+def _query_terms(text: str) -> list[str]:
+    terms = tokenize(text)
+    if terms and all(term.isdigit() for term in terms):
+        terms = [_identifier(text)]
+    return list(dict.fromkeys(terms))[:MAX_TERMS]
+
+
+# Các dòng chỉ mục của 1 bệnh nhân
+def _token_rows(patient: models.Patient) -> list[dict]:
+    rows = {(token, "name") for token in tokenize(patient.full_name)}
+    for field in IDENTIFIER_FIELDS:
+        value = _identifier(getattr(patient, field) or "")
+        if value:
+            rows.add((value, field))
+    return [{"token": token, "patient_id": patient.patient_id, "field": field} for token, field in rows]
+
+
+# --- 1. Cập nhật chỉ mục của 1 bệnh nhân (gọi trước db.commit(), sau khi đã có patient_id) ---
+def index_patient(db: Session, patient: models.Patient):
+    T = models.PatientSearchToken
+    db.execute(delete(T).where(T.patient_id == patient.patient_id))
+    # Bệnh nhân đã xóa mềm không xuất hiện trong kết quả tìm kiếm
+    if patient.is_active is False:
+        return
+    rows = _token_rows(patient)
+    if rows:
+        db.execute(insert(T), rows)
+
+
+# --- 2. Tìm kiếm: trả về patient_id đã xếp hạng (tối đa `limit`) ---
+def search_patient_ids(db: Session, text: str, limit: int) -> list[int]:
+    terms = _query_terms(text)
+    if not terms:
+        return []
+
+    T = models.PatientSearchToken
+    weight = case((T.field == "name", 1), else_=2)
+    parts = []
+    for i, term in enumerate(terms):
+        # Từ cuối đang gõ dở ("tran b") luôn khớp tiền tố: các từ trước đã thu hẹp kết quả
+        prefix = len(term) >= MIN_PREFIX_LEN or (i == len(terms) - 1 and i > 0)
+        condition = T.token.like(f"{term}%") if prefix else T.token == term
+        score = case((T.token == term, 2), else_=1) * weight
+        parts.append(
+            select(T.patient_id, literal(i).label("term"), score.label("score")).where(condition)
+        )
+    matches = union_all(*parts).subquery()
+
+    # Điểm của mỗi từ khóa = lần khớp tốt nhất; bệnh nhân phải khớp đủ mọi từ khóa
+    per_term = select(
+        matches.c.patient_id,
+        matches.c.term,
+        func.max(matches.c.score).label("score")
+    ).group_by(matches.c.patient_id, matches.c.term).subquery()
+
+    ranked = (
+        select(per_term.c.patient_id)
+        .group_by(per_term.c.patient_id)
+        .having(func.count() == len(terms))
+        .order_by(func.sum(per_term.c.score).desc(), per_term.c.patient_id)
+        .limit(limit)
+    )
+    return list(db.scalars(ranked))
+
+
+# --- 3. Dựng lại toàn bộ chỉ mục (lần đầu / khi nghi lệch), xử lý theo từng khối bệnh nhân ---
+def rebuild_index(db: Session, chunk_size: int = 1000) -> int:
+    db.execute(delete(models.PatientSearchToken))
+    count = 0
+    last_id = 0
+    while True:
+        patients = db.query(models.Patient).filter(
+            models.Patient.patient_id > last_id,
+            func.coalesce(models.Patient.is_active, True) == True
+        ).order_by(models.Patient.patient_id).limit(chunk_size).all()
+        if not patients:
+            break
+        rows = [row for patient in patients for row in _token_rows(patient)]
+        if rows:
+            db.execute(insert(models.PatientSearchToken), rows)
+        count += len(patients)
+        last_id = patients[-1].patient_id
+        db.commit()
+        db.expunge_all()
+    db.commit()
+    return count
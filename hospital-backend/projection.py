@@ -0,0 +1,77 @@
+# projection.py
+# Chọn trường trả về cho các API danh sách: ?fields=patient_id,full_name
+# - Chỉ SELECT các cột được chọn (load_only), quan hệ được chọn thì load bằng selectinload.
+# - Không truyền fields: lấy mọi trường của schema TRỪ các cột nặng (Text dài) trong HEAVY_FIELDS,
+#   client cần thì xin thêm qua fields=... (VD: ?fields=patient_id,full_name,allergies).
+# - Khóa chính luôn có trong kết quả. Kiểu dữ liệu / định dạng vẫn theo schema Pydantic của API.
+# json_response: đường serialize nhanh cho danh sách lớn - dòng (Row / dict / ORM) được validate & ghi JSON
+# 1 lần trong pydantic-core, trả thẳng Response nên FastAPI không validate lại theo response_model.
+import functools
+from typing import Optional
+
+from fastapi import HTTPException, Response
+from pydantic import ConfigDict, TypeAdapter, create_model
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import load_only, selectinload
+
+import models
+
+# Trường không trả về mặc định ở API danh sách (cột Text dài / danh sách con)
+HEAVY_FIELDS = {
+    models.Patient: {"allergies", "medical_history", "visits"},
+    models.Medicine: {"usage_instruction"},
+    models.Visit: set(),
+}
+
+
+# 1. Danh sách trường cần trả về (đã kiểm tra hợp lệ), khóa chính đứng đầu
+def parse_fields(fields: Optional[str], model, schema) -> tuple:
+    primary_keys = [column.key for column in sa_inspect(model).primary_key]
+    if fields is None:
+        names = [name for name in schema.model_fields if name not in HEAVY_FIELDS.get(model, ())]
+    else:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        invalid = [name for name in names if name not in schema.model_fields]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Trường không hợp lệ: {', '.join(invalid)}")
+    return tuple(dict.fromkeys(primary_keys + names))
+
+
+# 2. Thêm load_only / selectinload vào query. extra: các cột cần đọc thêm (VD: cột sắp xếp để phân trang)
+def apply(query, model, names: tuple, extra: tuple = ()):
+    mapper = sa_inspect(model)
+    columns = [getattr(model, name) for name in names if name in mapper.column_attrs]
+    columns += [column for column in extra if column.key not in names]
+    options = [load_only(*columns)]
+    options += [selectinload(getattr(model, name)) for name in names if name in mapper.relationships]
+    return query.options(*options)
+
+
+# Schema con chỉ gồm các trường đã chọn (giữ nguyên kiểu & mặc định của schema gốc), cache theo bộ trường
+@functools.lru_cache(maxsize=256)
+def _partial(schema, names: tuple):
+    return create_model(
+        f"{schema.__name__}Fields",
+        __config__=ConfigDict(from_attributes=True),
+        **{name: (schema.model_fields[name].annotation, schema.model_fields[name]) for name in names}
+    )
+
+
+# 3. Serialize danh sách đối tượng ORM ra JSON (chỉ đọc các trường đã chọn, không kích hoạt lazy load)
+def respond(rows: list, schema, names: tuple, response: Response = None) -> Response:
+    return json_response(list[_partial(schema, names)], rows, response)
+
+
+@functools.lru_cache(maxsize=256)
+def _adapter(type_) -> TypeAdapter:
+    return TypeAdapter(type_)
+
+# 4. Ghi dữ liệu ra JSON theo kiểu type_ (VD: list[schemas.InpatientResponse]).
+# data: Row của query theo cột, dict hoặc đối tượng ORM (đọc theo tên trường).
+# response: Response của endpoint -> chép lại các header đã ghi (X-Next-Cursor, X-Total-Count...)
+def json_response(type_, data, response: Response = None) -> Response:
+    adapter = _adapter(type_)
+    return Response(content=adapter.dump_json(adapter.validate_python(data, from_attributes=True)),
+                    media_type="application/json",
+                    headers={k: v for k, v in (response.headers if response is not None else {}).items()
+                             if k != "content-length"})
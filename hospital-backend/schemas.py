@@ -173,6 +173,7 @@ class PrescriptionResponse(BaseModel):
     prescription_id: int
     medicine_id: int
     quantity: int
+    unit_price: Optional[float] = None # Giá tại thời điểm kê đơn
     note: Optional[str]
     dosage_morning: Optional[str]
     dosage_noon: Optional[str]
@@ -195,6 +196,7 @@ class InvoiceResponse(BaseModel):
     invoice_id: int
     visit_id: int
     medicine_total: float
+    service_total: float = 0 # Tiền dịch vụ CLS
     exam_fee: float
     procedure_fee: float
     insurance_percent: int
@@ -206,6 +208,33 @@ class InvoiceResponse(BaseModel):
     class Config:
         from_attributes = True
 
+# Schema chốt ca thu ngân: tính / thanh toán nhiều lượt khám một lần
+# Gửi visit_ids HOẶC khoảng ngày (from_date - to_date)
+class BatchBillRequest(BaseModel):
+    visit_ids: Optional[List[int]] = None
+    from_date: Optional[date] = None
+    to_date: Optional[date] = None
+    insurance_percent: int = 0
+    payment_method: str = 'CASH'
+    create_invoices: bool = False # True: lưu Invoice cho tất cả trong 1 transaction
+
+class BatchBillItem(BaseModel):
+    visit_id: int
+    medicine_total: float
+    service_total: float
+    exam_fee: float
+    procedure_fee: float
+    sub_total: float
+    insurance_percent: int
+    discount: float
+    final_amount: float
+    invoice_id: Optional[int] = None # Có giá trị khi create_invoices = True
+
+class BatchBillResponse(BaseModel):
+    visit_count: int
+    total_amount: float # Tổng khách thực trả của cả lô
+    bills: List[BatchBillItem]
+
 # Schema hiển thị chi tiết tiền (Preview)
 class BillDetails(BaseModel):
     visit_id: int
@@ -223,6 +252,28 @@ class TopMedicine(BaseModel):
     name: str
     sold_quantity: int
     stock_quantity: int    
+
+# Báo cáo doanh thu từ dòng chi tiết hóa đơn (InvoiceItems)
+class RevenueByItem(BaseModel):
+    item_id: Optional[int]
+    item_name: Optional[str]
+    quantity: int
+    amount: float
+    insurance_amount: float # Phần BHYT chi trả
+
+class RevenueByCategory(BaseModel):
+    item_type: str # MEDICINE / SERVICE / EXAM / PROCEDURE
+    category: Optional[str] # Nhóm thuốc hoặc LAB / IMAGING / OTHER
+    quantity: int
+    amount: float
+    insurance_amount: float
+
+class RevenueByDoctor(BaseModel):
+    doctor_id: Optional[int]
+    doctor_name: Optional[str]
+    visit_count: int
+    amount: float
+    insurance_amount: float
     
 
 # --- SCHEMAS CHO LỊCH LÀM VIỆC (SCHEDULE) ---
@@ -355,7 +406,7 @@ class BedMapResponse(BaseModel):
 class AdmissionCreate(BaseModel):
     patient_id: int
     bed_id: int
-    doctor_id: int  # Đổi từ treating_doctor_id
+    doctor_id: Optional[int] = None  # Đổi từ treating_doctor_id. Bỏ trống: bác sĩ đang đăng nhập
     admission_reason: str
     diagnosis: str
 
@@ -363,7 +414,7 @@ class InpatientResponse(BaseModel):
     inpatient_id: int
     patient_id: int
     patient_name: str
-    bed_id: int
+    bed_id: Optional[int] = None # Đã xuất viện / chờ xếp giường: không có giường hiện tại
     bed_number: Optional[str]
     status: str
     admission_date: datetime
@@ -703,4 +754,21 @@ class InpatientCostReport(BaseModel):
     total_cost: float
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+# 5. Job báo cáo chạy nền (process pool)
+class ReportJobCreate(BaseModel):
+    report_type: str # doctors / services / inpatients_cost / revenue / revenue_medicines / ...
+    from_date: date
+    to_date: date
+    format: str = "json" # json / xlsx / csv / parquet
+
+class ReportJobResponse(BaseModel):
+    job_id: str
+    status: str # QUEUED / RUNNING / DONE / FAILED
+    progress: int = 0 # Số dòng đã xử lý
+    filename: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    error: Optional[str] = None
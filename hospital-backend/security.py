@@ -5,12 +5,27 @@ from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+import database
+import models
+from cache import TTLCache
 
 # Cấu hình bảo mật
 SECRET_KEY = "chuoi_bi_mat_cua_ban_nen_de_dai_va_kho_doan" # Thay đổi chuỗi này
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 # Token hết hạn sau 30 phút
 
+# Cache claims của token đã xác thực: key = sha256(token), mục tự hết hạn đúng lúc token hết hạn (exp).
+# Trạm làm việc gọi API liên tục với cùng 1 token -> chỉ verify chữ ký HMAC ở lần đầu.
+TOKEN_CACHE_MAX_BYTES = 1024 * 1024 # 1 MB (~ vài nghìn token)
+token_cache = TTLCache(TOKEN_CACHE_MAX_BYTES, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 # Công cụ mã hóa mật khẩu (Bcrypt)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -25,6 +40,68 @@ def verify_password(plain_password, hashed_password):
         return plain_password == hashed_password
     return pwd_context.verify(plain_password, hashed_password)
 
+# Pass trong DB cần băm lại (còn dạng chữ thường, hoặc băm theo cấu hình cũ) - gọi sau khi đăng nhập đúng
+def needs_rehash(hashed_password) -> bool:
+    return not hashed_password.startswith("$2b$") or pwd_context.needs_update(hashed_password)
+
+
+# --- BĂM MẬT KHẨU TRÊN EXECUTOR RIÊNG ---
+# bcrypt cố ý tốn CPU (~0.2s / lần). Chạy trong threadpool chung thì đợt đăng nhập đầu giờ chiếm hết
+# thread, các API khám / kê đơn (def thường) phải xếp hàng. -> Executor riêng, ít thread; API đăng nhập /
+# đổi mật khẩu là async def và await kết quả (không giữ thread nào trong lúc chờ).
+# Hàng chờ quá HASH_MAX_QUEUE -> 503 + Retry-After thay vì để request chờ vô hạn.
+HASH_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+HASH_MAX_QUEUE = 64
+
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_lock = threading.Lock()
+_hash_stats = {"queued": 0, "running": 0, "completed": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+async def _run_hash(func, *args):
+    with _hash_lock:
+        if _hash_stats["queued"] >= HASH_MAX_QUEUE:
+            _hash_stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Hệ thống đang bận, vui lòng thử lại sau giây lát",
+                headers={"Retry-After": "1"}
+            )
+        _hash_stats["queued"] += 1
+    submitted = time.monotonic()
+
+    def task():
+        wait = time.monotonic() - submitted
+        with _hash_lock:
+            _hash_stats["queued"] -= 1
+            _hash_stats["running"] += 1
+            _hash_stats["wait_total"] += wait
+            _hash_stats["wait_max"] = max(_hash_stats["wait_max"], wait)
+        try:
+            return func(*args)
+        finally:
+            with _hash_lock:
+                _hash_stats["running"] -= 1
+                _hash_stats["completed"] += 1
+
+    return await asyncio.get_running_loop().run_in_executor(_hash_executor, task)
+
+async def hash_password_async(plain_password) -> str:
+    return await _run_hash(pwd_context.hash, plain_password)
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    if not hashed_password.startswith("$2b$"): # Pass chưa băm: so sánh ngay, không cần executor
+        return plain_password == hashed_password
+    return await _run_hash(pwd_context.verify, plain_password, hashed_password)
+
+def hash_stats() -> dict:
+    with _hash_lock:
+        stats = dict(_hash_stats)
+    stats["workers"] = HASH_WORKERS
+    stats["max_queue"] = HASH_MAX_QUEUE
+    stats["wait_avg"] = round(stats["wait_total"] / stats["completed"], 4) if stats["completed"] else 0.0
+    stats["wait_total"], stats["wait_max"] = round(stats["wait_total"], 4), round(stats["wait_max"], 4)
+    return stats
+
 # Hàm tạo mã thông báo (JWT Token)
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -33,18 +110,47 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Giải mã + xác thực token (có cache). Token sai / hết hạn -> jwt.JWTError như jwt.decode
+def decode_token(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    found, payload = token_cache.get(key)
+    if found:
+        return payload
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if "uid" not in payload:
+        payload.update(_lookup_ids(payload.get("sub")))
+    ttl = payload["exp"] - time.time() if "exp" in payload else None
+    if ttl is None or ttl > 0:
+        token_cache.set(key, payload, ttl=ttl)
+    return payload
+
+# Token cấp trước khi có claim uid / pid: tra 1 lần theo username (kết quả vào cache cùng claims)
+def _lookup_ids(username: str) -> dict:
+    db = database.SessionLocal()
+    try:
+        row = db.query(models.User.user_id, models.Patient.patient_id).outerjoin(
+            models.Patient, models.Patient.account_id == models.User.user_id
+        ).filter(models.User.username == username).first()
+    finally:
+        db.close()
+    return {"uid": row.user_id if row else None, "pid": row.patient_id if row else None}
+
 # --- HÀM KIỂM TRA TOKEN & LẤY THÔNG TIN USER ---
 def get_current_user(token: str = Depends(oauth2_scheme)):
     """
     Xác thực token và trả về thông tin người dùng
     Được sử dụng để kiểm tra token hợp lệ
+    Trả về: username, role, user_id, patient_id (hồ sơ bệnh nhân liên kết, None nếu không có)
+    - đọc từ claims của token, không query DB
     """
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         role: str = payload.get("role")
+        user_id: int = payload.get("uid")
         
-        if username is None or role is None:
+        if username is None or role is None or user_id is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Token không hợp lệ"
@@ -55,7 +161,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
             detail="Token không hợp lệ hoặc hết hạn"
         )
     
-    return {"username": username, "role": role}
+    return {"username": username, "role": role, "user_id": user_id, "patient_id": payload.get("pid")}
 
 # --- DECORATOR KIỂM TRA QUYỀN ---
 def require_role(*allowed_roles):
@@ -66,7 +172,7 @@ def require_role(*allowed_roles):
     def decorator(func):
         async def wrapper(*args, token: str = Depends(oauth2_scheme), **kwargs):
             try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+                payload = decode_token(token)
                 user_role = payload.get("role")
                 
                 if user_role not in allowed_roles:
@@ -0,0 +1,43 @@
+# conftest.py
+# Test chạy trên SQLite (file tạm) thay cho MySQL: thay engine / SessionLocal TRƯỚC khi import main / models.
+# Chạy: cd hospital-backend && python -m pytest -q tests
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="hospital-test-"), "test.db")
+database.engine = create_engine(f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False})
+database.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=database.engine)
+
+import models  # noqa: E402
+
+database.Base.metadata.create_all(bind=database.engine)
+
+# InnoDB (MySQL) tự tạo index cho mọi cột khóa ngoại, SQLite thì không -> tạo thêm cho giống DB thật
+# (nếu không, planner của SQLite không join ngược từ bảng cha sang bảng con được bằng index)
+with database.engine.begin() as conn:
+    for table in database.Base.metadata.sorted_tables:
+        indexed = {tuple(index.columns)[0].name for index in table.indexes}
+        for fk in table.foreign_keys:
+            column = fk.parent
+            if not column.primary_key and column.name not in indexed:
+                conn.exec_driver_sql(f'CREATE INDEX "fk_{table.name}_{column.name}" ON "{table.name}" ("{column.name}")')
+                indexed.add(column.name)
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
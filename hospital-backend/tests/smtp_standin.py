@@ -0,0 +1,69 @@
+# smtp_standin.py
+# SMTP server giả lập cho test mailer: chạy trên 127.0.0.1 (cổng ngẫu nhiên) trong thread nền, không TLS /
+# đăng nhập, lưu lại nội dung các email nhận được. fail_data = n -> n lần DATA tiếp theo trả lỗi tạm 451.
+import asyncio
+import threading
+
+
+class StandIn:
+    def __init__(self):
+        self.port = None
+        self.messages = []    # Nội dung các email đã nhận (chuỗi)
+        self.connections = 0
+        self.fail_data = 0
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+
+        def reply(line: str):
+            writer.write((line + "\r\n").encode())
+
+        reply("220 standin")
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().strip().upper()
+            if command.startswith("EHLO"):
+                reply("250-standin")
+                reply("250 SIZE 1000000")
+            elif command.startswith(("HELO", "MAIL", "RCPT", "RSET", "NOOP")):
+                reply("250 ok")
+            elif command == "DATA":
+                reply("354 go")
+                await writer.drain()
+                data = []
+                while True:
+                    chunk = await reader.readline()
+                    if chunk in (b".\r\n", b""):
+                        break
+                    data.append(chunk)
+                if self.fail_data > 0:
+                    self.fail_data -= 1
+                    reply("451 try later")
+                else:
+                    self.messages.append(b"".join(data).decode())
+                    reply("250 queued")
+            elif command == "QUIT":
+                reply("221 bye")
+                await writer.drain()
+                break
+            else:
+                reply("502 unknown")
+            await writer.drain()
+        writer.close()
+
+    # Khởi động server trong thread nền, trả về khi đã nhận kết nối được
+    def start(self):
+        ready = threading.Event()
+
+        async def serve():
+            server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            await server.serve_forever()
+
+        threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+        ready.wait()
+        return self
@@ -0,0 +1,63 @@
+# Nhập viện: bác sĩ điều trị lấy từ người đăng nhập (token), không gán cứng bác sĩ mẫu.
+# Bác sĩ bỏ trống doctor_id -> chính bác sĩ đó; y tá / admin bỏ trống -> 400.
+from decimal import Decimal
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import main
+import models
+import security
+
+
+@pytest.fixture(scope="module")
+def ward():
+    db = database.SessionLocal()
+    doctor = models.User(username="bs_noitru", password="x", full_name="BS Nội trú", role="DOCTOR")
+    patient = models.Patient(full_name="Bệnh nhân nội trú")
+    department = models.Department(name="Khoa test")
+    db.add_all([doctor, patient, department])
+    db.flush()
+    room = models.Room(department_id=department.department_id, room_number="T1", type="STANDARD", base_price=Decimal(300000))
+    db.add(room)
+    db.flush()
+    beds = [models.Bed(room_id=room.room_id, bed_number=f"T1-{i}", status="AVAILABLE") for i in range(2)]
+    db.add_all(beds)
+    db.commit()
+    ids = {"doctor_id": doctor.user_id, "patient_id": patient.patient_id, "bed_ids": [b.bed_id for b in beds]}
+    db.close()
+    return ids
+
+
+def _admit(user: dict, **body):
+    main.app.dependency_overrides[security.get_current_user] = lambda: user
+    payload = {"admission_reason": "Sốt cao", "diagnosis": "Sốt xuất huyết", **body}
+    try:
+        return TestClient(main.app).post("/inpatients/admit", json=payload)
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_doctor_admits_as_treating_doctor(ward):
+    doctor = {"username": "bs_noitru", "role": "DOCTOR", "user_id": ward["doctor_id"], "patient_id": None}
+    response = _admit(doctor, patient_id=ward["patient_id"], bed_id=ward["bed_ids"][0])
+    assert response.status_code == 200
+
+    db = database.SessionLocal()
+    record = db.get(models.InpatientRecord, response.json()["inpatient_id"])
+    assert record.treating_doctor_id == ward["doctor_id"]
+    db.close()
+
+
+def test_nurse_must_choose_treating_doctor(ward):
+    nurse = {"username": "yta", "role": "NURSE", "user_id": 999, "patient_id": None}
+    response = _admit(nurse, patient_id=ward["patient_id"], bed_id=ward["bed_ids"][1])
+    assert response.status_code == 400
+
+    response = _admit(nurse, patient_id=ward["patient_id"], bed_id=ward["bed_ids"][1], doctor_id=ward["doctor_id"])
+    assert response.status_code == 200
+
+
+def test_admit_requires_login():
+    assert TestClient(main.app).post("/inpatients/admit", json={}).status_code == 401
@@ -0,0 +1,40 @@
+# Rollup theo ngày cộng dồn bằng 1 câu INSERT ... ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT (SQLite):
+# dòng đầu tiên của 1 (ngày, khóa) không bị lỗi trùng khóa khi 2 transaction cùng ghi, và không
+# tính lại từ bảng gốc trong lúc ghi (ngày cũ do rebuild-daily-rollups nạp).
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy.dialects import mysql
+
+import billing
+import database
+import models
+
+DAY = date(2024, 3, 1)
+
+
+def test_first_write_inserts_delta_then_increments(db):
+    billing.apply_daily_rollup(db, models.DailyRevenue, DAY, "CASH", invoice_count=1, revenue=Decimal(100000))
+    billing.apply_daily_rollup(db, models.DailyRevenue, DAY, "CASH", invoice_count=1, revenue=Decimal(50000))
+    billing.apply_daily_rollup(db, models.DailyRevenue, DAY, "CARD", invoice_count=1, revenue=Decimal(20000))
+
+    rows = {r.payment_method: r for r in db.query(models.DailyRevenue).filter(models.DailyRevenue.day == DAY)}
+    assert (rows["CASH"].invoice_count, rows["CASH"].revenue) == (2, Decimal(150000))
+    assert (rows["CARD"].invoice_count, rows["CARD"].revenue) == (1, Decimal(20000))
+
+
+def test_negative_delta_on_existing_row(db):
+    billing.record_service_usage(db, DAY, (1, 3, Decimal(300)))
+    billing.record_service_usage(db, DAY, (1, -1, Decimal(-100)))
+
+    row = db.get(models.DailyServiceUsage, (DAY, 1))
+    assert (row.usage_count, row.revenue) == (2, Decimal(200))
+
+
+def test_mysql_uses_single_upsert():
+    statement = database.increment_statement("mysql", models.DailyMedicineUsage.__table__,
+                                             {"day": DAY, "medicine_id": 1}, {"quantity": 2, "amount": 10})
+    sql = str(statement.compile(dialect=mysql.dialect()))
+    assert sql.startswith("INSERT INTO `DailyMedicineUsage`")
+    assert "ON DUPLICATE KEY UPDATE quantity = (`DailyMedicineUsage`.quantity + VALUES(quantity))" in sql
+    assert "amount = (`DailyMedicineUsage`.amount + VALUES(amount))" in sql
@@ -0,0 +1,129 @@
+# Worker email gửi qua SMTP giả lập (tests/smtp_standin.py): gửi được thì SENT, lỗi tạm thì hẹn thử lại,
+# ghi DB lỗi sau khi gửi thì ghi lại ở vòng sau chứ không gửi trùng, lỗi bất ngờ thì ghi log và chờ lâu dần.
+import asyncio
+import logging
+from datetime import datetime
+
+import pytest
+from fastapi_mail import ConnectionConfig
+
+import database
+import mailer
+import models
+from smtp_standin import StandIn
+
+
+@pytest.fixture(scope="module")
+def standin():
+    return StandIn().start()
+
+
+@pytest.fixture
+def outbox(standin, monkeypatch):
+    monkeypatch.setattr(mailer, "conf", ConnectionConfig(
+        MAIL_USERNAME="", MAIL_PASSWORD="", MAIL_FROM="noreply@hospital.vn",
+        MAIL_PORT=standin.port, MAIL_SERVER="127.0.0.1",
+        MAIL_STARTTLS=False, MAIL_SSL_TLS=False, USE_CREDENTIALS=False, VALIDATE_CERTS=False, TIMEOUT=5
+    ))
+    monkeypatch.setattr(mailer, "_unrecorded", [])
+    standin.messages.clear()
+    standin.fail_data = 0
+    yield standin
+    db = database.SessionLocal()
+    db.query(models.EmailOutbox).delete()
+    db.commit()
+    db.close()
+
+
+def _enqueue(*recipients):
+    db = database.SessionLocal()
+    for recipient in recipients:
+        mailer.enqueue(db, recipient, "Mã OTP", f"<p>OTP cho {recipient}</p>")
+    db.commit()
+    db.close()
+
+
+def _rows():
+    db = database.SessionLocal()
+    try:
+        return {row.recipient: row for row in db.query(models.EmailOutbox).all()}
+    finally:
+        db.close()
+
+
+# Chạy 1 vòng của worker: lấy lô rồi gửi
+async def _run_once():
+    batch = await asyncio.to_thread(mailer._claim_batch)
+    smtp = await mailer._send_batch(None, batch)
+    if smtp is not None:
+        await mailer._close(smtp)
+
+
+def test_batch_is_sent_and_marked(outbox):
+    _enqueue("a@hospital.vn", "b@hospital.vn")
+    asyncio.run(_run_once())
+
+    assert len(outbox.messages) == 2
+    rows = _rows()
+    assert {row.status for row in rows.values()} == {"SENT"}
+    assert all(row.attempts == 1 and row.sent_at is not None for row in rows.values())
+
+
+def test_transient_failure_is_retried_later(outbox):
+    outbox.fail_data = 1
+    _enqueue("a@hospital.vn")
+    asyncio.run(_run_once())
+
+    row = _rows()["a@hospital.vn"]
+    assert outbox.messages == []
+    assert row.status == "PENDING" and row.attempts == 1
+    assert "451" in row.last_error
+    assert row.next_attempt_at > datetime.now() # Hẹn lại theo backoff, không lấy lại ngay
+
+
+def test_record_failure_after_send_does_not_resend(outbox, monkeypatch):
+    _enqueue("a@hospital.vn", "b@hospital.vn")
+    record, calls = mailer._record, []
+
+    def flaky_record(results):
+        calls.append(results)
+        if len(calls) == 1:
+            raise RuntimeError("DB mất kết nối")
+        record(results)
+
+    monkeypatch.setattr(mailer, "_record", flaky_record)
+    with pytest.raises(RuntimeError):
+        asyncio.run(_run_once())
+
+    # Email đầu đã gửi nhưng chưa ghi được; email sau chưa gửi, vẫn đang giữ chỗ
+    assert len(outbox.messages) == 1
+    assert [email_id for email_id, _, _ in mailer._unrecorded] == [_rows()["a@hospital.vn"].email_id]
+
+    # Vòng sau của worker: ghi lại kết quả còn treo trước khi lấy lô mới
+    mailer._record(list(mailer._unrecorded))
+    mailer._unrecorded.clear()
+    rows = _rows()
+    assert rows["a@hospital.vn"].status == "SENT"
+    assert rows["b@hospital.vn"].status == "PENDING"
+    assert mailer._claim_batch() == [] # Chưa hết giữ chỗ -> không ai gửi lại
+
+
+def test_worker_logs_and_backs_off_on_error(outbox, monkeypatch, caplog):
+    def broken_claim():
+        raise RuntimeError("DB mất kết nối")
+
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        if len(delays) == 5:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(mailer, "_claim_batch", broken_claim)
+    monkeypatch.setattr(mailer.asyncio, "sleep", fake_sleep)
+    with caplog.at_level(logging.ERROR, logger="mailer"), pytest.raises(asyncio.CancelledError):
+        asyncio.run(mailer.worker())
+
+    assert delays == [5, 10, 20, 40, 60]
+    assert len(caplog.records) == 5
+    assert all(record.exc_info for record in caplog.records)
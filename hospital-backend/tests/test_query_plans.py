@@ -0,0 +1,107 @@
+# Báo cáo lọc theo khoảng thời gian nửa mở trên cột gốc -> planner phải dùng index của cột ngày,
+# không quét toàn bảng. Kiểm tra bằng EXPLAIN QUERY PLAN (SQLite) trên đúng các câu SQL báo cáo sinh ra.
+# Planner chọn theo thống kê: bảng rỗng thì nó đi theo khóa chính / quét bảng nhỏ -> nạp 3 năm dữ liệu
+# (mỗi ngày 1 lượt khám, 1 đơn thuốc, 1 chỉ định, 1 hóa đơn, 1 hồ sơ nội trú) rồi ANALYZE như DB thật.
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import event, text
+
+import billing
+import database
+import main
+import models
+
+FROM_DATE, TO_DATE = date(2024, 1, 1), date(2024, 1, 31)
+
+
+@pytest.fixture(scope="module")
+def history():
+    db = database.SessionLocal()
+    patient = models.Patient(full_name="Bệnh nhân test")
+    medicine = models.Medicine(name="Thuốc test", unit="viên", price=Decimal(1000), stock_quantity=0)
+    service = models.Service(name="Dịch vụ test", type="LAB", price=Decimal(50000))
+    db.add_all([patient, medicine, service])
+    db.flush()
+
+    first = datetime(2022, 1, 1, 9)
+    for i in range(3 * 365):
+        day = first + timedelta(days=i)
+        visit = models.Visit(patient_id=patient.patient_id, visit_date=day, status="PAID")
+        db.add(visit)
+        db.flush()
+        db.add_all([
+            models.Prescription(visit_id=visit.visit_id, medicine_id=medicine.medicine_id, quantity=1, unit_price=medicine.price),
+            models.ServiceRequest(visit_id=visit.visit_id, service_id=service.service_id, quantity=1,
+                                  unit_price=service.price, status="COMPLETED", created_at=day),
+            models.Invoice(visit_id=visit.visit_id, final_amount=Decimal(0), payment_method="CASH", payment_time=day),
+            models.InpatientRecord(patient_id=patient.patient_id, status="DISCHARGED",
+                                   admission_date=day, discharge_date=day + timedelta(days=3)),
+        ])
+    db.commit()
+    db.execute(text("ANALYZE"))
+    db.commit()
+    yield
+    for model in (models.Invoice, models.ServiceRequest, models.Prescription, models.InpatientRecord,
+                  models.Visit, models.Service, models.Medicine, models.Patient):
+        db.query(model).delete()
+    db.commit()
+    db.execute(text("ANALYZE"))
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def captured(history):
+    statements = []
+
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(database.engine, "before_cursor_execute", _capture)
+    yield statements
+    event.remove(database.engine, "before_cursor_execute", _capture)
+
+
+# Kế hoạch thực thi của các câu SELECT có lọc theo `predicate`
+def _plans(statements, predicate):
+    selects = [(s, p) for s, p in statements if predicate in s and s.lstrip().upper().startswith("SELECT")]
+    assert selects, f"Không có câu SQL nào lọc theo {predicate}"
+    plans = []
+    with database.engine.connect() as conn:
+        conn.exec_driver_sql("ANALYZE sqlite_schema") # Kết nối trong pool: nạp lại thống kê vừa ANALYZE
+        for statement, parameters in selects:
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+            plans.append(" | ".join(row[-1] for row in rows))
+    return plans
+
+
+def _assert_uses_index(statements, predicate, index):
+    for plan in _plans(statements, predicate):
+        assert f"USING INDEX {index} " in plan or f"USING COVERING INDEX {index} " in plan, plan
+
+
+def test_doctor_performance_uses_visit_date_index(db, captured):
+    main.report_doctor_performance.__wrapped__(FROM_DATE, TO_DATE, db=db, current_user=None)
+    _assert_uses_index(captured, '"Visits".visit_date >=', "ix_Visits_visit_date")
+
+
+def test_inpatient_costs_use_discharge_date_index(db, captured):
+    list(billing.inpatient_cost_rows(db, FROM_DATE, TO_DATE))
+    _assert_uses_index(captured, '"InpatientRecords".discharge_date >=', "ix_InpatientRecords_discharge_date")
+
+
+def test_rollup_facts_use_date_indexes(db, captured):
+    start, end = main._day_range(FROM_DATE, TO_DATE)
+    billing._revenue_facts(db, start, end).all()
+    billing._medicine_usage_facts(db, start, end).all()
+    billing._service_usage_facts(db, start, end).all()
+    _assert_uses_index(captured, '"Invoices".payment_time >=', "ix_Invoices_payment_time")
+    _assert_uses_index(captured, '"Visits".visit_date >=', "ix_Visits_visit_date")
+    _assert_uses_index(captured, '"ServiceRequests".created_at >=', "ix_ServiceRequests_created_at")
+
+
+def test_invoice_item_reports_use_payment_time_index(db, captured):
+    main.report_revenue_by_medicine.__wrapped__(FROM_DATE, TO_DATE, db=db, current_user=None)
+    _assert_uses_index(captured, '"InvoiceItems".payment_time >=', "ix_invoice_items_type_time")
@@ -0,0 +1,54 @@
+# Cache báo cáo: invalidate theo tag từ API ghi (tạo lượt khám -> báo cáo bác sĩ tính lại),
+# ghi nghiệp vụ không đụng tới bộ đếm TableVersions (chỉ bảng danh mục mới có bộ đếm).
+from datetime import date
+
+from fastapi.testclient import TestClient
+
+import cache
+import database
+import main
+import models
+import security
+
+ADMIN = {"username": "admin", "role": "ADMIN", "user_id": 1, "patient_id": None}
+QUERY = {"from_date": str(date.today()), "to_date": str(date.today())}
+
+
+def _counters():
+    db = database.SessionLocal()
+    try:
+        return {r.table_name: r.version for r in db.query(models.TableVersion).all()}
+    finally:
+        db.close()
+
+
+def test_visit_write_invalidates_report_without_bumping_counters():
+    db = database.SessionLocal()
+    doctor = models.User(username="bs_cache", password="x", full_name="BS Cache", role="DOCTOR")
+    patient = models.Patient(full_name="Bệnh nhân cache")
+    db.add_all([doctor, patient])
+    db.commit()
+    doctor_id, patient_id = doctor.user_id, patient.patient_id
+    db.close()
+
+    cache.report_cache.clear()
+    main.app.dependency_overrides[security.get_current_user] = lambda: ADMIN
+    try:
+        client = TestClient(main.app)
+
+        def visits():
+            rows = client.get("/reports/doctors-performance", params=QUERY).json()
+            return next(r["total_visits"] for r in rows if r["doctor_id"] == doctor_id)
+
+        assert visits() == 0
+        hits = cache.report_cache.hits
+        assert visits() == 0
+        assert cache.report_cache.hits == hits + 1
+
+        counters = _counters()
+        response = client.post("/visits", json={"patient_id": patient_id, "doctor_id": doctor_id, "chief_complaint": "Sốt"})
+        assert response.status_code == 200
+        assert visits() == 1
+        assert _counters() == counters
+    finally:
+        main.app.dependency_overrides.clear()
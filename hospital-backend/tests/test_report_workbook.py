@@ -0,0 +1,48 @@
+# Workbook nhiều báo cáo: các báo cáo chạy song song (mỗi báo cáo 1 thread, session riêng)
+# -> tổng thời gian ~ báo cáo chậm nhất; sheet vẫn đúng thứ tự yêu cầu, file spool tạm được dọn hết.
+import io
+import os
+import tempfile
+import threading
+import time
+
+from fastapi.testclient import TestClient
+from openpyxl import load_workbook
+
+import main
+import security
+
+REPORT_DELAY = 0.5
+
+
+def _spool_files():
+    return {name for name in os.listdir(tempfile.gettempdir()) if name.endswith(".spool")}
+
+
+def test_workbook_reports_run_concurrently(monkeypatch):
+    threads = {}
+
+    def slow_rows(report_type, f_date, t_date, current_user):
+        threads[report_type] = threading.get_ident()
+        time.sleep(REPORT_DELAY)
+        yield {column: None for column in main.EXPORT_REPORTS[report_type].model_fields}
+
+    monkeypatch.setattr(main, "_export_rows", slow_rows)
+    main.app.dependency_overrides[security.get_current_user] = lambda: {"username": "admin", "role": "ADMIN", "user_id": 1}
+    spools_before = _spool_files()
+    try:
+        client = TestClient(main.app)
+        started = time.perf_counter()
+        response = client.get("/reports/export/workbook", params={"from_date": "2024-01-01", "to_date": "2024-01-31"})
+        elapsed = time.perf_counter() - started
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert len(threads) == len(main.EXPORT_REPORTS)
+    assert len(set(threads.values())) == len(main.EXPORT_REPORTS)
+    assert elapsed < REPORT_DELAY * 2 # Tuần tự sẽ mất ~ REPORT_DELAY * 5
+
+    workbook = load_workbook(io.BytesIO(response.content), read_only=True)
+    assert workbook.sheetnames == list(main.EXPORT_SHEET_TITLES.values())
+    assert _spool_files() == spools_before
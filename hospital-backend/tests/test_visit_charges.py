@@ -0,0 +1,37 @@
+# VisitCharges: dòng tổng được mở cùng lúc tạo lượt khám, các thao tác ghi chỉ UPDATE cộng dồn
+# (không INSERT trong lúc kê đơn / chỉ định -> không tranh nhau tạo dòng đầu tiên).
+from decimal import Decimal
+
+import billing
+import models
+
+
+def _visit(db):
+    patient = models.Patient(full_name="Bệnh nhân test")
+    db.add(patient)
+    db.flush()
+    visit = models.Visit(patient_id=patient.patient_id, status="WAITING")
+    db.add(visit)
+    db.flush()
+    return visit
+
+
+def test_charges_are_added_to_row_opened_with_visit(db):
+    visit = _visit(db)
+    billing.open_visit_charge(db, visit.visit_id)
+    db.flush()
+    billing.apply_visit_charge(db, visit.visit_id, medicine_delta=Decimal(14000))
+    billing.apply_visit_charge(db, visit.visit_id, service_delta=Decimal(60000))
+    billing.apply_visit_charge(db, visit.visit_id, service_delta=Decimal(-10000))
+
+    row = db.get(models.VisitCharge, visit.visit_id)
+    db.refresh(row)
+    assert (row.medicine_total, row.service_total) == (Decimal(14000), Decimal(50000))
+
+
+def test_legacy_visit_without_row_is_left_to_rebuild(db):
+    visit = _visit(db)
+    billing.apply_visit_charge(db, visit.visit_id, medicine_delta=Decimal(14000))
+
+    assert db.get(models.VisitCharge, visit.visit_id) is None
+    assert billing.charge_totals(db, [visit.visit_id])[visit.visit_id] == {"medicine_total": 0.0, "service_total": 0.0}